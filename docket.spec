@@ -31,7 +31,6 @@ Requires:       python2-tonyg-rfc3339
 Requires:       uwsgi
 Requires:       uwsgi-plugin-python2
 
-Requires:       wireshark
 Requires:       redis
 
 %description
@@ -70,6 +69,7 @@ install -p -m 644 systemd/docket.service %{buildroot}%{_unitdir}/
 install -p -m 644 systemd/docket.socket  %{buildroot}%{_unitdir}/
 install -p -m 644 systemd/docket-celery-query.service %{buildroot}%{_unitdir}/
 install -p -m 644 systemd/docket-celery-io.service %{buildroot}%{_unitdir}/
+install -p -m 644 systemd/docket-celery-bulk.service %{buildroot}%{_unitdir}/
 install -p -m 644 systemd/docket-tmpfiles.conf %{buildroot}%{_tmpfilesdir}/%{name}.conf
 install -p -m 644 systemd/docket-uwsgi.ini %{buildroot}%{_sysconfdir}/docket/
 install -p -m 644 systemd/docket.sysconfig %{buildroot}%{_sysconfdir}/sysconfig/%{name}
@@ -92,13 +92,13 @@ getent passwd %{name} >/dev/null || \
 exit 0
 
 %post
-%systemd_post docket.socket docket.service docket-celery-query.service docket-celery-io.service
+%systemd_post docket.socket docket.service docket-celery-query.service docket-celery-bulk.service docket-celery-io.service
 
 %preun
-%systemd_preun docket.socket docket.service docket-celery-query.service docket-celery-io.service
+%systemd_preun docket.socket docket.service docket-celery-query.service docket-celery-bulk.service docket-celery-io.service
 
 %postun
-%systemd_postun_with_restart docket.socket docket.service docket-celery-query.service docket-celery-io.service
+%systemd_postun_with_restart docket.socket docket.service docket-celery-query.service docket-celery-bulk.service docket-celery-io.service
 
 %files
 %defattr(0644, root, root, 0755)
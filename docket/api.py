@@ -18,10 +18,12 @@
 ## under the License.
 ##
 ##
-from flask import Flask, Blueprint, Response
+from flask import Flask, Blueprint, Response, request, g
 from flask_restful import Api
+from time import time
 
-from resources.query import QueryRequest, ApiRequest, RawRequest
+from resources.query import QueryRequest, ApiRequest, RawRequest, StreamRequest, RefineRequest, ResultRequest, \
+        METRICS, PROFILER
 
 from config import Config
 
@@ -29,6 +31,34 @@ from config import Config
 api_bp = Blueprint('query', __name__)
 api = Api(api_bp)
 
+# time every request (docket_http_request_seconds). App-wide: flask takes the blueprint
+# from the endpoint's name, and ours have dots in them
+@api_bp.before_app_request
+def _start_timer():
+    g.started = time()
+
+@api_bp.after_app_request
+def _stop_timer(response):
+    METRICS.observe('docket_http_request_seconds', time() - g.started, endpoint=request.endpoint or 'unknown')
+    return response
+
+# profile PROFILE_RATE of requests, and those with the PROFILE_TOKEN header (not the profile listing itself)
+@api_bp.before_app_request
+def _start_profile():
+    token = Config.get('PROFILE_TOKEN')
+    if request.view_args and request.view_args.get('api') == 'profiles':
+        return
+    g.profile = PROFILER.start(request.endpoint or 'unknown',
+                               forced=bool(token) and request.headers.get('X-Docket-Profile') == str(token))
+
+@api_bp.teardown_app_request
+def _stop_profile(exc):
+    PROFILER.stop(g.pop('profile', None))
+
+# Result files are under PCAP_WEB_ROOT
+results_bp = Blueprint('results', __name__)
+results = Api(results_bp)
+
 # Add resources
 # consider 'login_required' for queries
 
@@ -52,12 +82,28 @@ api.add_resource(RawRequest, '/query/', endpoint="query.rawrequest.post", method
 api.add_resource(QueryRequest, '/', endpoint="query.queryrequest.post", methods=['POST'])  # POST / -d '{ "port":21, "after-ago":"1m" }'
 api.add_resource(QueryRequest, '/uri/<path:path>', endpoint="query.queryrequest.get", methods=['GET'])  # GET  /uri/host/1.2.3.4/port/80
 
+# StreamRequest sends a query's packets as sensors deliver them
+#   GET /stream/734d929c61e64315b140cb7040115a70 | tcpdump -r -
+api.add_resource(StreamRequest, '/stream/<q_id>', endpoint="query.streamrequest.get", methods=['GET'])
+
+# RefineRequest filters a completed query's results into a new query, without asking the sensors
+#   GET /refine/734d929c61e64315b140cb7040115a70/host/1.2.3.4/port/80
+api.add_resource(RefineRequest, '/refine/<q_id>/<path:path>', endpoint="query.refinerequest.get", methods=['GET'])
+
 # ApiRequest handles metadata requests
 #   GET /urls   GET /urls/d6c1e79adf9f46bf6187fd92fff016e5,734d929c61e64315b140cb7040115a70
 #   GET /ids    GET /ids/734d929c61e64315b140cb7040115a70,7065d7548b8e717b5bdac1d074e80b55
 #   GET /status GET /status/734d929c61e64315b140cb7040115a70,7065d7548b8e717b5bdac1d074e80b55
 #   GET /stats  GET /stats/sensor.1,sensor.2
+#   GET /events/734d929c61e64315b140cb7040115a70/?cursor=0   new events since cursor (returns the next cursor)
+#   GET /catalog  rebuild the spool catalog from SPOOL_DIR (queued in the io worker)
+#   GET /profiles GET /profiles/20181018T120000.000000.query.queryrequest.post.1234.folded   (see PROFILE_RATE)
 api.add_resource(ApiRequest,
                  '/<api>/<path:selected>/',
                  '/<api>/', methods=['GET']
                 )
+
+# ResultRequest serves results the web server doesn't have as files: compressed ones (COMPRESS_RESULTS)
+#   GET /results/734d929c61e64315b140cb7040115a70/merged.pcap        decompressed, Range requests supported
+#   GET /results/734d929c61e64315b140cb7040115a70/merged.pcap.gz     as stored
+results.add_resource(ResultRequest, '/<q_id>/<name>', endpoint="results.resultrequest.get", methods=['GET'])
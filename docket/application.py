@@ -68,8 +68,9 @@ class Application(object):
 #        return Manager(self.flask_app)
 
     def _set_blueprints(self):
-        from api import api_bp
+        from api import api_bp, results_bp
         self.flask_app.register_blueprint(api_bp, url_prefix=Config.get('WEB_ROOT', '/api'))
+        self.flask_app.register_blueprint(results_bp, url_prefix=Config.get('PCAP_WEB_ROOT', '/results'))
 
     def _configure_app(self, env):
         conf = env.get('DOCKET_CONF') or env.get('APP_CONF')
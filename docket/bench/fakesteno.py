@@ -0,0 +1,309 @@
+##
+## Copyright (c) 2017, 2018 RockNSM.
+##
+## This file is part of RockNSM
+## (see http://rocknsm.io).
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##   http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing,
+## software distributed under the License is distributed on an
+## "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+## KIND, either express or implied.  See the License for the
+## specific language governing permissions and limitations
+## under the License.
+##
+##
+""" Fake stenographer instances: mTLS /debug/stats and /query answered with synthetic captures
+    usage (from the docket directory):
+        python -m bench.fakesteno --instances 4 --size 8MB --latency 0.2 --busy 0.2 --failures 0.01
+    Once listening, prints one JSON line: the certificates and {sensor, port} of each instance.
+    On SIGTERM (or ^C) prints another: what each instance served.
+"""
+from __future__ import print_function
+from argparse import ArgumentParser
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from calendar import timegm
+from datetime import datetime
+from json import dumps
+from shutil import rmtree
+from socket import inet_aton, error as SocketError
+from subprocess import check_call
+from tempfile import mkdtemp
+from threading import Thread, Lock
+from time import time, sleep
+import random
+import signal
+import struct
+import ssl
+import sys
+import os
+import re
+# python 2: the first strptime in a thread can race the import of this
+import _strptime
+
+from common.pcap import global_header, RECORD_HEADER
+from common.utils import parse_capacity, ISOFORMAT
+
+_WINDOW_RX = re.compile(r'\b(after|before) (\S+)')
+_HOST_RX = re.compile(r'\bhost (\d+\.\d+\.\d+\.\d+)\b')
+_PORT_RX = re.compile(r'\bport (\d+)\b')
+# packet sizes on the wire: acks, small queries, mid-sized and full frames
+_LENGTHS = (60, 66, 120, 590, 1514)
+# bytes of packets sent per chunk of the (chunked) response
+_BLOCK = 256 * 1024
+
+
+def make_certs(directory):
+    """ a CA, and server and client certificates it signed, for 127.0.0.1. Requires openssl
+        returns {ca, cert, key, server_cert, server_key}: paths in directory
+    """
+    def path(name):
+        return os.path.join(directory, name)
+
+    def openssl(*args):
+        with open(os.devnull, 'wb') as quiet:
+            check_call(('openssl',) + args, stdout=quiet, stderr=quiet)
+
+    openssl('req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '2', '-subj', '/CN=docket-bench-ca',
+            '-keyout', path('ca_key.pem'), '-out', path('ca_cert.pem'))
+    with open(path('san.ext'), 'w') as f:
+        f.write('subjectAltName=IP:127.0.0.1,DNS:localhost\n')
+    for name, cn in (('server', '127.0.0.1'), ('client', 'docket-bench-client')):
+        openssl('req', '-newkey', 'rsa:2048', '-nodes', '-subj', '/CN={}'.format(cn),
+                '-keyout', path(name + '_key.pem'), '-out', path(name + '.csr'))
+        openssl('x509', '-req', '-days', '2', '-in', path(name + '.csr'), '-extfile', path('san.ext'),
+                '-CA', path('ca_cert.pem'), '-CAkey', path('ca_key.pem'), '-CAcreateserial',
+                '-out', path(name + '_cert.pem'))
+    return {'ca': path('ca_cert.pem'), 'cert': path('client_cert.pem'), 'key': path('client_key.pem'),
+            'server_cert': path('server_cert.pem'), 'server_key': path('server_key.pem')}
+
+
+def _packets(query, size, rnd):
+    """ ethernet/ipv4/udp packets: from the query's host and port, spread evenly over its time window """
+    window = dict((kind, timegm(datetime.strptime(value, ISOFORMAT).timetuple()))
+                  for kind, value in _WINDOW_RX.findall(query))
+    before = window.get('before', int(time()))
+    after = window.get('after', before - 3600)
+    host = _HOST_RX.search(query)
+    port = _PORT_RX.search(query)
+    src = inet_aton(host.group(1) if host else '10.0.0.1')
+    sport = int(port.group(1)) if port else 53
+
+    bodies = []
+    for length in _LENGTHS:
+        dst = inet_aton('10.{}.{}.{}'.format(rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(1, 254)))
+        ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, length - 14, 0, 0, 64, 17, 0, src, dst)
+        udp = struct.pack('!HHHH', sport, rnd.randint(1024, 65535), length - 34, 0)
+        bodies.append(b'\x02' * 6 + b'\x04' * 6 + b'\x08\x00' + ip + udp + b'\x00' * (length - 42))
+
+    average = sum(_LENGTHS) / float(len(_LENGTHS)) + RECORD_HEADER.size
+    count = max(int(size / average), 1)
+    step = max(before - after, 1) * 1000000.0 / count
+    block, ts = [], after * 1000000.0
+    for i in range(count):
+        body = bodies[i % len(bodies)]
+        ts += step
+        block.append(RECORD_HEADER.pack(int(ts) // 1000000, int(ts) % 1000000, len(body), len(body)))
+        block.append(body)
+        if len(block) * (average / 2) >= _BLOCK:
+            yield b''.join(block)
+            block = []
+    if block:
+        yield b''.join(block)
+
+
+class FakeStenographer(object):
+    """ steno = FakeStenographer(sensor, server_cert, server_key, ca, size, ...)
+            size - bytes of pcap per query (uniform within +/- spread of it)
+            latency - seconds before a query's response starts, rate - bytes/second (0: as fast as possible)
+            busy - part of every 'period' seconds /debug/stats reports reads in progress, starting at 'phase'
+            failures - part of queries that fail: half are refused (400), half are cut off mid transfer
+        steno.start()           listen on an ephemeral port of 127.0.0.1, returns it
+        steno.counters()        {queries, failed, bytes, stats}
+        steno.stop()
+    """
+    def __init__(self, sensor, server_cert, server_key, ca, size, spread=0.5, latency=0.0, rate=0,
+                 busy=0.0, period=10.0, phase=0.0, failures=0.0, seed=None):
+        self.sensor = sensor
+        self.size = size
+        self.spread = spread
+        self.latency = latency
+        self.rate = rate
+        self.busy = busy
+        self.period = period
+        self.phase = phase
+        self.failures = failures
+        self.active = 0
+        self._counts = {'queries': 0, 'failed': 0, 'bytes': 0, 'stats': 0}
+        self._lock = Lock()
+        self._random = random.Random(seed)
+        self._context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH, cafile=ca)
+        self._context.load_cert_chain(server_cert, server_key)
+        self._context.verify_mode = ssl.CERT_REQUIRED
+        self._server = None
+
+    def start(self):
+        self._server = _TLSServer(('127.0.0.1', 0), _Handler, self._context, self)
+        thread = Thread(target=self._server.serve_forever, name=self.sensor)
+        thread.daemon = True
+        thread.start()
+        return self._server.server_address[1]
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def counters(self):
+        with self._lock:
+            return dict(self._counts)
+
+    def _count(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                self._counts[name] += value
+
+    def stats(self):
+        """ stenographer's /debug/stats: 'name value' lines. Reads are in progress while busy or answering """
+        self._count(stats=1)
+        busy = (time() + self.phase) % self.period < self.busy * self.period
+        return 'indexfile_current_reads {}\noldest_timestamp {}\n'.format(
+            self.active + int(busy), int((time() - 86400) * 1000000000))
+
+    def query(self, handler, query):
+        with self._lock:
+            self.active += 1
+            self._counts['queries'] += 1
+            draw = self._random.random()
+            seed = self._random.random()
+            size = int(self.size * (1 + self.spread * (2 * self._random.random() - 1)))
+        try:
+            sleep(self.latency)
+            if draw < self.failures / 2:
+                self._count(failed=1)
+                return handler.reply(400, "fake failure\n")
+            cut = size * seed if draw < self.failures else None
+
+            handler.send_response(200)
+            handler.send_header('Content-Type', 'application/octet-stream')
+            handler.send_header('Transfer-Encoding', 'chunked')
+            handler.end_headers()
+            started, sent = time(), 0
+            for data in [global_header()] + list(_packets(query, size, random.Random(seed))):
+                if cut is not None and sent >= cut:
+                    # the connection closes (cleanly) without the last chunk: an interrupted transfer
+                    self._count(failed=1)
+                    handler.close_connection = True
+                    handler.wfile.flush()
+                    handler.request.unwrap()
+                    return
+                handler.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+                sent += len(data)
+                if self.rate:
+                    sleep(max(sent / float(self.rate) - (time() - started), 0))
+            handler.wfile.write(b'0\r\n\r\n')
+            self._count(bytes=sent)
+        finally:
+            with self._lock:
+                self.active -= 1
+
+
+class _TLSServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, handler, context, steno):
+        HTTPServer.__init__(self, address, handler)
+        self.context = context
+        self.steno = steno
+
+    def get_request(self):
+        # the handshake happens in the request's thread (see _Handler.setup), so a slow client can't stall accept
+        sock, address = self.socket.accept()
+        return self.context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False), address
+
+    def handle_error(self, request, address):
+        pass        # clients that hang up, or fail the handshake
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # keep-alive, like stenographer (and docket's session pool) expects
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        self.request.do_handshake()
+        BaseHTTPRequestHandler.setup(self)
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, code, text):
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
+    def do_GET(self):
+        if self.path != '/debug/stats':
+            return self.reply(404, "not found\n")
+        self.reply(200, self.server.steno.stats())
+
+    def do_POST(self):
+        query = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path != '/query':
+            return self.reply(404, "not found\n")
+        try:
+            self.server.steno.query(self, query)
+        except SocketError:
+            self.close_connection = True        # the client gave up
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--instances', type=int, default=4, help='number of instances')
+    parser.add_argument('--size', default='8MB', help='capture size returned per query')
+    parser.add_argument('--spread', type=float, default=0.5, help='sizes vary by this part of --size, either way')
+    parser.add_argument('--latency', type=float, default=0.2, help='seconds before a response starts')
+    parser.add_argument('--rate', default='0', help='transfer rate per query, bytes/second (0: unlimited)')
+    parser.add_argument('--busy', type=float, default=0.0, help='part of every period an instance reports busy')
+    parser.add_argument('--period', type=float, default=10.0, help='seconds in a busy cycle')
+    parser.add_argument('--failures', type=float, default=0.0, help='part of queries that fail')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--dir', help='certificate directory (default: a temporary directory)')
+    args = parser.parse_args()
+
+    work = args.dir or mkdtemp(prefix='docket-steno-')
+    try:
+        certs = make_certs(work)
+        stenos = [FakeStenographer('sensor-{:03d}'.format(i + 1), certs['server_cert'], certs['server_key'],
+                                   certs['ca'], parse_capacity(args.size), spread=args.spread,
+                                   latency=args.latency, rate=parse_capacity(args.rate), busy=args.busy,
+                                   period=args.period, phase=args.period * i / args.instances,
+                                   failures=args.failures, seed=args.seed + i)
+                  for i in range(args.instances)]
+        instances = [{'sensor': steno.sensor, 'port': steno.start()} for steno in stenos]
+        print(dumps(dict(certs, instances=instances)))
+        sys.stdout.flush()
+
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        try:
+            while True:
+                sleep(3600)
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        print(dumps({steno.sensor: steno.counters() for steno in stenos}))
+        sys.stdout.flush()
+        for steno in stenos:
+            steno.stop()
+    finally:
+        if not args.dir:
+            rmtree(work)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,301 @@
+##
+## Copyright (c) 2017, 2018 RockNSM.
+##
+## This file is part of RockNSM
+## (see http://rocknsm.io).
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##   http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing,
+## software distributed under the License is distributed on an
+## "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+## KIND, either express or implied.  See the License for the
+## specific language governing permissions and limitations
+## under the License.
+##
+##
+""" Hot functions at spool scale, with saved baselines to catch regressions
+    usage (from the docket directory):
+        python -m bench.hot --jobs 1000,10000,100000 --save baseline.json
+        python -m bench.hot --jobs 1000,10000,100000 --compare baseline.json --threshold 0.25
+    --compare exits with status 1 if anything is slower than its baseline by more than the threshold.
+    --redis URL also runs the redis variants (save, load, status, find...): that database is FLUSHED.
+"""
+from __future__ import print_function
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from itertools import count
+from json import dumps, loads
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+import platform
+import random
+import sys
+import os
+
+import yaml
+
+from common.utils import ISOFORMAT
+
+FIELDS = {'host': ['192.168.254.201'], 'port': ['53'],
+          'after': '2018-01-01T00:00:00Z', 'before': '2018-01-01T01:00:00Z'}
+URI = 'host/192.168.254.201/port/53/udp/after/2018-01-01T00:00:00Z/before/2018-01-01T01:00:00Z/'
+# queries status_for_ids describes at once, like a page of the jobs list
+STATUS_IDS = 100
+# queries a cleanup finds due, less than EXPIRE_BATCH so it doesn't queue another
+DUE = 25
+EXPIRE_BATCH = 50
+# rebuilding the catalog of a large spool takes seconds: best of fewer rounds
+REBUILDS = 3
+
+
+def timed(func, rounds, setup=None):
+    """ best seconds per call of rounds. Quick functions are called repeatedly in each round (like timeit),
+        unless there's a setup to run before each call
+    """
+    number = 1
+    if setup is None:
+        start = time()
+        func()
+        number = max(int(0.05 / max(time() - start, 1e-7)), 1)
+    best = None
+    for _ in range(rounds):
+        if setup is not None:
+            setup()
+        start = time()
+        for _ in range(number):
+            func()
+        elapsed = (time() - start) / number
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def _use_redis(on):
+    from config import Config
+    Config.config['DOCKET_NO_REDIS'] = not on
+    Config._redis = None
+
+
+def _template():
+    """ records of a typical finished query: created, requests, results from 4 sensors, merged """
+    from resources.query import Query
+    q = Query(fields=FIELDS)
+    q.progress(Query.CREATED, state=Query.CREATED)
+    for i in range(4):
+        sensor = 'sensor-{}'.format(i)
+        q.progress(sensor, 'Awaiting sensor', Query.RECEIVING)
+        q.progress(sensor, 'requesting {}'.format(q.query), Query.RECEIVING)
+        q.result(sensor, '{} bytes received'.format(i * 1000000), Query.RECEIVED, i * 1000000)
+    q.progress('merge', 'Merging', Query.MERGE)
+    q.progress(Query.FINISHED, state=Query.SUCCESS)
+    return [Query.encode_event(e) for e in q.events]
+
+
+class Spool(object):
+    """ spool = Spool(jobs, redis)      SPOOL_DIR filled with 'jobs' finished queries, touched over the last hour
+            written directly (event log files, and redis when configured), then the catalog is rebuilt
+        spool.ids                       their ids, oldest first
+        spool.add(count, touched)       more queries, returns their ids
+    """
+    def __init__(self, jobs, redis):
+        from config import Config
+        from resources.query import Query
+        self.path = Config.get('SPOOL_DIR')
+        self.redis = Config.redis() if redis else None
+        rmtree(self.path)
+        os.mkdir(self.path)
+        if self.redis:
+            self.redis.flushdb()
+        self._records = _template()
+        self._made = 0
+        self._requested = datetime.utcnow() - timedelta(days=1)
+        now = time()
+        self.ids = self.add(jobs, lambda i: now - 3600 + 3600.0 * i / max(jobs, 1))
+        self.rebuilt = timed(Query.rebuild_catalog, REBUILDS)
+
+    def add(self, count, touched):
+        """ touched(i) - the epoch query i was last touched """
+        from common.eventlog import EventLog
+        from common import queryindex
+        from resources.query import Query, SCHEMA_VERSION
+        ids = []
+        pipe = self.redis.pipeline(transaction=False) if self.redis else None
+        for i in range(count):
+            self._made += 1
+            n = self._made
+            after = self._requested + timedelta(seconds=n)
+            query = 'host 10.{}.{}.{} and after {} and before {}'.format(
+                n >> 16 & 255, n >> 8 & 255, n & 255, after.strftime(ISOFORMAT),
+                (after + timedelta(hours=1)).strftime(ISOFORMAT))
+            q_id = Query(query=query).id
+            state = {'v': SCHEMA_VERSION, 'query': query, 'state': Query.SUCCESS}
+            shift = n * 1000000
+            records = [[rec[0] + shift] + rec[1:] for rec in self._records]
+            log = Query.log_for_id(q_id)
+            os.mkdir(Query.job_path_for_id(q_id))
+            EventLog(None, log.path).write(records, state)
+            os.utime(Query.job_path_for_id(q_id), (touched(i), touched(i)))
+            if pipe:
+                pipe.rpush(log.key + '.events', *[dumps(rec) for rec in records])
+                pipe.hmset(log.key + '.state', {k: dumps(v) for k, v in state.items()})
+                queryindex.add(q_id, query, records[0][0] / 1000000, pipe=pipe)
+                if n % 1000 == 0:
+                    pipe.execute()
+            ids.append(q_id)
+        if pipe:
+            pipe.execute()
+        return ids
+
+
+def functions(app, rounds, work):
+    """ {name: seconds} of the functions that don't depend on the spool """
+    from resources.query import Query, parse_uri, parse_json
+    from common.utils import recurse_update, update_yaml
+    results = {}
+    results['build_query'] = timed(lambda: Query(fields=FIELDS), rounds)
+    results['id'] = timed(lambda: Query(query='host 1.2.3.4 and after 2018-01-01T00:00:00Z').id, rounds)
+    results['parse_uri'] = timed(lambda: parse_uri(URI), rounds)
+
+    body = dumps(FIELDS)
+    def parse():
+        with app.test_request_context('/', method='POST', data=body, content_type='application/json'):
+            parse_json()
+    results['parse_json'] = timed(parse, rounds)
+
+    def merge():
+        a = {'map': {'set': 'set', 'unset': None}, 'extend': [(1, 1), (3, 3)], 'n': 1}
+        a.update(('k{}'.format(i), i) for i in range(50))
+        recurse_update(a, {'map': {'set': None, 'unset': 'unset', 'new': 'new'}, 'extend': [(2, 2)], 'n': 2},
+                       ignore_none=True)
+    results['recurse_update'] = timed(merge, rounds)
+
+    path = os.path.join(work, 'update.yaml')
+    with open(path, 'w') as f:
+        f.write(yaml.dump({'k{}'.format(i): i for i in range(100)}))
+    counter = count()
+    results['update_yaml'] = timed(lambda: update_yaml(path, {'k0': next(counter)}), rounds)
+    return results
+
+
+def spool_functions(spool, rounds, backend):
+    """ {name: seconds} of the functions that read or change the spool """
+    from resources.query import Query, CATALOG
+    import tasks
+    rnd = random.Random(0)
+    results = {'rebuild_catalog': spool.rebuilt}
+
+    template = Query(fields=FIELDS)
+    template.progress(Query.CREATED, state=Query.CREATED)
+    for i in range(8):
+        template.progress('sensor-{}'.format(i), 'requesting', Query.RECEIVING)
+    os.mkdir(template.job_path)
+    def fresh():
+        Query.log_for_id(template.id).delete()
+        template._saved, template._saved_state = 0, None
+    results['save'] = timed(template.save, rounds * 4, setup=fresh)
+    results['load'] = timed(lambda: Query().load(q_id=rnd.choice(spool.ids)), rounds)
+
+    page = rnd.sample(spool.ids, min(STATUS_IDS, len(spool.ids)))
+    results['status_for_ids'] = timed(lambda: Query.status_for_ids(page), rounds)
+    results['get_unexpired'] = timed(Query.get_unexpired, rounds)
+    if backend == 'redis':
+        results['find'] = timed(lambda: Query.find({'host': ['10.0.0.1']}, limit=50), rounds)
+
+    results['cleanup'] = timed(lambda: tasks.cleanup(force=True), rounds)
+    def due():
+        old = time() - 2 * 86400
+        for q_id in spool.add(DUE, lambda i: old):
+            CATALOG.update(q_id, created=old, touched=old, size=0)
+    results['cleanup_batch'] = timed(lambda: tasks.cleanup(force=True), rounds, setup=due)
+    return results
+
+
+def _human(seconds):
+    if seconds is None:
+        return '-'
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return '{:.2f}{}'.format(seconds / scale, unit)
+    return '{:.0f}ns'.format(seconds / 1e-9)
+
+
+def compare(results, baseline, threshold):
+    """ print each result next to its baseline, returns the names that regressed """
+    regressed = []
+    for name in sorted(results):
+        now, before = results[name], baseline.get(name)
+        change = ''
+        if before:
+            ratio = now / before
+            change = '{:+.0f}%'.format((ratio - 1) * 100)
+            if ratio > 1 + threshold:
+                regressed.append(name)
+                change += '  REGRESSION'
+        print("{:<36} {:>10} {:>10} {}".format(name, _human(before), _human(now), change))
+    return regressed
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--jobs', default='1000,10000,100000', help='spool sizes, comma separated')
+    parser.add_argument('--rounds', type=int, default=5, help='best of this many runs')
+    parser.add_argument('--redis', help='also run the redis variants with this (FLUSHED) database')
+    parser.add_argument('--save', help='write the results to this baseline file')
+    parser.add_argument('--compare', help='compare with this baseline file, exit 1 on a regression')
+    parser.add_argument('--threshold', type=float, default=0.25, help='slowdown that counts as a regression')
+    parser.add_argument('--dir', help='work directory (default: a temporary directory)')
+    args = parser.parse_args()
+
+    work = args.dir or mkdtemp(prefix='docket-hot-')
+    try:
+        conf = os.path.join(work, 'docket.yaml')
+        with open(conf, 'w') as f:
+            yaml.safe_dump({'STENOGRAPHER_INSTANCES': [{'host': '127.0.0.1', 'port': 1234, 'sensor': 'sensor-1',
+                                                        'cert': '', 'key': '', 'ca': ''}],
+                            'SPOOL_DIR': os.path.join(work, 'spool'), 'SECRET_KEY': 'docket-bench',
+                            'CELERY_URL': args.redis or 'redis://localhost:6379', 'REDIS_URL': args.redis,
+                            'DOCKET_NO_REDIS': not args.redis, 'LOG_LEVEL': 'error',
+                            'EXPIRE_TIME': '1d', 'EXPIRE_BATCH': EXPIRE_BATCH, 'TIME_WINDOW': 60},
+                           f, default_flow_style=False)
+        os.mkdir(os.path.join(work, 'spool'))
+        os.environ['DOCKET_CONF'] = conf
+        import docket
+
+        results = functions(docket.app, args.rounds, work)
+        for backend in ['file'] + (['redis'] if args.redis else []):
+            _use_redis(backend == 'redis')
+            for jobs in [int(j) for j in args.jobs.split(',')]:
+                start = time()
+                spool = Spool(jobs, backend == 'redis')
+                print("{} spool of {} jobs built in {:.1f}s".format(backend, jobs, time() - start),
+                      file=sys.stderr)
+                for name, seconds in spool_functions(spool, args.rounds, backend).items():
+                    results['{}[{}]@{}'.format(name, backend, jobs)] = seconds
+    finally:
+        if not args.dir:
+            rmtree(work)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = loads(f.read())['results']
+    print("{:<36} {:>10} {:>10}".format('', 'baseline', 'now'))
+    regressed = compare(results, baseline, args.threshold)
+    if args.save:
+        with open(args.save, 'w') as f:
+            f.write(dumps({'python': platform.python_version(), 'host': platform.node(),
+                           'time': datetime.utcnow().strftime(ISOFORMAT), 'rounds': args.rounds,
+                           'results': results}, indent=2, sort_keys=True))
+    if regressed:
+        print("{} slower than the baseline by more than {:.0%}: {}".format(
+            len(regressed), args.threshold, ', '.join(regressed)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
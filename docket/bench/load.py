@@ -0,0 +1,395 @@
+##
+## Copyright (c) 2017, 2018 RockNSM.
+##
+## This file is part of RockNSM
+## (see http://rocknsm.io).
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##   http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing,
+## software distributed under the License is distributed on an
+## "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+## KIND, either express or implied.  See the License for the
+## specific language governing permissions and limitations
+## under the License.
+##
+##
+""" End to end load: queries through the API and celery workers, against fake stenographer instances
+    usage (from the docket directory, with a redis server for the workers):
+        python -m bench.load --sensors 4 --size 8MB --queries 200 --clients 8 --redis redis://localhost:6379/15
+        python -m bench.load --inline ...       no redis or workers: tasks run in the submitting thread
+    Reports queries/minute, time to pcap (submission to Completed), worker RSS and spool I/O.
+    The redis database is FLUSHED first: use one that only the benchmark uses.
+    Any docket setting can be changed with --set KEY=VALUE (e.g. --set CHUNK_SECONDS=600)
+"""
+from __future__ import print_function
+from argparse import ArgumentParser
+from collections import namedtuple, Counter
+from datetime import datetime, timedelta
+from json import dumps, loads
+from shutil import rmtree
+from subprocess import Popen, PIPE, STDOUT
+from tempfile import mkdtemp
+from threading import Thread, Event, Lock
+from time import time, sleep
+import random
+import signal
+import sys
+import os
+# python 2: the first strptime in a thread can race the import of this
+import _strptime
+
+import yaml
+
+from common.utils import parse_duration, ISOFORMAT
+
+DOCKET_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# requests prefers these to a session's own CA (stenographer's), they'd break every mTLS connection
+_CA_OVERRIDES = ('REQUESTS_CA_BUNDLE', 'CURL_CA_BUNDLE')
+
+Result = namedtuple('Result', ['kind', 'state', 'seconds'])
+
+
+def _percentile(values, percent):
+    """ nearest rank """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(int(round(percent / 100.0 * len(values))) - 1, 0)]
+
+
+def _descendants(pid, exclude=()):
+    """ pid and every process below it (celery's pool processes), except those in exclude and below them """
+    children = {}
+    for name in os.listdir('/proc'):
+        if name.isdigit():
+            try:
+                with open('/proc/{}/stat'.format(name)) as f:
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (IOError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(name))
+    found, pending = [], [pid]
+    while pending:
+        pid = pending.pop()
+        if pid in exclude:
+            continue
+        found.append(pid)
+        pending.extend(children.get(pid, []))
+    return found
+
+
+def _proc_values(pid, name, keys):
+    """ {key: int} of /proc/<pid>/<name> lines 'key: value ...', missing if the process is gone """
+    values = {}
+    try:
+        with open('/proc/{}/{}'.format(pid, name)) as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in keys:
+                    values[key] = int(value.split()[0])
+    except (IOError, ValueError):
+        pass
+    return values
+
+
+class ProcessSampler(Thread):
+    """ sampler = ProcessSampler({group: pid}, period, exclude=())
+        polls the processes of each group (and their children, but not the excluded pids) until stopped:
+        sampler.peak_rss                {group: bytes}, the most the group's processes used at once
+        sampler.io                      {group: {read_bytes, write_bytes}} storage I/O since the start
+    """
+    def __init__(self, groups, period=0.5, exclude=()):
+        Thread.__init__(self, name='sampler')
+        self.daemon = True
+        self.groups = groups
+        self.period = period
+        self.exclude = exclude
+        self.peak_rss = Counter()
+        self.io = {group: Counter() for group in groups}
+        self._started = {}          # pid: io when first seen
+        self._last = {}             # pid: io when last seen, exited processes keep their share
+        self._stop = Event()
+
+    def run(self):
+        while True:
+            self.sample()
+            if self._stop.wait(self.period):
+                break
+        self.sample()
+
+    def stop(self):
+        self._stop.set()
+        self.join()
+
+    def sample(self):
+        for group, root in self.groups.items():
+            rss = 0
+            for pid in _descendants(root, self.exclude):
+                rss += _proc_values(pid, 'status', ('VmRSS',)).get('VmRSS', 0) * 1024
+                io = _proc_values(pid, 'io', ('read_bytes', 'write_bytes'))
+                if io:
+                    self._started.setdefault((group, pid), io)
+                    self._last[(group, pid)] = io
+            self.peak_rss[group] = max(self.peak_rss[group], rss)
+            total = Counter()
+            for (seen, pid), io in self._last.items():
+                if seen == group:
+                    total.update({k: v - self._started[(seen, pid)][k] for k, v in io.items()})
+            self.io[group] = total
+
+
+def start_stenographers(work, args):
+    """ the fake stenographer process, and what it printed: {ca, cert, key, instances: [{sensor, port}]} """
+    process = Popen([sys.executable, '-m', 'bench.fakesteno', '--instances', str(args.sensors),
+                     '--size', args.size, '--spread', str(args.spread), '--latency', str(args.latency),
+                     '--rate', args.rate, '--busy', str(args.busy), '--period', str(args.busy_period),
+                     '--failures', str(args.failures), '--seed', str(args.seed), '--dir', work],
+                    stdout=PIPE, cwd=DOCKET_DIR)
+    return process, loads(process.stdout.readline())
+
+
+def write_config(path, work, stenos, args):
+    conf = {
+        'STENOGRAPHER_INSTANCES': [{'host': '127.0.0.1', 'port': i['port'], 'sensor': i['sensor'],
+                                    'cert': stenos['cert'], 'key': stenos['key'], 'ca': stenos['ca']}
+                                   for i in stenos['instances']],
+        'SECRET_KEY': 'docket-bench',
+        'SPOOL_DIR': os.path.join(work, 'spool'),
+        'CELERY_URL': args.redis,
+        'DOCKET_NO_REDIS': args.inline,
+        'LOG_LEVEL': 'warning',
+        'LOG_FILE': os.path.join(work, 'docket.log'),
+        'TIME_WINDOW': 60,
+        'LONG_AGO': '24h',
+        'QUERY_TIMEOUT': args.timeout,
+    }
+    if not args.inline:
+        conf['REDIS_URL'] = args.redis
+    for setting in args.set:
+        key, _, value = setting.partition('=')
+        conf[key] = yaml.safe_load(value)
+    os.mkdir(conf['SPOOL_DIR'])
+    with open(path, 'w') as f:
+        yaml.safe_dump(conf, f, default_flow_style=False)
+
+
+def start_workers(conf, work, args):
+    """ the 'query', 'bulk' and 'io' celery workers, as systemd runs them """
+    env = dict(os.environ, DOCKET_CONF=conf)
+    command = [sys.executable, '-m', 'celery', 'worker', '--app', 'docket.celery', '-l', 'warning']
+    workers = {}
+    for name, options in (('query', ['-c', str(args.query_workers), '-O', 'fair', '-Q', 'query']),
+                          ('bulk', ['-c', str(args.bulk_workers), '-O', 'fair', '-Q', 'bulk']),
+                          ('io', ['-c', '1', '-Q', 'io,celery'])):
+        with open(os.path.join(work, name + '-worker.log'), 'wb') as log:
+            workers[name] = Popen(command + options + ['-n', 'bench-{}@%h'.format(name)],
+                                  env=env, cwd=DOCKET_DIR, stdout=log, stderr=STDOUT)
+    return workers
+
+
+def wait_for_workers(celery, count, timeout=60):
+    deadline = time() + timeout
+    while time() < deadline:
+        if len(celery.control.ping(timeout=1.0) or []) >= count:
+            return True
+    return False
+
+
+class QueryPlan(object):
+    """ plan = QueryPlan(count, window, repeat, narrow, seed)
+        plan.next()         (kind, fields) to submit, None once 'count' were handed out
+            unique - a new host, repeat - a query submitted before (a duplicate),
+            narrow - a query submitted before with a port added (answerable from its results)
+    """
+    def __init__(self, count, window, repeat=0.0, narrow=0.0, seed=0):
+        self.count = count
+        self.window = window
+        self.repeat = repeat
+        self.narrow = narrow
+        self._random = random.Random(seed)
+        self._submitted = []
+        self._lock = Lock()
+        self._now = datetime.utcnow().replace(second=0, microsecond=0)
+
+    def next(self):
+        with self._lock:
+            if self.count <= 0:
+                return None
+            self.count -= 1
+            draw = self._random.random()
+            if self._submitted and draw < self.repeat:
+                return 'repeat', dict(self._random.choice(self._submitted))
+            if self._submitted and draw < self.repeat + self.narrow:
+                return 'narrow', dict(self._random.choice(self._submitted), port=[self._random.randint(1, 65535)])
+            n = len(self._submitted) + 1
+            after = self._now - timedelta(seconds=self._random.randint(2, 20) * 3600)
+            fields = {'host': ['10.{}.{}.{}'.format(n >> 16 & 255, n >> 8 & 255, n & 255)],
+                      'after': after.strftime(ISOFORMAT),
+                      'before': (after + timedelta(seconds=self.window)).strftime(ISOFORMAT)}
+            self._submitted.append(fields)
+            return 'unique', fields
+
+
+def run_client(app, plan, results, poll, timeout):
+    """ submit the plan's queries one at a time, each once the last reached a final state """
+    from resources.query import Query
+    client = app.test_client()
+    api = app.config.get('WEB_ROOT', '/api')
+    while True:
+        item = plan.next()
+        if item is None:
+            return
+        kind, fields = item
+        submitted = time()
+        rv = client.post(api + '/', data=dumps(fields), content_type='application/json')
+        if rv.status_code != 200:
+            results.append(Result(kind, 'HTTP {}'.format(rv.status_code), time() - submitted))
+            continue
+        q_id = loads(rv.data)['id']
+        state = None
+        while time() - submitted < timeout:
+            status = loads(client.get('{}/status/{}/?fields=state'.format(api, q_id)).data)
+            state = status.get(q_id, {}).get('state')
+            if state in Query.FINAL_STATES:
+                break
+            sleep(poll)
+        results.append(Result(kind, state or 'Unknown', time() - submitted))
+
+
+def _spool_size(path):
+    total = 0
+    for directory, _, names in os.walk(path):
+        for name in names:
+            try:
+                total += os.path.getsize(os.path.join(directory, name))
+            except OSError:
+                pass
+    return total
+
+
+def report(results, elapsed, sampler, spool, served):
+    """ a summary dict, see main() for how it's printed """
+    from resources.query import Query
+    completed = [r.seconds for r in results if r.state == Query.SUCCESS]
+    summary = {
+        'queries': len(results),
+        'seconds': elapsed,
+        'queries_per_minute': len(results) * 60.0 / elapsed if elapsed else 0,
+        'states': dict(Counter(r.state for r in results)),
+        'kinds': dict(Counter(r.kind for r in results)),
+        'time_to_pcap': {'p50': _percentile(completed, 50), 'p99': _percentile(completed, 99),
+                         'max': max(completed) if completed else None},
+        'peak_rss': dict(sampler.peak_rss),
+        'io': {group: dict(io) for group, io in sampler.io.items()},
+        'spool_bytes': spool,
+        'stenographers': served,
+    }
+    return summary
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    steno = parser.add_argument_group('fake stenographers')
+    steno.add_argument('--sensors', type=int, default=4, help='number of instances')
+    steno.add_argument('--size', default='8MB', help='capture size each instance returns per query')
+    steno.add_argument('--spread', type=float, default=0.5, help='sizes vary by this part of --size, either way')
+    steno.add_argument('--latency', type=float, default=0.2, help='seconds before a response starts')
+    steno.add_argument('--rate', default='0', help='transfer rate per query, bytes/second (0: unlimited)')
+    steno.add_argument('--busy', type=float, default=0.0, help='part of every busy period instances report busy')
+    steno.add_argument('--busy-period', type=float, default=10.0, help='seconds in a busy cycle')
+    steno.add_argument('--failures', type=float, default=0.0, help='part of queries that fail')
+    load = parser.add_argument_group('load')
+    load.add_argument('--queries', type=int, default=100, help='queries to submit')
+    load.add_argument('--clients', type=int, default=4, help='clients submitting at once, one query at a time each')
+    load.add_argument('--window', default='10m', help='time window of each query')
+    load.add_argument('--repeat', type=float, default=0.0, help='part of queries that repeat an earlier one')
+    load.add_argument('--narrow', type=float, default=0.0, help='part of queries that add a port to an earlier one')
+    load.add_argument('--poll', type=float, default=0.2, help='seconds between status checks')
+    load.add_argument('--timeout', type=float, default=600.0, help='seconds a query may take (QUERY_TIMEOUT)')
+    load.add_argument('--seed', type=int, default=0, help='random seed')
+    docket = parser.add_argument_group('docket')
+    docket.add_argument('--redis', default='redis://localhost:6379/15', help='broker and redis (FLUSHED first)')
+    docket.add_argument('--query-workers', type=int, default=4, help="'query' worker concurrency")
+    docket.add_argument('--bulk-workers', type=int, default=2,
+                        help="'bulk' worker concurrency (queries over LANE_FAST_BYTES, see --set)")
+    docket.add_argument('--inline', action='store_true', help='run tasks in the submitting thread, without redis')
+    docket.add_argument('--set', action='append', default=[], metavar='KEY=VALUE', help='a docket setting')
+    parser.add_argument('--dir', help='work directory (default: a temporary directory)')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    for name in _CA_OVERRIDES:
+        os.environ.pop(name, None)
+    work = args.dir or mkdtemp(prefix='docket-load-')
+    stenographers, workers, sampler = None, {}, None
+    try:
+        stenographers, stenos = start_stenographers(work, args)
+        conf = os.path.join(work, 'docket.yaml')
+        write_config(conf, work, stenos, args)
+        os.environ['DOCKET_CONF'] = conf
+        import docket
+        from config import Config
+        if args.inline:
+            docket.celery.conf.task_always_eager = True
+        else:
+            Config.redis().flushdb()
+            workers = start_workers(conf, work, args)
+            if not wait_for_workers(docket.celery, len(workers)):
+                raise SystemExit("workers didn't start, see {}".format(work))
+
+        sampler = ProcessSampler(dict([(name, w.pid) for name, w in workers.items()] +
+                                      [('docket' if args.inline else 'api', os.getpid())]),
+                                 exclude=(stenographers.pid,))
+        sampler.start()
+        plan = QueryPlan(args.queries, parse_duration(args.window).total_seconds(),
+                         repeat=args.repeat, narrow=args.narrow, seed=args.seed)
+        results = []
+        started = time()
+        clients = [Thread(target=run_client, args=(docket.app, plan, results, args.poll, args.timeout))
+                   for _ in range(args.clients)]
+        for client in clients:
+            client.daemon = True
+            client.start()
+        for client in clients:
+            client.join()
+        elapsed = time() - started
+        sampler.stop()
+
+        stenographers.send_signal(signal.SIGTERM)
+        served = loads(stenographers.stdout.readline() or '{}')
+        summary = report(results, elapsed, sampler, _spool_size(Config.get('SPOOL_DIR')), served)
+    finally:
+        for process in list(workers.values()) + [stenographers]:
+            if process and process.poll() is None:
+                process.terminate()
+                process.wait()
+        if not args.dir:
+            rmtree(work)
+
+    mb = 1024.0 ** 2
+    print("queries      {queries} in {seconds:.1f}s: {queries_per_minute:.1f}/minute".format(**summary))
+    print("states       {}".format(', '.join('{} {}'.format(n, s) for s, n in sorted(summary['states'].items()))))
+    print("kinds        {}".format(', '.join('{} {}'.format(n, k) for k, n in sorted(summary['kinds'].items()))))
+    ttp = summary['time_to_pcap']
+    if ttp['p50'] is not None:
+        print("time to pcap p50 {p50:.2f}s  p99 {p99:.2f}s  max {max:.2f}s".format(**ttp))
+    for group in sorted(summary['peak_rss']):
+        io = summary['io'].get(group, {})
+        print("{:<12} peak RSS {:8.1f} MB  read {:8.1f} MB  written {:8.1f} MB".format(
+            group, summary['peak_rss'][group] / mb, io.get('read_bytes', 0) / mb, io.get('write_bytes', 0) / mb))
+    print("spool        {:.1f} MB".format(summary['spool_bytes'] / mb))
+    for sensor, counts in sorted(summary['stenographers'].items()):
+        print("{:<12} {queries} queries, {failed} failed, {mb:.1f} MB sent, {stats} stats".format(
+            sensor, mb=counts['bytes'] / mb, **counts))
+    if args.json:
+        with open(args.json, 'w') as f:
+            f.write(dumps(summary, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+##
+## Copyright (c) 2017, 2018 RockNSM.
+##
+## This file is part of RockNSM
+## (see http://rocknsm.io).
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##   http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing,
+## software distributed under the License is distributed on an
+## "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+## KIND, either express or implied.  See the License for the
+## specific language governing permissions and limitations
+## under the License.
+##
+##
+""" Merge throughput: common.pcap.merge_pcaps vs wireshark's mergecap
+    usage (from the docket directory):
+        python -m bench.merge --sensors 4 --size 64MB
+"""
+from __future__ import print_function
+from argparse import ArgumentParser
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+import random
+import struct
+import os
+
+from common.pcap import merge_pcaps, global_header, RECORD_HEADER
+from common.utils import parse_capacity
+
+MERGECAP = '/usr/sbin/mergecap'
+
+
+def synthesize(path, size, start, seed):
+    """ write a pcap of roughly 'size' bytes with packets of typical sizes, 1-999us apart """
+    rnd = random.Random(seed)
+    payload = os.urandom(1514)
+    written = 0
+    ts = start * 1000000
+    with open(path, 'wb') as f:
+        f.write(global_header())
+        while written < size:
+            length = rnd.choice((60, 66, 590, 1514))
+            ts += rnd.randint(1, 999)
+            f.write(RECORD_HEADER.pack(ts // 1000000, ts % 1000000, length, length))
+            f.write(payload[:length])
+            written += RECORD_HEADER.size + length
+    return written
+
+
+def timed(func, *args):
+    start = time()
+    func(*args)
+    return time() - start
+
+
+def mergecap(paths, out):
+    from subprocess import check_call
+    check_call([MERGECAP, '-F', 'pcap', '-w', out] + paths)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sensors', type=int, default=4, help='number of input captures')
+    parser.add_argument('--size', default='64MB', help='size of each input capture')
+    parser.add_argument('--rounds', type=int, default=3, help='best of this many runs')
+    parser.add_argument('--dir', help='work directory (default: a temporary directory)')
+    args = parser.parse_args()
+
+    work = args.dir or mkdtemp(prefix='docket-bench-')
+    try:
+        paths = [os.path.join(work, 'sensor-{}.pcap'.format(i)) for i in range(args.sensors)]
+        total = sum(synthesize(p, parse_capacity(args.size), 1500000000, i) for i, p in enumerate(paths))
+        out = os.path.join(work, 'merged.pcap')
+        print("inputs: {} x {} ({:.1f} MB total)".format(args.sensors, args.size, total / 1024.0**2))
+
+        contenders = [('merge_pcaps', merge_pcaps)]
+        if os.path.exists(MERGECAP):
+            contenders.append(('mergecap', mergecap))
+        else:
+            print("{} not found, skipping the comparison".format(MERGECAP))
+
+        for name, func in contenders:
+            best = min(timed(func, paths, out) for _ in range(args.rounds))
+            print("{:<12} {:8.3f}s {:8.1f} MB/s".format(name, best, total / 1024.0**2 / best))
+    finally:
+        if not args.dir:
+            rmtree(work)
+
+
+if __name__ == '__main__':
+    main()
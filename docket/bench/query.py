@@ -0,0 +1,101 @@
+##
+## Copyright (c) 2017, 2018 RockNSM.
+##
+## This file is part of RockNSM
+## (see http://rocknsm.io).
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##   http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing,
+## software distributed under the License is distributed on an
+## "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+## KIND, either express or implied.  See the License for the
+## specific language governing permissions and limitations
+## under the License.
+##
+##
+""" Query metadata save/load: yaml.dump of the object vs the JSON event log schema
+    usage (from the docket directory):
+        python -m bench.query --events 500 --conf test/test.yaml
+"""
+from __future__ import print_function
+from argparse import ArgumentParser
+from json import dumps, loads
+from time import time
+
+import yaml
+
+from config import Config
+
+
+def build(events):
+    """ a query with 'events' progress events and results, like a busy multi-sensor query """
+    from resources.query import Query
+    q = Query(query='host 192.168.254.201 and port 53 and after 2018-01-01T00:00:00Z and before 2018-01-02T00:00:00Z')
+    q.progress(Query.CREATED, state=Query.CREATED)
+    for i in range(events - 1):
+        sensor = 'sensor-{}'.format(i % 16)
+        if i % 3:
+            q.progress(sensor, 'requesting', Query.RECEIVING)
+        else:
+            q.result(sensor, '{} bytes received'.format(i * 1000), Query.RECEIVED, i * 1000)
+    return q
+
+
+def legacy(q):
+    """ the old save/load: yaml.dump(self), yaml.load() """
+    data = yaml.dump(q)
+    yaml.load(data)
+    return len(data)
+
+
+def schema(q):
+    """ the full event log: state + one record per event, decoded """
+    from resources.query import Query
+    data = '\n'.join([dumps(['s', q._state_record()])] +
+                     [dumps(['e', Query.encode_event(e)]) for e in q.events])
+    for line in data.splitlines():
+        kind, value = loads(line)
+        if kind == 'e':
+            Query.decode_event(value)
+    return len(data)
+
+
+def incremental(q):
+    """ a save once the log exists: just the newest event """
+    from resources.query import Query
+    return len(dumps(['e', Query.encode_event(q.events[-1])]))
+
+
+def timed(func, q, rounds):
+    best, size = None, 0
+    for _ in range(rounds):
+        start = time()
+        size = func(q)
+        elapsed = time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, size
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--events', type=int, default=500, help='events in the query')
+    parser.add_argument('--rounds', type=int, default=5, help='best of this many runs')
+    parser.add_argument('--conf', default='test/test.yaml', help='docket configuration')
+    args = parser.parse_args()
+
+    Config.load(args.conf)
+    q = build(args.events)
+    print("query with {} events".format(len(q.events)))
+    results = [(name, timed(func, q, args.rounds))
+               for name, func in (('yaml', legacy), ('schema', schema), ('append', incremental))]
+    for name, (best, size) in results:
+        print("{:<8} {:9.3f}ms {:9} bytes {:8.1f}x".format(name, best * 1000, size, results[0][1][0] / best))
+
+
+if __name__ == '__main__':
+    main()
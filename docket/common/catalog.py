@@ -0,0 +1,266 @@
+##
+## Copyright (c) 2017, 2018 RockNSM.
+##
+## This file is part of RockNSM
+## (see http://rocknsm.io).
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##   http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing,
+## software distributed under the License is distributed on an
+## "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+## KIND, either express or implied.  See the License for the
+## specific language governing permissions and limitations
+## under the License.
+##
+##
+# SpoolCatalog - what's in SPOOL_DIR without listing and stat()ing it: id, created, touched, size and state per query.
+#   The processes that change the spool keep it up to date. It's rebuilt from disk when missing or on request.
+#   In redis: a sorted set of ids scored by last touch (Docket.Catalog) and a hash per id (Docket.Catalog.<id>)
+#     and a sorted set of ids scored by request time (Docket.Catalog.created) to page through
+#   Without redis: an append-only log of changes (see EventLog) each process replays from where it left off,
+#     and <path>.built once it was rebuilt (updates create the log too: a spool from before it isn't in it).
+#     Appends share an flock() on <path>.lock, rewrites (rebuild, compact) hold it alone: none is lost to a rename.
+#     compact() rewrites the log as one line per entry once it's mostly history.
+from contextlib import contextmanager
+from fcntl import flock, LOCK_EX, LOCK_SH, LOCK_UN
+from json import dumps, loads
+from threading import Lock
+import errno
+import os
+
+from config import Config
+from common.eventlog import EventLog
+
+_REDIS_KEY = 'Docket.Catalog'
+_BUILT = _REDIS_KEY + '.built'
+_CREATED = _REDIS_KEY + '.created'
+# catalogs built before _CREATED existed are rebuilt
+_VERSION = '2'
+FIELDS = ('created', 'touched', 'size', 'state')
+# ids read from redis at a time while paging
+_PAGE_BATCH = 100
+# without redis the log is compacted when it has more lines than this many per entry, plus _COMPACT_SLACK
+_COMPACT_RATIO = 4
+_COMPACT_SLACK = 1000
+
+
+class SpoolCatalog(object):
+    """ catalog = SpoolCatalog(path)            path - the catalog file, used without redis
+        catalog.update(q_id, **fields)          set some of FIELDS (epochs, bytes, state string)
+        catalog.remove(q_ids)
+        catalog.entries(ids=None)               { id: {created, touched, size, state} }
+        catalog.ids(ids=None)                   ids (least recently touched first), optionally limited to ids
+        catalog.oldest(count)                   [(id, entry)] of the 'count' least recently touched
+        catalog.page(limit, cursor, states, newest)
+                                                ([(id, entry)], next cursor or None) ordered by request time
+        catalog.rebuild(spool_dir, describe)    describe(q_id) returns the fields of a job directory (or None)
+        catalog.compact()                       without redis: rewrite the log if it's mostly history
+    """
+    def __init__(self, path):
+        self.path = path
+        self._log = EventLog(None, path)
+        self._lock = Lock()
+        self._entries = {}
+        self._cursor = 0
+        self._inode = None
+        self._lines = 0             # records replayed from the current log
+
+    def update(self, q_id, **fields):
+        r = Config.redis()
+        if r:
+            pipe = r.pipeline()
+            pipe.hmset(_REDIS_KEY + '.' + q_id, {k: dumps(v) for k, v in fields.items()})
+            if fields.get('touched') is not None:
+                pipe.zadd(_REDIS_KEY, **{q_id: fields['touched']})
+            if fields.get('created') is not None:
+                pipe.zadd(_CREATED, **{q_id: fields['created']})
+            pipe.execute()
+        else:
+            with self._locked(LOCK_SH):
+                self._log.append([['u', q_id, fields]], to_file=True)
+
+    def remove(self, q_ids):
+        if not q_ids:
+            return
+        r = Config.redis()
+        if r:
+            pipe = r.pipeline()
+            pipe.zrem(_REDIS_KEY, *q_ids)
+            pipe.zrem(_CREATED, *q_ids)
+            pipe.delete(*[_REDIS_KEY + '.' + i for i in q_ids])
+            pipe.execute()
+        else:
+            with self._locked(LOCK_SH):
+                self._log.append([['d', list(q_ids)]], to_file=True)
+
+    @contextmanager
+    def _locked(self, mode):
+        """ appenders share the lock, a rewrite holds it alone """
+        with open(self.path + '.lock', 'a') as lock:
+            flock(lock, mode)
+            try:
+                yield
+            finally:
+                flock(lock, LOCK_UN)
+
+    def _replay(self):
+        """ apply the catalog file's changes since we last looked. Requires self._lock """
+        try:
+            inode = os.stat(self.path).st_ino
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            inode = None
+        if inode != self._inode:
+            # rebuilt (or never read): start over
+            self._inode, self._entries, self._cursor, self._lines = inode, {}, 0, 0
+        _, records, self._cursor = self._log.read(self._cursor, from_file=True)
+        self._lines += len(records)
+        for record in records:
+            if record[0] == 'u':
+                self._entries.setdefault(record[1], {}).update(record[2])
+            else:
+                for q_id in record[1]:
+                    self._entries.pop(q_id, None)
+
+    def entries(self, ids=None):
+        r = Config.redis()
+        if r:
+            if ids is None:
+                ids = r.zrange(_REDIS_KEY, 0, -1)
+            pipe = r.pipeline()
+            for q_id in ids:
+                pipe.zscore(_REDIS_KEY, q_id)
+                pipe.hgetall(_REDIS_KEY + '.' + q_id)
+            replies = pipe.execute()
+            return {q_id: {k: loads(v) for k, v in entry.items()}
+                    for q_id, touched, entry in zip(ids, replies[::2], replies[1::2])
+                    if touched is not None}
+
+        with self._lock:
+            self._replay()
+            if ids is None:
+                return {i: dict(e) for i, e in self._entries.items() if e.get('touched') is not None}
+            return {i: dict(self._entries[i]) for i in ids
+                    if self._entries.get(i, {}).get('touched') is not None}
+
+    def ids(self, ids=None):
+        r = Config.redis()
+        if r and ids is None:
+            return r.zrange(_REDIS_KEY, 0, -1)
+        entries = self.entries(ids)
+        return sorted(entries, key=lambda i: entries[i]['touched'])
+
+    def oldest(self, count):
+        """ [(id, entry)] for the 'count' least recently touched queries """
+        r = Config.redis()
+        if r:
+            ids = r.zrange(_REDIS_KEY, 0, count - 1)
+            entries = self.entries(ids)
+            return [(i, entries[i]) for i in ids if i in entries]
+        entries = self.entries()
+        return sorted(entries.items(), key=lambda item: item[1]['touched'])[:count]
+
+    def page(self, limit, cursor=None, states=None, newest=True):
+        """ up to limit entries in states (all if None), by request time then id, after the one cursor names
+            cursor - None for the first page, then what the previous page returned
+        """
+        after = None
+        if cursor:
+            created, q_id = cursor.split(':', 1)
+            after = (float(created), q_id)
+        def beyond(key):
+            return after is None or (key < after if newest else key > after)
+        def created(entry):
+            return float(entry.get('created') or entry.get('touched') or 0)
+
+        page = []
+        r = Config.redis()
+        if r:
+            # walk the request time index from the cursor on, a batch at a time, until the page is full
+            bound, start = (after[0] if after else ('+inf' if newest else '-inf')), 0
+            while len(page) <= limit:
+                if newest:
+                    batch = r.zrevrangebyscore(_CREATED, bound, '-inf', start=start, num=_PAGE_BATCH, withscores=True)
+                else:
+                    batch = r.zrangebyscore(_CREATED, bound, '+inf', start=start, num=_PAGE_BATCH, withscores=True)
+                if not batch:
+                    break
+                start += len(batch)
+                ids = [q_id for q_id, score in batch if beyond((score, q_id))]
+                entries = self.entries(ids)
+                page.extend((i, entries[i]) for i in ids
+                            if i in entries and (states is None or entries[i].get('state') in states))
+        else:
+            page = sorted(((i, e) for i, e in self.entries().items()
+                           if beyond((created(e), i)) and (states is None or e.get('state') in states)),
+                          key=lambda item: (created(item[1]), item[0]), reverse=newest)
+        if len(page) <= limit:
+            return page, None
+        page = page[:limit]
+        return page, '{}:{}'.format(repr(created(page[-1][1])), page[-1][0])
+
+    def built(self):
+        r = Config.redis()
+        if r:
+            return r.get(_BUILT) == _VERSION
+        try:
+            with open(self.path + '.built', 'rb') as f:
+                return f.read() == _VERSION and os.path.exists(self.path)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+
+    def rebuild(self, spool_dir, describe):
+        """ replace the catalog with what's in spool_dir: one listdir, describe() for every job directory """
+        entries = {}
+        for q_id in os.listdir(spool_dir):
+            if len(q_id) < 32 or not os.path.isdir(os.path.join(spool_dir, q_id)):
+                continue
+            fields = describe(q_id)
+            if fields:
+                entries[q_id] = fields
+
+        r = Config.redis()
+        if r:
+            stale = set(r.zrange(_REDIS_KEY, 0, -1)) - set(entries)
+            pipe = r.pipeline()
+            if stale:
+                pipe.zrem(_REDIS_KEY, *stale)
+                pipe.delete(*[_REDIS_KEY + '.' + i for i in stale])
+            pipe.delete(_CREATED)
+            for q_id, fields in entries.items():
+                pipe.hmset(_REDIS_KEY + '.' + q_id, {k: dumps(v) for k, v in fields.items()})
+                pipe.zadd(_REDIS_KEY, **{q_id: fields['touched']})
+                pipe.zadd(_CREATED, **{q_id: fields.get('created', fields['touched'])})
+            pipe.set(_BUILT, _VERSION)
+            pipe.execute()
+        else:
+            with self._locked(LOCK_EX):
+                self._log.write([['u', q_id, fields] for q_id, fields in entries.items()], {})
+            with open(self.path + '.built', 'wb') as f:
+                f.write(_VERSION)
+        Config.logger.info("Catalog: rebuilt, {} queries".format(len(entries)))
+        return entries
+
+    def compact(self):
+        """ without redis: replace the log with one update per entry when it has many more lines than entries
+            returns True if it was rewritten
+        """
+        if Config.redis() or not os.path.exists(self.path):
+            return False
+        with self._locked(LOCK_EX):
+            with self._lock:
+                self._replay()
+                lines, entries = self._lines, [['u', i, dict(e)] for i, e in self._entries.items()]
+            if lines <= _COMPACT_RATIO * len(entries) + _COMPACT_SLACK:
+                return False
+            self._log.write(entries, {})
+        Config.logger.info("Catalog: compacted, {} lines to {}".format(lines, len(entries)))
+        return True
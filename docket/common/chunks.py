@@ -0,0 +1,158 @@
+##
+## Copyright (c) 2017, 2018 RockNSM.
+##
+## This file is part of RockNSM
+## (see http://rocknsm.io).
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##   http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing,
+## software distributed under the License is distributed on an
+## "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+## KIND, either express or implied.  See the License for the
+## specific language governing permissions and limitations
+## under the License.
+##
+##
+# ChunkCache - each sensor's results for a query's clauses over aligned slices of time (chunks),
+#   so overlapping and sliding-window queries only ask the sensors about time they haven't asked about yet.
+#   <path>/<key>/<sensor>.<start>.pcap     key - a hash of the query without its time clauses, and the chunk size
+#   <path>/<key>/<sensor>.<start>.empty    the chunk had no packets
+#   A chunk is cached once it's old enough that the sensors had all of its packets when we asked.
+from collections import namedtuple
+from datetime import datetime
+from hashlib import md5
+from time import time
+import errno
+import os
+
+from common.pcapfilter import PacketFilter
+from common.utils import ISOFORMAT
+
+Chunk = namedtuple('Chunk', ['start', 'query', 'path', 'cached', 'cacheable'])
+
+# seconds after a chunk ends before it can be cached: sensors write (and index) packets a little late
+SETTLE = 300
+
+
+class ChunkCache(object):
+    """ cache = ChunkCache(path, seconds)
+        cache.plan(query, sensor)       [Chunk] covering query's time window, None if it can't be chunked
+            chunk.query - stenographer query for the chunk, chunk.path - the cached capture
+            chunk.cached - already in the cache, chunk.cacheable - old enough to be cached
+        cache.store(chunk, path)        move a chunk's capture (path, or nothing if it had no packets) into the cache
+        cache.files(chunks)             the cached captures of chunks that had packets (every chunk is marked used)
+        cache.clip(chunk, before)       (start, end) epoch seconds of the chunk's packets to stitch, end excluded
+        cache.expire(before, space=0)   remove chunks unused since before (an epoch, or None), then
+                                        the least recently used until space bytes are freed
+    """
+    def __init__(self, path, seconds):
+        self.path = path
+        self.seconds = int(seconds)
+
+    def plan(self, query, sensor):
+        try:
+            window = PacketFilter.parse(query)
+        except ValueError:
+            return None
+        if window.after is None or window.before is None:
+            return None
+        clauses = [c for c in query.split(' and ') if not c.strip().startswith(('after ', 'before '))]
+        directory = os.path.join(self.path, md5('{}|{}'.format(' and '.join(clauses), self.seconds)).hexdigest())
+
+        settled = time() - SETTLE
+        chunks = []
+        for start in range(window.after - window.after % self.seconds, window.before, self.seconds):
+            end = start + self.seconds
+            path = os.path.join(directory, '{}.{}.pcap'.format(sensor, start))
+            chunk_query = ' and '.join(clauses + [
+                'after {}'.format(datetime.utcfromtimestamp(start).strftime(ISOFORMAT)),
+                'before {}'.format(datetime.utcfromtimestamp(end).strftime(ISOFORMAT))])
+            chunks.append(Chunk(start, chunk_query, path,
+                                cached=os.path.exists(path) or os.path.exists(self._empty(path)),
+                                cacheable=end <= settled))
+        return chunks
+
+    def clip(self, chunk, before):
+        """ a chunk keeps to its own seconds, so packets on a boundary aren't stitched in twice. 'before' takes in
+            its whole second, like the stenographer query: the chunk holding it ends a second after it
+        """
+        end = chunk.start + self.seconds
+        return chunk.start, end if end < before else before + 1
+
+    @staticmethod
+    def _empty(path):
+        return path[:-len('.pcap')] + '.empty'
+
+    def store(self, chunk, path):
+        directory = os.path.dirname(chunk.path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        if os.path.exists(path):
+            os.rename(path, chunk.path)
+        else:
+            open(self._empty(chunk.path), 'a').close()
+
+    def files(self, chunks):
+        files = []
+        for chunk in chunks:
+            # an empty chunk's marker is used too: it mustn't expire while queries rely on it
+            for path in (chunk.path, self._empty(chunk.path)):
+                try:
+                    os.utime(path, None)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    continue
+                if path == chunk.path:
+                    files.append(path)
+                break
+        return files
+
+    def expire(self, before, space=0):
+        """ returns (files removed, bytes freed) """
+        try:
+            keys = os.listdir(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return 0, 0
+        found = []
+        for key in keys:
+            directory = os.path.join(self.path, key)
+            try:
+                names = os.listdir(directory)
+            except OSError:
+                continue
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue        # removed by someone else
+                found.append((stat.st_mtime, stat.st_size, path))
+
+        removed = freed = 0
+        for mtime, size, path in sorted(found):
+            if (before is None or mtime >= before) and freed >= space:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            removed += 1
+            freed += size
+        for key in keys:
+            try:
+                os.rmdir(os.path.join(self.path, key))
+            except OSError:
+                pass                # still has chunks
+        return removed, freed
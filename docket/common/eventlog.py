@@ -0,0 +1,165 @@
+##
+## Copyright (c) 2017, 2018 RockNSM.
+##
+## This file is part of RockNSM
+## (see http://rocknsm.io).
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##   http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing,
+## software distributed under the License is distributed on an
+## "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+## KIND, either express or implied.  See the License for the
+## specific language governing permissions and limitations
+## under the License.
+##
+##
+# EventLog - append-only persistence for a stream of records plus a small state dictionary.
+#   Appending costs O(new records) no matter how long the log already is, and readers tail it from a cursor.
+#   In redis: a list of records and a hash of state (<key>.events, <key>.state)
+#   On disk: one JSON document per line, ["s", {state}] or ["e", record], appended with a single write()
+from json import dumps, loads
+import errno
+import os
+
+from config import Config
+
+_STATE = 's'
+_EVENT = 'e'
+
+
+class EventLog(object):
+    """ log = EventLog(key, path)
+            key - redis key prefix (used when redis is configured), path - the file copy
+        log.append(records, state=None)     add records (JSON-able), update state fields
+        log.read(cursor=0)                  (state, records, cursor): records after cursor
+            cursors are opaque: pass back what the last read returned to tail the log
+        log.write(records, state)           (re)write the whole file copy
+        EventLog.read_many(logs)            [log.read() for log in logs] in one redis round trip
+    """
+    def __init__(self, key, path):
+        self.key = key
+        self.path = path
+
+    @property
+    def _events_key(self):
+        return self.key + '.events'
+
+    @property
+    def _state_key(self):
+        return self.key + '.state'
+
+    def exists(self, from_file=False):
+        r = None if from_file else Config.redis()
+        if r:
+            return bool(r.exists(self._state_key))
+        return os.path.exists(self.path)
+
+    def append(self, records, state=None, to_file=False):
+        """ to_file - append to the file even though redis is configured """
+        r = None if to_file else Config.redis()
+        if r:
+            pipe = r.pipeline()
+            if records:
+                pipe.rpush(self._events_key, *[dumps(rec) for rec in records])
+            if state:
+                pipe.hmset(self._state_key, {k: dumps(v) for k, v in state.items()})
+            pipe.execute()
+            return True
+
+        lines = []
+        if state:
+            lines.append(dumps([_STATE, state]))
+        lines.extend(dumps([_EVENT, rec]) for rec in records)
+        if not lines:
+            return True
+        try:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0640)
+        except OSError as e:
+            Config.logger.error("EventLog: can't open {}: {}".format(self.path, e))
+            return False
+        try:
+            # one write: concurrent appenders can't interleave within it
+            os.write(fd, ('\n'.join(lines) + '\n').encode('utf-8'))
+        finally:
+            os.close(fd)
+        return True
+
+    def write(self, records, state):
+        """ replace the file copy, the new content becomes visible atomically """
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(dumps([_STATE, state]) + '\n')
+            for rec in records:
+                f.write(dumps([_EVENT, rec]) + '\n')
+        os.rename(tmp, self.path)
+        return True
+
+    def read(self, cursor=0, from_file=False):
+        r = None if from_file else Config.redis()
+        if r:
+            pipe = r.pipeline()
+            self._queue_read(pipe, cursor)
+            return self._decode(pipe.execute(), cursor)
+
+        state, records = {}, []
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(cursor)
+                data = f.read()
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return state, records, cursor
+        # ignore a partial line: its writer isn't done with it
+        data = data[:data.rfind(b'\n') + 1]
+        for line in data.splitlines():
+            try:
+                kind, value = loads(line)
+                if kind == _STATE:
+                    state.update(value)
+                else:
+                    records.append(value)
+            except (ValueError, TypeError) as e:
+                # a torn or damaged line: the rest of the log is still good
+                Config.logger.error("EventLog: {} skipping bad line {}: {}".format(self.path, repr(line[:80]), e))
+        return state, records, cursor + len(data)
+
+    def _queue_read(self, pipe, cursor):
+        pipe.hgetall(self._state_key)
+        pipe.lrange(self._events_key, cursor, -1)
+
+    @staticmethod
+    def _decode(replies, cursor):
+        """ bad records and state fields are logged and skipped, like bad lines on disk """
+        def decoded(items):
+            for key, value in items:
+                try:
+                    yield key, loads(value)
+                except ValueError as e:
+                    Config.logger.error("EventLog: skipping bad entry {}: {}".format(repr(value[:80]), e))
+        state, records = replies
+        count = len(records)
+        records = [rec for _, rec in decoded(enumerate(records))]
+        return dict(decoded(state.items())), records, cursor + count
+
+    @staticmethod
+    def read_many(logs):
+        """ read(0) of every log in logs, in one redis round trip """
+        r = Config.redis()
+        if not r:
+            return [log.read() for log in logs]
+        pipe = r.pipeline()
+        for log in logs:
+            log._queue_read(pipe, 0)
+        replies = pipe.execute()
+        return [EventLog._decode(replies[i:i + 2], 0) for i in range(0, len(replies), 2)]
+
+    def delete(self):
+        r = Config.redis()
+        if r:
+            r.delete(self._events_key, self._state_key)
@@ -0,0 +1,107 @@
+##
+## Copyright (c) 2017, 2018 RockNSM.
+##
+## This file is part of RockNSM
+## (see http://rocknsm.io).
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##   http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing,
+## software distributed under the License is distributed on an
+## "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+## KIND, either express or implied.  See the License for the
+## specific language governing permissions and limitations
+## under the License.
+##
+##
+# compress_file - stores a file as gzip 'frames': one gzip member per 'frame' bytes of input.
+#   Members are independent, so any byte range can be read by decompressing only the frames that hold it.
+#   The file is still an ordinary gzip file (zcat, tcpdump -r <(zcat ...)) and can be served as is.
+#   <path>.idx records the input size and where each member starts (JSON)
+# FramedReader - reads byte ranges of the original file
+from json import dumps, loads
+import zlib
+import io
+
+INDEX_SUFFIX = '.idx'
+INDEX_VERSION = 1
+# gzip framing for zlib: header and trailer written by compressobj, accepted by decompressobj
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def compress_file(path, out_path, frame, level=6, buffer_size=io.DEFAULT_BUFFER_SIZE):
+    """ compress path into out_path (and its index) a frame at a time
+        returns (bytes read, bytes written)
+    """
+    frame = int(frame)
+    offsets, size = [], 0
+    with io.open(path, 'rb', buffering=buffer_size) as src:
+        with io.open(out_path, 'wb', buffering=buffer_size) as out:
+            while True:
+                data = src.read(frame)
+                if not data:
+                    break
+                offsets.append(out.tell())
+                size += len(data)
+                member = zlib.compressobj(level, zlib.DEFLATED, _GZIP_WBITS)
+                out.write(member.compress(data))
+                out.write(member.flush())
+            offsets.append(out.tell())
+    with open(out_path + INDEX_SUFFIX, 'wb') as f:
+        f.write(dumps({'v': INDEX_VERSION, 'frame': frame, 'size': size, 'offsets': offsets}))
+    return size, offsets[-1]
+
+
+class FramedReader(object):
+    """ reader = FramedReader(path)        a file written by compress_file
+        reader.size                         bytes in the original file, None if the index is missing
+        for data in reader.read(start, stop): ...
+                                            the original bytes [start, stop)
+        Without an index, a read decompresses from the start of the file.
+    """
+    def __init__(self, path, chunk_size=64*1024):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.size = None
+        self._frame = None
+        self._offsets = None
+        try:
+            with open(path + INDEX_SUFFIX, 'rb') as f:
+                index = loads(f.read())
+            if index.get('v') == INDEX_VERSION:
+                self.size, self._frame, self._offsets = index['size'], index['frame'], index['offsets']
+        except (IOError, ValueError, KeyError):
+            pass
+
+    def read(self, start=0, stop=None):
+        if self.size is not None:
+            stop = self.size if stop is None else min(stop, self.size)
+        if stop is not None and start >= stop:
+            return
+        position, offset = 0, 0
+        if self._offsets:
+            member = start // self._frame
+            position, offset = member * self._frame, self._offsets[member]
+
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            inflate = zlib.decompressobj(_GZIP_WBITS)
+            while stop is None or position < stop:
+                compressed = f.read(self.chunk_size)
+                if not compressed:
+                    break
+                data = inflate.decompress(compressed)
+                # a member ended: the rest belongs to the next ones
+                while inflate.unused_data:
+                    data += inflate.flush()
+                    compressed, inflate = inflate.unused_data, zlib.decompressobj(_GZIP_WBITS)
+                    data += inflate.decompress(compressed)
+                begin, end = position, position + len(data)
+                position = end
+                if end <= start:
+                    continue
+                yield data[max(start - begin, 0):len(data) if stop is None else min(stop - begin, len(data))]
@@ -0,0 +1,161 @@
+##
+## Copyright (c) 2017, 2018 RockNSM.
+##
+## This file is part of RockNSM
+## (see http://rocknsm.io).
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##   http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing,
+## software distributed under the License is distributed on an
+## "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+## KIND, either express or implied.  See the License for the
+## specific language governing permissions and limitations
+## under the License.
+##
+##
+# IdleTracker - queries waiting for a stenographer instance to become idle share one watcher per instance:
+#   N queued queries cost one stream of stats reads instead of N polling loops.
+# IdleHistograms - how long instances stay idle or busy, to tune IDLE_TIME from data.
+from collections import defaultdict
+from threading import Thread, Condition
+from time import time, sleep
+
+from config import Config
+
+IDLE = 'idle'
+BUSY = 'busy'
+UNREACHABLE = 'unreachable'
+
+_REDIS_PREFIX = 'Docket.Idle.'
+
+
+class IdleTracker(object):
+    """ tracker = IdleTracker(read, idle_time=5, poll=2.0)
+            read(sensor) returns (sampled epoch, state) state is one of IDLE, BUSY, UNREACHABLE
+        tracker.wait(sensor, timeout, cancel)
+            True once sensor was seen idle within idle_time seconds
+            False if it's unreachable, timeout seconds pass, or cancel (a threading.Event) is set
+    """
+    def __init__(self, read, idle_time=5, poll=2.0):
+        self.read = read
+        self.idle_time = idle_time
+        self.poll = poll
+        self._cond = Condition()
+        self._waiters = defaultdict(int)
+        self._watchers = set()
+        self._idle = {}             # sensor: epoch it was last seen idle
+        self._unreachable = set()
+
+    def _is_idle(self, sensor):
+        return time() - self._idle.get(sensor, 0) <= self.idle_time
+
+    def wait(self, sensor, timeout, cancel):
+        give_up = time() + timeout
+        with self._cond:
+            self._waiters[sensor] += 1
+            try:
+                if not self._is_idle(sensor):
+                    self._watch(sensor)
+                while not self._is_idle(sensor):
+                    remaining = give_up - time()
+                    if sensor in self._unreachable or remaining <= 0 or cancel.is_set():
+                        return False
+                    # wake up now and then to notice cancellation
+                    self._cond.wait(min(remaining, self.poll))
+                return True
+            finally:
+                self._waiters[sensor] -= 1
+
+    def _watch(self, sensor):
+        """ start sensor's watcher unless it's running. Requires self._cond """
+        if sensor in self._watchers:
+            return
+        self._watchers.add(sensor)
+        self._unreachable.discard(sensor)
+        thread = Thread(target=self._watcher, args=(sensor,), name='idle-' + sensor)
+        thread.daemon = True
+        thread.start()
+
+    def _watcher(self, sensor):
+        """ leaves _watchers in the critical section it decides to stop in, so any later waiter starts a new one """
+        try:
+            while True:
+                with self._cond:
+                    if not self._waiters[sensor]:
+                        self._watchers.discard(sensor)
+                        return
+                sampled, state = self.read(sensor)
+                with self._cond:
+                    if state == IDLE:
+                        self._idle[sensor] = max(self._idle.get(sensor, 0), sampled)
+                    elif state == UNREACHABLE:
+                        self._unreachable.add(sensor)
+                        self._watchers.discard(sensor)
+                    self._cond.notify_all()
+                    if state == UNREACHABLE:
+                        return
+                sleep(self.poll)
+        except Exception as e:
+            Config.logger.error("Idle watcher {}: {}".format(sensor, e))
+            with self._cond:
+                self._unreachable.add(sensor)
+                self._watchers.discard(sensor)
+                self._cond.notify_all()
+
+
+class IdleHistograms(object):
+    """ Durations of idle and busy periods per sensor, fed by the stats collector:
+        histograms.observe(sensor, sampled, state)  record a stats sample
+        histograms.read(sensors)                    { sensor: { 'idle': {...}, 'busy': {...} } }
+        Counts are kept in redis (or in this process without redis)
+    """
+    BUCKETS = (1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+    def __init__(self):
+        self._state = {}                                    # sensor: (state, since)
+        self._local = defaultdict(lambda: defaultdict(float))
+
+    def observe(self, sensor, sampled, state):
+        previous = self._state.get(sensor)
+        if previous and previous[0] == state:
+            return
+        if previous and previous[0] in (IDLE, BUSY):
+            self._record(sensor, previous[0], sampled - previous[1])
+        self._state[sensor] = (state, sampled)
+
+    def _record(self, sensor, state, seconds):
+        bucket = next((str(b) for b in self.BUCKETS if seconds <= b), '+Inf')
+        r = Config.redis()
+        if r:
+            key = _REDIS_PREFIX + sensor
+            pipe = r.pipeline()
+            pipe.hincrby(key, '{}:{}'.format(state, bucket), 1)
+            pipe.hincrby(key, '{}:count'.format(state), 1)
+            pipe.hincrbyfloat(key, '{}:sum'.format(state), seconds)
+            pipe.execute()
+        else:
+            counts = self._local[sensor]
+            counts['{}:{}'.format(state, bucket)] += 1
+            counts['{}:count'.format(state)] += 1
+            counts['{}:sum'.format(state)] += seconds
+
+    def read(self, sensors):
+        r = Config.redis()
+        results = {}
+        for sensor in sensors:
+            counts = r.hgetall(_REDIS_PREFIX + sensor) if r else self._local.get(sensor, {})
+            result = {}
+            for state in (IDLE, BUSY):
+                result[state] = {
+                    'buckets': {str(b): int(float(counts.get('{}:{}'.format(state, b), 0)))
+                                for b in self.BUCKETS + ('+Inf',)},
+                    'count': int(float(counts.get(state + ':count', 0))),
+                    'sum': float(counts.get(state + ':sum', 0)),
+                }
+            results[sensor] = result
+        return results
@@ -0,0 +1,303 @@
+##
+## Copyright (c) 2017, 2018 RockNSM.
+##
+## This file is part of RockNSM
+## (see http://rocknsm.io).
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##   http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing,
+## software distributed under the License is distributed on an
+## "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+## KIND, either express or implied.  See the License for the
+## specific language governing permissions and limitations
+## under the License.
+##
+##
+# MetricsRegistry - counters and histograms shared by every docket process (uwsgi and celery), in prometheus text format.
+#   Each process adds to a dict in memory and pushes what changed every few seconds (or when asked to),
+#   so recording costs a dict update. Gauges are computed when the metrics are rendered.
+#   In redis: one hash of totals (Docket.Metrics), changes are added with HINCRBYFLOAT
+#   Without redis: a file of totals per process in <path>, summed when rendered. fold() adds the files of
+#   the host's exited processes to one file per host (<host>.folded), which lists those it holds until they're gone
+from collections import defaultdict
+from contextlib import contextmanager
+from fcntl import flock, LOCK_EX, LOCK_UN
+from socket import gethostname
+from threading import Lock
+from json import dumps, loads
+from time import time
+import errno
+import os
+
+from config import Config
+
+_REDIS_KEY = 'Docket.Metrics'
+COUNTER = 'counter'
+HISTOGRAM = 'histogram'
+GAUGE = 'gauge'
+_FOLDED = '.folded'
+# seconds: request handling to whole queries
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+
+def _labels(labels):
+    """ prometheus label text for a dict or sequence of (name, value) """
+    items = sorted(labels.items() if isinstance(labels, dict) else labels)
+    return ','.join('{}="{}"'.format(k, str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+                    for k, v in items)
+
+
+def _series(name, labels, value):
+    """ a sample line: integers stay exact, bytes counters get large """
+    value = '{:d}'.format(int(value)) if value == int(value) else repr(value)
+    return '{}{{{}}} {}'.format(name, labels, value) if labels else '{} {}'.format(name, value)
+
+
+def _exited(name, host):
+    """ True if name is the file of a process of this host that is gone """
+    parts = name.rsplit('.', 2)
+    if len(parts) != 3 or parts[0] != host or not parts[1].isdigit() or int(parts[1]) == os.getpid():
+        return False
+    try:
+        os.kill(int(parts[1]), 0)
+    except OSError as e:
+        return e.errno == errno.ESRCH
+    return False
+
+
+class MetricsRegistry(object):
+    """ metrics = MetricsRegistry(path, flush=5.0)
+            path - directory of each process's totals, used without redis
+            flush - seconds between pushes of this process's changes
+        metrics.counter(name, help)
+        metrics.histogram(name, help, buckets=DEFAULT_BUCKETS)
+        metrics.gauge(name, help, collect)      collect() returns {labels: value} when rendering, labels is a dict
+                                                or a tuple of (name, value) pairs
+        metrics.inc(name, value=1, **labels)
+        metrics.observe(name, value, **labels)
+        with metrics.timer(name, **labels):     observe the seconds the block takes
+        metrics.flush()                         push this process's changes now
+        metrics.render()                        every process's totals and the gauges, prometheus text format
+        metrics.totals([(name, labels)])        [total] of each counter series, from every process
+        metrics.fold()                          without redis: fold the files of this host's exited processes into one
+    """
+    def __init__(self, path, flush=5.0):
+        self.path = path
+        self.period = flush
+        self._metrics = {}                  # name: (type, help, buckets or collect)
+        self._lock = Lock()
+        self._pending = defaultdict(float)  # field: change since the last push
+        self._totals = defaultdict(float)   # field: this process's totals, without redis
+        self._pushed = time()
+        self._pid = None
+        self._file = None
+
+    def counter(self, name, help):
+        self._metrics[name] = (COUNTER, help, None)
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        self._metrics[name] = (HISTOGRAM, help, tuple(buckets))
+
+    def gauge(self, name, help, collect):
+        self._metrics[name] = (GAUGE, help, collect)
+
+    def inc(self, name, value=1, **labels):
+        self._add([('{}|{}'.format(name, _labels(labels)), value)])
+
+    def observe(self, name, value, **labels):
+        buckets = self._metrics[name][2]
+        bucket = next((str(b) for b in buckets if value <= b), '+Inf')
+        labels = _labels(labels)
+        self._add([('{}|{}|{}'.format(name, labels, bucket), 1),
+                   ('{}|{}|sum'.format(name, labels), value)])
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time()
+        try:
+            yield
+        finally:
+            self.observe(name, time() - start, **labels)
+
+    def _add(self, changes):
+        with self._lock:
+            self._forked()
+            for field, value in changes:
+                self._pending[field] += value
+            due = time() - self._pushed >= self.period
+        if due:
+            self.flush()
+
+    def _forked(self):
+        """ a forked child starts without its parent's counts. Requires self._lock """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._pending.clear()
+            self._totals.clear()
+            self._file = os.path.join(self.path, '{}.{}.{}'.format(gethostname(), self._pid, int(time())))
+
+    def flush(self):
+        """ a failed push is logged and dropped: metrics never fail a query """
+        with self._lock:
+            self._forked()
+            pending, self._pending = self._pending, defaultdict(float)
+            self._pushed = time()
+            if not pending:
+                return
+            r = Config.redis()
+            if not r:
+                for field, value in pending.items():
+                    self._totals[field] += value
+                try:
+                    # renamed into place: readers never see part of a file
+                    self._makedirs()
+                    with open(self._file + '.tmp', 'wb') as f:
+                        f.write(dumps(self._totals))
+                    os.rename(self._file + '.tmp', self._file)
+                except (IOError, OSError) as e:
+                    Config.logger.error("Metrics: push failed: {}".format(e))
+                return
+        try:
+            pipe = r.pipeline(transaction=False)
+            for field, value in pending.items():
+                pipe.hincrbyfloat(_REDIS_KEY, field, value)
+            pipe.execute()
+        except Exception as e:
+            Config.logger.error("Metrics: push failed: {}".format(e))
+
+    def _read(self):
+        """ {field: total} of every process """
+        r = Config.redis()
+        if r:
+            return {k: float(v) for k, v in r.hgetall(_REDIS_KEY).items()}
+        for attempt in range(3):
+            totals, vanished = self._read_files()
+            if not vanished:
+                break
+        return totals
+
+    def _read_files(self):
+        """ ({field: total}, whether a file went away: folded while we read, read again) """
+        totals = defaultdict(float)
+        try:
+            names = os.listdir(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return totals, False
+        # the folded totals first: the files they hold may still be there
+        folded = set()
+        for name in [n for n in names if n.endswith(_FOLDED)]:
+            data = self._load(name)
+            if data:
+                for field, value in data['totals'].items():
+                    totals[field] += value
+                folded.update(data['folded'])
+        for name in names:
+            if name.startswith('.') or name.endswith(('.tmp', _FOLDED)) or name in folded:
+                continue
+            data = self._load(name)
+            if data is None:
+                return totals, True
+            for field, value in data.items():
+                totals[field] += value
+        return totals, False
+
+    def _load(self, name):
+        """ a file's contents, {} if it's unreadable, None if it's gone """
+        try:
+            with open(os.path.join(self.path, name), 'rb') as f:
+                return loads(f.read())
+        except IOError as e:
+            return None if e.errno == errno.ENOENT else {}
+        except ValueError:
+            return {}
+
+    def fold(self):
+        """ add the totals of this host's exited processes to its .folded file and delete theirs, without redis
+            returns the number of files folded
+        """
+        if Config.redis() or not os.path.isdir(self.path):
+            return 0
+        host = gethostname()
+        with open(os.path.join(self.path, '.lock'), 'a') as lock:
+            flock(lock, LOCK_EX)
+            try:
+                names = os.listdir(self.path)
+                data = self._load(host + _FOLDED) or {'totals': {}, 'folded': []}
+                exited = [n for n in names if _exited(n, host) and n not in data['folded']]
+                if not exited:
+                    return 0
+                totals = defaultdict(float, data['totals'])
+                for name in exited:
+                    for field, value in (self._load(name) or {}).items():
+                        totals[field] += value
+                # the files are deleted once the folded totals hold them: a reader skips those it lists
+                path = os.path.join(self.path, host + _FOLDED)
+                with open(path + '.tmp', 'wb') as f:
+                    f.write(dumps({'totals': totals, 'folded': [n for n in data['folded'] if n in names] + exited}))
+                os.rename(path + '.tmp', path)
+                for name in exited:
+                    os.remove(os.path.join(self.path, name))
+                return len(exited)
+            except (IOError, OSError) as e:
+                Config.logger.error("Metrics: fold failed: {}".format(e))
+                return 0
+            finally:
+                flock(lock, LOCK_UN)
+
+    def totals(self, series):
+        self.flush()
+        totals = self._read()
+        return [totals.get('{}|{}'.format(name, _labels(labels)), 0) for name, labels in series]
+
+    def render(self):
+        self.flush()
+        series = defaultdict(lambda: defaultdict(dict))     # name: labels: {bucket or '': value}
+        for field, value in self._read().items():
+            parts = field.split('|', 2)
+            if len(parts) == 2:
+                parts.append('')
+            name, labels, bucket = parts
+            series[name][labels][bucket] = value
+
+        lines = []
+        for name in sorted(self._metrics):
+            kind, help, extra = self._metrics[name]
+            if kind == GAUGE:
+                try:
+                    values = {_labels(labels): value for labels, value in extra().items()}
+                except Exception as e:
+                    Config.logger.error("Metrics: {} failed: {}".format(name, e))
+                    continue
+            else:
+                values = series.get(name, {})
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels in sorted(values):
+                if kind == HISTOGRAM:
+                    counts, total = values[labels], 0
+                    for bucket in [str(b) for b in extra] + ['+Inf']:
+                        total += counts.get(bucket, 0)
+                        le = 'le="{}"'.format(bucket)
+                        lines.append(_series(name + '_bucket', ','.join(l for l in (labels, le) if l), total))
+                    lines.append(_series(name + '_sum', labels, counts.get('sum', 0)))
+                    lines.append(_series(name + '_count', labels, total))
+                elif kind == COUNTER:
+                    lines.append(_series(name, labels, values[labels]['']))
+                else:
+                    lines.append(_series(name, labels, values[labels]))
+        return '\n'.join(lines) + '\n'
+
+    def _makedirs(self):
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
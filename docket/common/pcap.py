@@ -0,0 +1,332 @@
+##
+## Copyright (c) 2017, 2018 RockNSM.
+##
+## This file is part of RockNSM
+## (see http://rocknsm.io).
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##   http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing,
+## software distributed under the License is distributed on an
+## "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+## KIND, either express or implied.  See the License for the
+## specific language governing permissions and limitations
+## under the License.
+##
+##
+# PcapReader - reads libpcap records through mmap, optionally following a file that is still being written
+#   spans() walks the records in place, for readers that look at fields with struct.unpack_from and copy nothing
+# merge_pcaps - k-way merge of captures into a single pcap, ordered by record timestamp
+# StreamMerger - merges captures as they arrive, for clients that want packets before every sensor is done
+#   Replaces wireshark's mergecap: no fork, no wireshark dependency.
+#   Output is always little-endian, microsecond resolution libpcap ( mergecap -F pcap )
+from collections import namedtuple
+from heapq import heappush, heappop, heapreplace
+from time import sleep, time
+import struct
+import mmap
+import io
+import os
+
+GLOBAL_HEADER = struct.Struct('<IHHiIII')  # magic, major, minor, thiszone, sigfigs, snaplen, linktype
+RECORD_HEADER = struct.Struct('<IIII')     # ts_sec, ts_frac, incl_len, orig_len
+
+MAGIC_USEC = 0xa1b2c3d4
+MAGIC_NSEC = 0xa1b23c4d
+# first 4 bytes of a file : (byte order, nanosecond resolution)
+MAGICS = {
+    b'\xd4\xc3\xb2\xa1': ('<', False),
+    b'\xa1\xb2\xc3\xd4': ('>', False),
+    b'\x4d\x3c\xb2\xa1': ('<', True),
+    b'\xa1\xb2\x3c\x4d': ('>', True),
+}
+LINKTYPE_ETHERNET = 1
+DEFAULT_SNAPLEN = 65535
+# No sane capture has records larger than this, anything bigger is corruption
+MAX_SNAPLEN = 262144
+# seconds between checks on a file that is still growing
+FOLLOW_SLEEP = 0.2
+
+Merged = namedtuple('Merged', ['records', 'truncated', 'counts'])
+
+
+class PcapError(Exception):
+    pass
+
+
+def view(data, offset, size):
+    """ size bytes of data (a string or mmap) at offset, without copying them """
+    try:
+        return buffer(data, offset, size)
+    except NameError:
+        # python 3: mmap supports the buffer protocol
+        return memoryview(data)[offset:offset + size]
+
+
+def global_header(snaplen=DEFAULT_SNAPLEN, linktype=LINKTYPE_ETHERNET):
+    """ a little-endian, microsecond resolution pcap file header """
+    return GLOBAL_HEADER.pack(MAGIC_USEC, 2, 4, 0, 0, snaplen, linktype)
+
+
+class PcapReader(object):
+    """ reader = PcapReader(path)           read a complete capture
+        reader = PcapReader(path, follow)   read a capture that is still being written:
+                                            follow() returns True while more data may arrive
+        for ts, record in reader: ...       ts is microseconds since the epoch,
+                                            record is a normalized (little-endian, usec) record header + data
+
+        for offset, size in reader.spans(): ...
+                                            records as they are in reader.map (in the file's byte order),
+                                            header included. Only for complete captures
+
+        Records are sliced from an mmap of the file, so only one record is held in memory at a time.
+    """
+    def __init__(self, path, follow=None):
+        self.path = path
+        self.follow = follow
+        self.truncated = False      # True if the file ended in the middle of a record
+        self.done = False           # True once the end of the capture has been reached
+        self.count = 0              # records read
+        self._f = open(path, 'rb')
+        self._map = None
+        self._size = 0
+        self._offset = GLOBAL_HEADER.size
+        self._read_header()
+
+    def _remap(self):
+        """ map any data appended since the last map, returns True if there is more to read """
+        size = os.fstat(self._f.fileno()).st_size
+        if size <= self._size:
+            return False
+        if self._map is not None:
+            self._map.close()
+        self._map = mmap.mmap(self._f.fileno(), size, access=mmap.ACCESS_READ)
+        self._size = size
+        return True
+
+    def _wait(self, need, wait=True):
+        """ ensure at least 'need' bytes are mapped, waiting on a growing file.
+            False if they never arrive (sets done), or haven't arrived yet and wait is False
+        """
+        while self._size < need:
+            if self._remap():
+                continue
+            if not (self.follow and self.follow()):
+                # the writer may have finished between our last look and now
+                self._remap()
+                self.done = self._size < need
+                return not self.done
+            if not wait:
+                return False
+            sleep(FOLLOW_SLEEP)
+        return True
+
+    def _read_header(self):
+        if not self._wait(GLOBAL_HEADER.size):
+            self.close()
+            raise PcapError("{}: too short for a pcap header".format(self.path))
+        magic = self._map[:4]
+        if magic not in MAGICS:
+            self.close()
+            raise PcapError("{}: not a pcap file (magic {})".format(self.path, repr(magic)))
+        self.order, self.nanosecond = MAGICS[magic]
+        self._record = struct.Struct(self.order + 'IIII')
+        (_, self.major, self.minor, _, _,
+         self.snaplen, self.linktype) = struct.unpack(self.order + 'IHHiIII', self._map[:GLOBAL_HEADER.size])
+        if self.major != 2:
+            self.close()
+            raise PcapError("{}: unsupported pcap version {}.{}".format(self.path, self.major, self.minor))
+
+    def next(self, wait=True):
+        """ returns (timestamp, record) for the next record or None at the end of the capture.
+            wait - if False, return None instead of waiting for a record that hasn't been written yet
+        """
+        offset = self._offset
+        end = offset + RECORD_HEADER.size
+        if not self._wait(end, wait):
+            self.truncated = self.done and self._size > offset
+            return None
+        sec, frac, incl, orig = self._record.unpack_from(self._map, offset)
+        if incl > max(self.snaplen, MAX_SNAPLEN):
+            raise PcapError("{}: corrupt record at offset {} ({} bytes)".format(self.path, offset, incl))
+        if not self._wait(end + incl, wait):
+            self.truncated = self.done
+            return None
+        if self.nanosecond:
+            frac //= 1000
+        self._offset = end + incl
+        self.count += 1
+        return (sec * 1000000 + frac,
+                RECORD_HEADER.pack(sec, frac, incl, orig) + self._map[end:end + incl])
+
+    __next__ = next
+
+    @property
+    def normalized(self):
+        """ True if records are stored the way next() returns them (little-endian, microseconds) """
+        return self.order == '<' and not self.nanosecond
+
+    @property
+    def map(self):
+        return self._map
+
+    def spans(self):
+        """ yields (offset, size) of each record left in the capture """
+        self._wait(self._offset + RECORD_HEADER.size)
+        unpack_from, header, size = self._record.unpack_from, RECORD_HEADER.size, self._size
+        limit = max(self.snaplen, MAX_SNAPLEN)
+        offset = self._offset
+        while offset + header <= size:
+            incl = unpack_from(self._map, offset)[2]
+            if incl > limit:
+                raise PcapError("{}: corrupt record at offset {} ({} bytes)".format(self.path, offset, incl))
+            end = offset + header + incl
+            if end > size:
+                break
+            self._offset = end
+            self.count += 1
+            yield offset, header + incl
+            offset = end
+        self.done = True
+        self.truncated = offset < size
+
+    def __iter__(self):
+        return iter(self.next, None)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def reconcile(readers):
+    """ returns the (snaplen, linktype) for an output file that can hold every reader's records """
+    linktypes = set(r.linktype for r in readers)
+    if len(linktypes) > 1:
+        raise PcapError("Can't merge different link types: {}".format(
+            ', '.join('{}={}'.format(r.path, r.linktype) for r in readers)))
+    linktype = linktypes.pop() if linktypes else LINKTYPE_ETHERNET
+    snaplen = max([r.snaplen for r in readers] or [DEFAULT_SNAPLEN])
+    return snaplen, linktype
+
+
+def merged_records(readers, clips=None):
+    """ k-way merge: yields records from all readers ordered by timestamp.
+        Ties keep the order of readers, so merging is deterministic.
+        clips - for each reader, (start, end) microseconds or None: its records outside [start, end) are skipped
+    """
+    def next_item(i):
+        item = readers[i].next()
+        clip = clips and clips[i]
+        while clip and item is not None and not clip[0] <= item[0] < clip[1]:
+            item = readers[i].next()
+        return item
+
+    heap = []
+    for i in range(len(readers)):
+        item = next_item(i)
+        if item is not None:
+            heappush(heap, (item[0], i, item[1]))
+    while heap:
+        _, i, record = heap[0]
+        yield record
+        item = next_item(i)
+        if item is None:
+            heappop(heap)
+        else:
+            heapreplace(heap, (item[0], i, item[1]))
+
+
+class StreamMerger(object):
+    """ merger = StreamMerger(skew)
+        merger.add(PcapReader(path, follow))    readers can be added at any time
+        for record in merger.available(): ...   records that can be sent now, without blocking
+        merger.done                             True when every reader added so far is exhausted
+
+        Records are time ordered while every reader keeps up.
+        A reader with nothing to offer holds the others back for at most 'skew' seconds,
+        after that its records are interleaved as they arrive (possibly out of order).
+    """
+    def __init__(self, skew=5.0):
+        self.skew = skew
+        self._readers = []
+        self._heap = []         # (timestamp, reader index, record) - the next record of each reader
+        self._waiting = {}      # reader index: time it started waiting for its next record
+
+    def add(self, reader):
+        self._readers.append(reader)
+        self._waiting[len(self._readers) - 1] = time()
+
+    def _pull(self, i):
+        """ move reader i's next record onto the heap, if it has one """
+        item = self._readers[i].next(wait=False)
+        if item is not None:
+            heappush(self._heap, (item[0], i, item[1]))
+            del self._waiting[i]
+        elif self._readers[i].done:
+            del self._waiting[i]
+
+    def available(self):
+        for i in list(self._waiting):
+            self._pull(i)
+        while self._heap:
+            now = time()
+            if any(now - since < self.skew for since in self._waiting.values()):
+                return
+            _, i, record = heappop(self._heap)
+            yield record
+            self._waiting[i] = now
+            self._pull(i)
+
+    @property
+    def done(self):
+        return not self._heap and not self._waiting
+
+    def close(self):
+        for reader in self._readers:
+            reader.close()
+
+
+def count_records(path):
+    """ records in a complete capture, without reading their data """
+    with PcapReader(path) as reader:
+        return sum(1 for _ in reader.spans())
+
+
+def merge_pcaps(paths, out_path, buffer_size=io.DEFAULT_BUFFER_SIZE, follow=None, keep=None, clips=None):
+    """ merge the pcap files in paths into out_path ordered by time.
+        buffer_size - bytes buffered before each write to out_path
+        follow      - follow(path) returns True while path is still being written
+        keep        - keep(record) returns False for records to leave out
+        clips       - {path: (start, end)} epoch seconds: that input's records outside [start, end) are left out
+        returns Merged(records written, [paths of truncated inputs], {path: records read})
+    """
+    readers = []
+    try:
+        for path in paths:
+            readers.append(PcapReader(path, follow=(lambda p=path: follow(p)) if follow else None))
+        snaplen, linktype = reconcile(readers)
+        count = 0
+        with io.open(out_path, 'wb', buffering=buffer_size) as out:
+            out.write(global_header(snaplen, linktype))
+            windows = [(clips[r.path][0] * 1000000, clips[r.path][1] * 1000000) if clips and r.path in clips else None
+                       for r in readers]
+            for record in merged_records(readers, windows):
+                if keep is None or keep(record):
+                    out.write(record)
+                    count += 1
+        return Merged(count, [r.path for r in readers if r.truncated], {r.path: r.count for r in readers})
+    finally:
+        for reader in readers:
+            reader.close()
@@ -0,0 +1,212 @@
+##
+## Copyright (c) 2017, 2018 RockNSM.
+##
+## This file is part of RockNSM
+## (see http://rocknsm.io).
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##   http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing,
+## software distributed under the License is distributed on an
+## "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+## KIND, either express or implied.  See the License for the
+## specific language governing permissions and limitations
+## under the License.
+##
+##
+# PacketFilter - matches pcap records against the stenographer queries docket builds,
+#   so results we already have can be narrowed down locally instead of asking the sensors again.
+#   Understands what _build_query writes: host, net, port, ip proto, tcp/udp/icmp, after and before, joined by 'and'
+#   Fields are read in place with struct.unpack_from, addresses compared as integers: no per-packet copies
+# filter_pcap - writes the records of a capture that a filter matches to a new capture
+from calendar import timegm
+from datetime import datetime
+from socket import inet_pton, AF_INET, AF_INET6, error as SocketError
+import struct
+import io
+import re
+
+from common.pcap import PcapReader, PcapError, global_header, view, RECORD_HEADER, LINKTYPE_ETHERNET
+from common.utils import ISOFORMAT
+
+PROTOCOLS = {'tcp': 6, 'udp': 17, 'icmp': 1}
+# protocols with 16 bit source and destination ports at the start of their header
+_PORTED = (6, 17, 132)
+
+_CLAUSE_RX = re.compile(r'^(host|net|port|ip proto|after|before) (\S+)$|^(tcp|udp|icmp)$')
+_ETHER_TYPE = struct.Struct('!H')
+_PORTS = struct.Struct('!HH')
+_BYTE = struct.Struct('B')
+_IPV4_ADDRESSES = struct.Struct('!II')
+_IPV6_ADDRESSES = struct.Struct('!QQQQ')
+_ETHER_IPV4, _ETHER_IPV6 = 0x0800, 0x86dd
+_ETHER_VLANS = (0x8100, 0x88a8, 0x9100)
+
+
+def _address(ip):
+    """ (version, address as an integer) """
+    version = 6 if ':' in ip else 4
+    value = 0
+    for byte in bytearray(inet_pton(AF_INET6 if version == 6 else AF_INET, ip)):
+        value = value << 8 | byte
+    return version, value
+
+
+def _network(cidr):
+    """ 'ip/bits' or 'ip/dotted mask' -> (version, network, mask) """
+    ip, mask = cidr.split('/')
+    version, network = _address(ip)
+    width = 128 if version == 6 else 32
+    if '.' in mask:
+        mask = _address(mask)[1]
+    else:
+        bits = int(mask)
+        if not 0 <= bits <= width:
+            raise ValueError("bad netmask: {}".format(cidr))
+        mask = ((1 << bits) - 1) << (width - bits)
+    return version, network & mask, mask
+
+
+class PacketFilter(object):
+    """ f = PacketFilter.parse(query)   ValueError if the query has clauses we can't filter on
+        f = PacketFilter.window(query)  a filter on the query's time clauses only
+        f.match(data, offset=0)         the record at offset in data (a string, or a capture's map)
+                                        records are normalized: little-endian, microseconds (see PcapReader)
+        f.covers(other)                 True if every packet 'other' matches is matched by f (times aside)
+        f.after, f.before               the time window, epoch seconds (or None)
+    """
+    def __init__(self):
+        self.hosts = []         # (version, address)
+        self.nets = []          # (version, network, mask)
+        self.ports = []
+        self.protos = []
+        self.after = None
+        self.before = None
+
+    @classmethod
+    def parse(cls, query):
+        f = cls()
+        for clause in (query or '').split(' and '):
+            m = _CLAUSE_RX.match(clause.strip())
+            if not m:
+                raise ValueError("can't filter on: {}".format(clause))
+            kind, value = m.group(1), m.group(2)
+            try:
+                if m.group(3):
+                    f.protos.append(PROTOCOLS[m.group(3)])
+                elif kind == 'host':
+                    f.hosts.append(_address(value))
+                elif kind == 'net':
+                    f.nets.append(_network(value))
+                elif kind == 'port':
+                    f.ports.append(int(value))
+                elif kind == 'ip proto':
+                    f.protos.append(int(value))
+                else:
+                    # repeated time clauses narrow the window
+                    when = timegm(datetime.strptime(value, ISOFORMAT).timetuple())
+                    if getattr(f, kind) is not None:
+                        when = (max if kind == 'after' else min)(when, getattr(f, kind))
+                    setattr(f, kind, when)
+            except (SocketError, ValueError) as e:
+                raise ValueError("can't filter on: {} ({})".format(clause, e))
+        return f
+
+    @classmethod
+    def window(cls, query):
+        """ a filter on query's time clauses only """
+        parsed, f = cls.parse(query), cls()
+        f.after, f.before = parsed.after, parsed.before
+        return f
+
+    def covers(self, other):
+        """ each of our clauses is implied by one of other's: a host in a net we have, a net inside it... """
+        def in_net(address, net):
+            return address[0] == net[0] and address[1] & net[2] == net[1]
+        def net_in_net(inner, net):
+            return in_net(inner[:2], net) and inner[2] & net[2] == net[2]
+        return (all(host in other.hosts for host in self.hosts)
+                and all(any(in_net(host, net) for host in other.hosts) or
+                        any(net_in_net(inner, net) for inner in other.nets) for net in self.nets)
+                and all(port in other.ports for port in self.ports)
+                and all(proto in other.protos for proto in self.protos))
+
+    def match(self, data, offset=0):
+        sec = RECORD_HEADER.unpack_from(data, offset)[0]
+        if (self.after is not None and sec < self.after) or (self.before is not None and sec > self.before):
+            return False
+        if not (self.hosts or self.nets or self.ports or self.protos):
+            return True
+        try:
+            return self._match_packet(data, offset + RECORD_HEADER.size)
+        except struct.error:
+            return False        # truncated by the snaplen before the fields we need
+
+    def _match_packet(self, data, offset):
+        offset += 12
+        ether_type = _ETHER_TYPE.unpack_from(data, offset)[0]
+        while ether_type in _ETHER_VLANS:
+            offset += 4
+            ether_type = _ETHER_TYPE.unpack_from(data, offset)[0]
+        offset += 2
+        if ether_type == _ETHER_IPV4:
+            version = 4
+            header = (_BYTE.unpack_from(data, offset)[0] & 0x0f) * 4
+            proto = _BYTE.unpack_from(data, offset + 9)[0]
+            src, dst = _IPV4_ADDRESSES.unpack_from(data, offset + 12)
+            # fragments after the first don't have ports
+            fragment = _ETHER_TYPE.unpack_from(data, offset + 6)[0] & 0x1fff
+        elif ether_type == _ETHER_IPV6:
+            version, header, fragment = 6, 40, 0
+            proto = _BYTE.unpack_from(data, offset + 6)[0]
+            src_high, src_low, dst_high, dst_low = _IPV6_ADDRESSES.unpack_from(data, offset + 8)
+            src, dst = src_high << 64 | src_low, dst_high << 64 | dst_low
+        else:
+            return False
+
+        for proto_wanted in self.protos:
+            if proto != proto_wanted:
+                return False
+        for host_version, host in self.hosts:
+            if host_version != version or (host != src and host != dst):
+                return False
+        for net_version, network, mask in self.nets:
+            if net_version != version or (src & mask != network and dst & mask != network):
+                return False
+        if self.ports:
+            if proto not in _PORTED or fragment:
+                return False
+            ports = _PORTS.unpack_from(data, offset + header)
+            for port in self.ports:
+                if port not in ports:
+                    return False
+        return True
+
+
+def filter_pcap(path, out_path, pfilter, buffer_size=io.DEFAULT_BUFFER_SIZE):
+    """ write the records of the capture at path that pfilter matches to out_path
+        returns (records read, records written)
+    """
+    with PcapReader(path) as reader:
+        if reader.linktype != LINKTYPE_ETHERNET:
+            raise PcapError("{}: can't filter link type {}".format(path, reader.linktype))
+        written = 0
+        with io.open(out_path, 'wb', buffering=buffer_size) as out:
+            out.write(global_header(reader.snaplen, reader.linktype))
+            if reader.normalized:
+                # docket's own captures: matched records go from the map to the output as they are
+                data = reader.map
+                for offset, size in reader.spans():
+                    if pfilter.match(data, offset):
+                        out.write(view(data, offset, size))
+                        written += 1
+            else:
+                for _, record in reader:
+                    if pfilter.match(record):
+                        out.write(record)
+                        written += 1
+        return reader.count, written
@@ -0,0 +1,213 @@
+##
+## Copyright (c) 2017, 2018 RockNSM.
+##
+## This file is part of RockNSM
+## (see http://rocknsm.io).
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##   http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing,
+## software distributed under the License is distributed on an
+## "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+## KIND, either express or implied.  See the License for the
+## specific language governing permissions and limitations
+## under the License.
+##
+##
+# Profiler - opt-in profiles of API requests and celery tasks, written to a directory for flamegraphs.
+#   A fraction of runs is sampled (rate), and callers can force one (see PROFILE_TOKEN).
+#   'sample' mode: a thread records the profiled threads' stacks every interval: wall time, including waits.
+#       Written as folded stacks (<name>.folded): 'thread;outer;...;inner count' lines, for flamegraph.pl or speedscope
+#   'cprofile' mode: the calling thread's cProfile stats (<name>.prof), for pstats, snakeviz or flameprof
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+from threading import Thread, Event, local, current_thread, enumerate as threads
+from random import random
+import cProfile
+import errno
+import os
+import re
+import sys
+
+from config import Config
+
+SAMPLE = 'sample'
+CPROFILE = 'cprofile'
+_SUFFIXES = {SAMPLE: '.folded', CPROFILE: '.prof'}
+_UNSAFE = re.compile(r'[^A-Za-z0-9_.-]+')
+
+
+def _frame_name(code):
+    return '{}:{}:{}'.format(os.path.basename(code.co_filename), code.co_name, code.co_firstlineno)
+
+
+class _Sampler(Thread):
+    """ counts the folded stacks of thread 'ident', or of every other thread (ident=None) """
+    def __init__(self, interval, ident=None):
+        super(_Sampler, self).__init__(name='profiler')
+        self.daemon = True
+        self.interval = interval
+        self.target = ident
+        self.stacks = Counter()
+        self._done = Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            names = {t.ident: t.name for t in threads()}
+            for ident, frame in sys._current_frames().items():
+                if ident == self.ident or (self.target is not None and ident != self.target):
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, 'thread'))
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+
+class Profile(object):
+    """ one running profile, see Profiler.start """
+    def __init__(self, name, forced, mode, interval, all_threads):
+        self.name = name
+        self.forced = forced
+        self.started = datetime.utcnow()
+        if mode == CPROFILE:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        else:
+            self._profiler = _Sampler(interval, None if all_threads else current_thread().ident)
+            self._profiler.start()
+
+    def stop(self):
+        if isinstance(self._profiler, _Sampler):
+            self._profiler.stop()
+        else:
+            self._profiler.disable()
+
+    def write(self, path):
+        if isinstance(self._profiler, _Sampler):
+            with open(path, 'w') as f:
+                for stack, count in sorted(self._profiler.stacks.items()):
+                    f.write('{} {}\n'.format(stack, count))
+        else:
+            self._profiler.dump_stats(path)
+
+
+class Profiler(object):
+    """ profiler = Profiler(path, rate=0.0, mode=SAMPLE, interval=0.01, keep=100)
+            path - directory the profiles are written to
+            rate - fraction of runs that are profiled, 0 profiles only forced runs
+            keep - profiles kept in path, the oldest are deleted
+        profile = profiler.start(name, forced=False, all_threads=False)   None if this run isn't sampled
+        profiler.stop(profile)                  write it to path (None is ignored)
+        with profiler.profile(name, forced=False, all_threads=False): ...
+        @profiler.task()                        under @celery.task: profiles the task's runs, a 'profile' keyword forces one
+        profiler.forwarded()                    {'profile': True} within a forced profile: kwargs for the tasks it queues
+        profiler.list()                         [{name, size, time}] newest first
+        profiler.file(name)                     the path of a listed profile, or None
+    """
+    def __init__(self, path, rate=0.0, mode=SAMPLE, interval=0.01, keep=100):
+        if mode not in _SUFFIXES:
+            raise ValueError("Unknown profile mode: {}".format(mode))
+        self.path = path
+        self.rate = rate
+        self.mode = mode
+        self.interval = interval
+        self.keep = keep
+        self._local = local()
+
+    def start(self, name, forced=False, all_threads=False):
+        if getattr(self._local, 'profile', None) or not (forced or (self.rate and random() < self.rate)):
+            return None         # nested runs (tasks called directly) are part of the outer profile
+        self._local.profile = Profile(name, forced, self.mode, self.interval, all_threads)
+        return self._local.profile
+
+    def stop(self, profile):
+        """ a failed write is logged: profiles never fail a query """
+        if profile is None:
+            return
+        profile.stop()
+        if getattr(self._local, 'profile', None) is profile:
+            self._local.profile = None
+        name = '{:%Y%m%dT%H%M%S.%f}.{}.{}{}'.format(profile.started, _UNSAFE.sub('_', profile.name),
+                                                      os.getpid(), _SUFFIXES[self.mode])
+        try:
+            self._makedirs()
+            profile.write(os.path.join(self.path, name + '.tmp'))
+            os.rename(os.path.join(self.path, name + '.tmp'), os.path.join(self.path, name))
+            self._prune()
+        except (IOError, OSError) as e:
+            Config.logger.error("Profiler: writing {} failed: {}".format(name, e))
+
+    @contextmanager
+    def profile(self, name, forced=False, all_threads=False):
+        profile = self.start(name, forced, all_threads)
+        try:
+            yield profile
+        finally:
+            self.stop(profile)
+
+    def task(self, name=None):
+        """ celery checks a task's arguments against the function's: this wrapper accepts any """
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                forced = kwargs.pop('profile', False)
+                with self.profile(name or func.__name__, forced, all_threads=True):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def forwarded(self):
+        profile = getattr(self._local, 'profile', None)
+        return {'profile': True} if profile and profile.forced else {}
+
+    def list(self):
+        try:
+            names = os.listdir(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+        profiles = []
+        for name in names:
+            if name.endswith('.tmp'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue        # pruned while we listed
+            profiles.append({'name': name, 'size': st.st_size,
+                             'time': datetime.utcfromtimestamp(st.st_mtime)})
+        return sorted(profiles, key=lambda p: p['name'], reverse=True)
+
+    def file(self, name):
+        if name != os.path.basename(name) or name.endswith('.tmp') or name.startswith('.'):
+            return None
+        path = os.path.join(self.path, name)
+        return path if os.path.isfile(path) else None
+
+    def _prune(self):
+        for profile in self.list()[self.keep:]:
+            try:
+                os.remove(os.path.join(self.path, profile['name']))
+            except OSError:
+                pass            # another process pruned it
+
+    def _makedirs(self):
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
@@ -0,0 +1,182 @@
+##
+## Copyright (c) 2017, 2018 RockNSM.
+##
+## This file is part of RockNSM
+## (see http://rocknsm.io).
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##   http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing,
+## software distributed under the License is distributed on an
+## "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+## KIND, either express or implied.  See the License for the
+## specific language governing permissions and limitations
+## under the License.
+##
+##
+# QueryIndex - a redis secondary index of queries by clause (host, net, port, proto) and request time.
+#   Finding queries is set intersections and a range scan instead of loading every query:
+#   Docket.Index.time         sorted set of ids, scored by request time (epoch)
+#   Docket.Index.host:1.2.3.4 set of ids, one per clause ('net:10.0.0.0/8', 'port:53', 'proto:6')
+#                             protocols are indexed by number: 'tcp' and 'ip proto 6' are both 'proto:6'
+#   Docket.Index.id.<id>      the clause keys an id was added to, so it can be removed
+#   Docket.Index.nets         the net clauses that have ids, so subsets() can find the nets holding a query's addresses
+#   Docket.Index.bare         ids of queries with time clauses only: they cover any query in their window
+from uuid import uuid4
+import re
+
+from config import Config
+from common.pcapfilter import PROTOCOLS
+
+_PREFIX = 'Docket.Index.'
+_TIME = _PREFIX + 'time'
+_BUILT = _PREFIX + 'built'
+_NETS = _PREFIX + 'nets'
+_BARE = _PREFIX + 'bare'
+# indexes built before _NETS, _BARE and protocol numbers are rebuilt
+_VERSION = '3'
+
+_CLAUSE_RX = re.compile(r'^(host|net|port|ip proto) (\S+)$|^(tcp|udp|icmp)$')
+
+
+def parse_clauses(query):
+    """ stenographer query string -> a list of indexable clauses
+        'host 1.2.3.4 and tcp and port 53 and after ...' -> ['host:1.2.3.4', 'proto:6', 'port:53']
+        Time clauses, and anything but simple clauses joined by 'and' (or, parentheses...), aren't indexed
+    """
+    clauses = []
+    for clause in (query or '').split(' and '):
+        m = _CLAUSE_RX.match(clause.strip())
+        if not m:
+            continue
+        if m.group(3):
+            clause = 'proto:{}'.format(PROTOCOLS[m.group(3)])
+        else:
+            clause = '{}:{}'.format('proto' if m.group(1) == 'ip proto' else m.group(1), m.group(2))
+        if clause not in clauses:
+            clauses.append(clause)
+    return clauses
+
+
+def _bare(query):
+    """ True if query has time clauses only (or none) """
+    return all(c.strip().startswith(('after ', 'before ')) for c in (query or '').split(' and ') if c.strip())
+
+
+def field_clauses(fields):
+    """ find() fields (see parse_json, parse_uri) -> the clauses a matching query has """
+    def values(v):
+        return v if isinstance(v, (list, tuple)) else [v]
+    clauses = []
+    for key in ('host', 'net', 'port', 'proto'):
+        for v in values(fields.get(key) or []):
+            clauses.append('{}:{}'.format(key, int(v) if key in ('port', 'proto') else v))
+    name = (fields.get('proto-name') or '').lower()
+    if name in PROTOCOLS and 'proto:{}'.format(PROTOCOLS[name]) not in clauses:
+        clauses.append('proto:{}'.format(PROTOCOLS[name]))
+    return clauses
+
+
+def add(q_id, query, requested, pipe=None):
+    """ index q_id, requested is an epoch. Pass a pipeline to batch several """
+    r = pipe or Config.redis().pipeline()
+    clauses = parse_clauses(query)
+    keys = [_PREFIX + c for c in clauses]
+    r.zadd(_TIME, **{q_id: requested})
+    for key in keys:
+        r.sadd(key, q_id)
+    if keys:
+        r.sadd(_PREFIX + 'id.' + q_id, *keys)
+    elif _bare(query):
+        r.sadd(_BARE, q_id)
+    nets = [c for c in clauses if c.startswith('net:')]
+    if nets:
+        r.sadd(_NETS, *nets)
+    if pipe is None:
+        r.execute()
+
+
+def remove(q_ids):
+    r = Config.redis()
+    if not r or not q_ids:
+        return
+    pipe = r.pipeline()
+    for q_id in q_ids:
+        pipe.smembers(_PREFIX + 'id.' + q_id)
+    keys = pipe.execute()
+    for q_id, clause_keys in zip(q_ids, keys):
+        for key in clause_keys:
+            pipe.srem(key, q_id)
+        pipe.zrem(_TIME, q_id)
+        pipe.srem(_BARE, q_id)
+        pipe.delete(_PREFIX + 'id.' + q_id)
+    pipe.execute()
+    # nets no query has any more (redis deletes empty sets)
+    nets = sorted(set(k for clause_keys in keys for k in clause_keys if k.startswith(_PREFIX + 'net:')))
+    for key in nets:
+        pipe.exists(key)
+    gone = [key[len(_PREFIX):] for key, exists in zip(nets, pipe.execute()) if not exists]
+    if gone:
+        r.srem(_NETS, *gone)
+
+
+def search(clauses, after=None, before=None, limit=None, cursor=0):
+    """ ids having every clause, requested between after and before (epochs), newest first
+        returns (ids, cursor): pass cursor back for the next 'limit' ids, it's None after the last page
+    """
+    r = Config.redis()
+    high = before if before is not None else '+inf'
+    low = after if after is not None else '-inf'
+    page = (cursor, limit) if limit else (None, None)
+    if clauses:
+        # scores come from the time index only (the sets' weight is 0)
+        tmp = _PREFIX + 'search.' + uuid4().hex
+        pipe = r.pipeline()
+        pipe.zinterstore(tmp, dict([(_TIME, 1)] + [(_PREFIX + c, 0) for c in clauses]))
+        pipe.zrevrangebyscore(tmp, high, low, *page)
+        pipe.delete(tmp)
+        ids = pipe.execute()[1]
+    else:
+        ids = r.zrevrangebyscore(_TIME, high, low, *page)
+    if not limit:
+        ids = ids[cursor:]
+    return ids, (cursor + len(ids) if limit and len(ids) == limit else None)
+
+
+def subsets(clauses, requested_after, contains=None):
+    """ ids requested after requested_after (an epoch) having some of clauses and no others, newest first.
+        Queries with time clauses only have none of them: they're found too, even for a query without clauses
+        contains(net) - True if an indexed net (a value like '10.0.0.0/8') holds one of the query's hosts or nets:
+                        those nets count as clauses of the query too
+    """
+    r = Config.redis()
+    if contains:
+        clauses = clauses + [c for c in r.smembers(_NETS) if c not in clauses and contains(c.split(':', 1)[1])]
+    union, found = [_PREFIX + 'search.' + uuid4().hex for _ in range(2)]
+    pipe = r.pipeline()
+    pipe.sunionstore(union, _BARE, *[_PREFIX + c for c in clauses])
+    pipe.zinterstore(found, {_TIME: 1, union: 0})
+    pipe.zrevrangebyscore(found, '+inf', requested_after)
+    pipe.delete(union, found)
+    ids = pipe.execute()[2]
+    for q_id in ids:
+        pipe.smembers(_PREFIX + 'id.' + q_id)
+    keys = set(_PREFIX + c for c in clauses)
+    return [q_id for q_id, clause_keys in zip(ids, pipe.execute()) if clause_keys <= keys]
+
+
+def built():
+    return Config.redis().get(_BUILT) == _VERSION
+
+
+def rebuild(queries):
+    """ index every (q_id, query, requested) in queries """
+    pipe = Config.redis().pipeline()
+    for q_id, query, requested in queries:
+        add(q_id, query, requested, pipe=pipe)
+    pipe.set(_BUILT, _VERSION)
+    pipe.execute()
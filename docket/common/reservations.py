@@ -0,0 +1,219 @@
+##
+## Copyright (c) 2017, 2018 RockNSM.
+##
+## This file is part of RockNSM
+## (see http://rocknsm.io).
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##   http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing,
+## software distributed under the License is distributed on an
+## "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+## KIND, either express or implied.  See the License for the
+## specific language governing permissions and limitations
+## under the License.
+##
+##
+# SpaceLedger - spool space promised to accepted queries that haven't written their results yet.
+#   A query is admitted if its predicted size fits in free space minus everyone else's reservations.
+#   Its reservation shrinks as results arrive, and is dropped once they're merged.
+#   Predictions scale the WEIGHTS estimate by how results have compared to their estimates so far.
+#   In redis: a hash of id -> [bytes, updated] (Docket.Reservations) and one of observations
+#   Without redis: a file per reservation (its mtime is 'updated'), admission holds an flock()
+from datetime import datetime
+from fcntl import flock, LOCK_EX, LOCK_UN
+from json import dumps, loads
+from time import time
+import errno
+import os
+
+from config import Config
+
+_REDIS_KEY = 'Docket.Reservations'
+_OBSERVED = _REDIS_KEY + '.observed'
+
+ADMITTED = 'admitted'
+QUEUED = 'queued'
+REJECTED = 'rejected'
+
+# how much each finished query moves the observed averages
+_OBSERVE_WEIGHT = 0.2
+# seconds between attempts to reserve space for a queued query
+RESERVE_POLL = 1.0
+
+
+class SpaceLedger(object):
+    """ ledger = SpaceLedger(path, default, timeout)
+            path - directory of reservation files, used without redis
+            default - bytes to predict for queries without an estimate, until some have finished
+            timeout - seconds: a reservation that isn't updated for this long was abandoned
+        ledger.predict(estimate)                bytes a query will need, estimate is bytes or None
+        ledger.admit(q_id, size, available)     ADMITTED (reserved), QUEUED (fits once others release) or REJECTED
+        ledger.acquire(q_id, size, available, deadline, cancel)
+                                                blocks until q_id is admitted, the deadline passes, or cancel is set
+        ledger.update(q_id, size)               bytes q_id still needs, 0 releases it
+        ledger.observe(estimate, size)          a query estimated at 'estimate' produced 'size' bytes
+        ledger.outstanding()                    total bytes reserved
+    """
+    def __init__(self, path, default, timeout):
+        self.path = path
+        self.default = default
+        self.timeout = timeout
+
+    def predict(self, estimate):
+        observed = self._observed()
+        if estimate is not None:
+            return int(estimate * observed.get('ratio', 1.0))
+        return int(observed.get('size', self.default))
+
+    def _observed(self):
+        r = Config.redis()
+        if r:
+            return {k: float(v) for k, v in r.hgetall(_OBSERVED).items()}
+        try:
+            with open(os.path.join(self.path, '.observed'), 'rb') as f:
+                return loads(f.read())
+        except (IOError, ValueError):
+            return {}
+
+    def observe(self, estimate, size):
+        """ update the running averages, a lost race between workers only loses an observation """
+        observed = self._observed()
+        def average(key, value, initial):
+            old = observed.get(key, initial)
+            observed[key] = old + _OBSERVE_WEIGHT * (value - old)
+        average('size', size, self.default)
+        if estimate:
+            average('ratio', float(size) / estimate, 1.0)
+
+        r = Config.redis()
+        if r:
+            r.hmset(_OBSERVED, observed)
+            return
+        self._makedirs()
+        path = os.path.join(self.path, '.observed')
+        with open(path + '.tmp', 'wb') as f:
+            f.write(dumps(observed))
+        os.rename(path + '.tmp', path)
+
+    def admit(self, q_id, size, available):
+        """ reserve size bytes for q_id if they fit in available (free bytes we're allowed to use) """
+        def decide(reserved):
+            if q_id in reserved or size <= available - sum(reserved.values()):
+                return ADMITTED
+            return QUEUED if size <= available else REJECTED
+
+        r = Config.redis()
+        if r:
+            def reserve(pipe):
+                reserved, stale = self._read_redis(pipe)
+                decision = decide(reserved)
+                pipe.multi()
+                if stale:
+                    pipe.hdel(_REDIS_KEY, *stale)
+                if decision == ADMITTED and q_id not in reserved:
+                    pipe.hset(_REDIS_KEY, q_id, dumps([size, time()]))
+                return decision
+            return r.transaction(reserve, _REDIS_KEY, value_from_callable=True)
+
+        self._makedirs()
+        with open(os.path.join(self.path, '.lock'), 'a') as lock:
+            flock(lock, LOCK_EX)
+            try:
+                decision = decide(self._read_files())
+                if decision == ADMITTED:
+                    self._write_file(q_id, size)
+                return decision
+            finally:
+                flock(lock, LOCK_UN)
+
+    def acquire(self, q_id, size, available, deadline, cancel):
+        """ available - returns the free bytes we're allowed to use, asked before every attempt
+            deadline - a utc datetime, cancel - a threading.Event
+        """
+        while self.admit(q_id, size, available()) != ADMITTED:
+            remaining = (deadline - datetime.utcnow()).total_seconds()
+            if remaining <= 0 or cancel.wait(min(RESERVE_POLL, remaining)):
+                return False
+        return True
+
+    def update(self, q_id, size):
+        r = Config.redis()
+        if r:
+            if size > 0:
+                r.hset(_REDIS_KEY, q_id, dumps([size, time()]))
+            else:
+                r.hdel(_REDIS_KEY, q_id)
+        elif size > 0:
+            self._makedirs()
+            self._write_file(q_id, size)
+        else:
+            try:
+                os.remove(os.path.join(self.path, q_id))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def reserved(self, q_id):
+        """ bytes reserved for q_id, None if it has no reservation """
+        r = Config.redis()
+        reserved = self._read_redis(r)[0] if r else self._read_files()
+        return reserved.get(q_id)
+
+    def outstanding(self):
+        r = Config.redis()
+        return sum((self._read_redis(r)[0] if r else self._read_files()).values())
+
+    def _read_redis(self, r):
+        """ ({id: bytes}, [stale ids]) """
+        reserved, stale = {}, []
+        abandoned = time() - self.timeout
+        for q_id, value in r.hgetall(_REDIS_KEY).items():
+            size, updated = loads(value)
+            if updated < abandoned:
+                stale.append(q_id)
+            else:
+                reserved[q_id] = size
+        return reserved, stale
+
+    def _read_files(self):
+        """ {id: bytes}, removes abandoned reservations """
+        reserved = {}
+        abandoned = time() - self.timeout
+        try:
+            names = os.listdir(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return reserved
+        for q_id in names:
+            if q_id[0] == '.':
+                continue
+            path = os.path.join(self.path, q_id)
+            try:
+                if os.path.getmtime(path) < abandoned:
+                    os.remove(path)
+                    continue
+                with open(path, 'rb') as f:
+                    reserved[q_id] = int(f.read() or 0)
+            except (OSError, IOError):
+                continue        # released while we looked
+        return reserved
+
+    def _write_file(self, q_id, size):
+        tmp = os.path.join(self.path, '.' + q_id)
+        with open(tmp, 'wb') as f:
+            f.write(str(int(size)))
+        os.rename(tmp, os.path.join(self.path, q_id))
+
+    def _makedirs(self):
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
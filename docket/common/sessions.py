@@ -0,0 +1,113 @@
+##
+## Copyright (c) 2017, 2018 RockNSM.
+##
+## This file is part of RockNSM
+## (see http://rocknsm.io).
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##   http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing,
+## software distributed under the License is distributed on an
+## "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+## KIND, either express or implied.  See the License for the
+## specific language governing permissions and limitations
+## under the License.
+##
+##
+# SessionPool - keep-alive mTLS sessions for stenographer instances, kept for the life of the process.
+#   Every stats poll and query used to pay for a TCP connection and a TLS handshake with client certs,
+#   pooled sessions reuse connections. Requests and the handshakes actually needed are counted in the
+#   shared metrics (docket_sensor_requests_total, docket_sensor_connections_total), so every process adds up.
+from threading import Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connection import VerifiedHTTPSConnection
+from requests.packages.urllib3.connectionpool import HTTPSConnectionPool
+from requests.packages.urllib3.util.retry import Retry
+
+
+class _KeepAliveAdapter(HTTPAdapter):
+    """ on_connect() is called for every TLS connection its pools open """
+    def __init__(self, on_connect, **kwargs):
+        self.on_connect = on_connect
+        HTTPAdapter.__init__(self, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        on_connect = self.on_connect
+        class CountingConnection(VerifiedHTTPSConnection):
+            def connect(self):
+                on_connect()
+                return VerifiedHTTPSConnection.connect(self)
+        class CountingPool(HTTPSConnectionPool):
+            ConnectionCls = CountingConnection
+        self.poolmanager.pool_classes_by_scheme = dict(self.poolmanager.pool_classes_by_scheme,
+                                                       https=CountingPool)
+
+
+class SessionPool(object):
+    """ sessions = SessionPool(metrics, pool_size=4, retries=2)
+        sessions.get(instance).post(url, ...)   a session with the instance's client cert and CA
+        sessions.reset(instance)                the next requests use new connections, requests
+                                                already using the old ones finish on them
+        sessions.counters(instances)            { sensor: {requests, handshakes, handshakes_avoided} } of every process
+    """
+    def __init__(self, metrics, pool_size=4, retries=2):
+        self.metrics = metrics
+        self.pool_size = pool_size
+        self.retries = retries
+        self._sessions = {}
+        self._lock = Lock()
+
+    def _new_session(self, instance):
+        session = requests.Session()
+        session.cert = (instance['cert'], instance['key'])
+        session.verify = instance['ca']
+        # retry failed connects only, stenographer queries aren't safe to resend once sent
+        sensor = instance['sensor']
+        adapter = _KeepAliveAdapter(lambda: self.metrics.inc('docket_sensor_connections_total', sensor=sensor),
+                                    pool_connections=1, pool_maxsize=self.pool_size,
+                                    max_retries=Retry(total=self.retries, connect=self.retries,
+                                                      read=0, redirect=0))
+        session.mount('https://', adapter)
+
+        def count(response, *args, **kwargs):
+            self.metrics.inc('docket_sensor_requests_total', sensor=sensor)
+        session.hooks['response'].append(count)
+        return session
+
+    def get(self, instance):
+        sensor = instance['sensor']
+        session = self._sessions.get(sensor)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(sensor)
+                if session is None:
+                    session = self._sessions[sensor] = self._new_session(instance)
+        return session
+
+    def reset(self, instance):
+        """ replace an instance's session after a failure. Other threads may still be using the old one:
+            it isn't closed, its connections go when the last of them lets go of it
+        """
+        with self._lock:
+            if instance['sensor'] in self._sessions:
+                self._sessions[instance['sensor']] = self._new_session(instance)
+
+    def counters(self, instances):
+        sensors = [instance['sensor'] for instance in instances]
+        totals = self.metrics.totals([(name, {'sensor': sensor}) for sensor in sensors
+                                      for name in ('docket_sensor_requests_total', 'docket_sensor_connections_total')])
+        counts = {}
+        for sensor, made, handshakes in zip(sensors, totals[::2], totals[1::2]):
+            counts[sensor] = {
+                'requests': int(made),
+                'handshakes': int(handshakes),
+                'handshakes_avoided': int(max(made - handshakes, 0)),
+            }
+        return counts
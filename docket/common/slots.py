@@ -0,0 +1,169 @@
+##
+## Copyright (c) 2017, 2018 RockNSM.
+##
+## This file is part of RockNSM
+## (see http://rocknsm.io).
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##   http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing,
+## software distributed under the License is distributed on an
+## "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+## KIND, either express or implied.  See the License for the
+## specific language governing permissions and limitations
+## under the License.
+##
+##
+# SensorSlot - admission control for stenographer instances shared by every worker process.
+#   Each instance has 'limit' slots, a slot is an flock()ed file: it's released when
+#   the holder releases it, or when the holder dies - no stale counters to clean up.
+#   With priority lanes (see LANE_FAST_BYTES) bulk requests leave 'reserved' slots to fast ones, and a bulk
+#   request that has waited 'starve' seconds marks the sensor starving (<sensor>.starving, touched while it waits):
+#   fast requests keep to the reserved slots until it's gone or stale. An instance with no slot to reserve is shared.
+#   Bulk holders also share an flock() on <sensor>.bulk, so anyone can tell whether a bulk request is running.
+from datetime import datetime
+from time import time
+from fcntl import flock, LOCK_EX, LOCK_SH, LOCK_NB, LOCK_UN
+import errno
+import os
+
+# seconds between attempts to take a slot while all of them are busy
+SLOT_POLL = 0.5
+# a starving marker that isn't touched for this long was left by a request that died
+STARVING_STALE = 10 * SLOT_POLL
+
+FAST = 'fast'
+BULK = 'bulk'
+
+
+class SensorSlot(object):
+    """ slot = SensorSlot(path, 'sensor-1', limit=2, lane=None, reserved=1, starve=60)
+            lane - FAST, BULK or None (no lanes: every slot is shared)
+            reserved - slots BULK requests leave to FAST ones, they keep one at least
+            starve - seconds a BULK request waits before FAST ones make way for it
+        if slot.acquire(deadline, cancel):  blocks until a slot is free, the deadline passes, or cancel is set
+            ...
+            slot.release()
+        slot.bulk_running()                 True while a BULK request holds one of the sensor's slots
+    """
+    def __init__(self, path, sensor, limit=1, lane=None, reserved=1, starve=60):
+        self.path = path
+        self.sensor = sensor
+        self.limit = max(int(limit), 1)
+        self.lane = lane
+        self.reserved = max(int(reserved), 0)
+        self.starve = starve
+        self._held = None
+        self._bulk = None
+        self._starving = False
+
+    def _slot_path(self, i):
+        return os.path.join(self.path, '{}.{}'.format(self.sensor, i))
+
+    def _starving_path(self):
+        return os.path.join(self.path, '{}.starving'.format(self.sensor))
+
+    def _bulk_path(self):
+        return os.path.join(self.path, '{}.bulk'.format(self.sensor))
+
+    def bulk_running(self):
+        """ a BULK holder keeps a shared lock on <sensor>.bulk: if we can't lock it exclusively, one is running """
+        if self._bulk is not None:
+            return True
+        try:
+            f = open(self._bulk_path(), 'a')
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False        # no slot directory yet: nothing is running
+        try:
+            flock(f, LOCK_EX | LOCK_NB)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return True
+        finally:
+            f.close()
+        return False
+
+    def _slots(self):
+        """ the slots this lane may take now """
+        if self.lane is None:
+            return range(self.limit)
+        bulk = max(self.limit - self.reserved, 1)
+        if self.lane == BULK:
+            return range(bulk)
+        try:
+            starving = time() - os.path.getmtime(self._starving_path()) < STARVING_STALE
+        except OSError:
+            starving = False
+        # with no slot to spare (limit 1) the lanes share it: fast requests are never shut out
+        return (starving and range(bulk, self.limit)) or range(self.limit)
+
+    def _starve(self, starving):
+        """ mark (touch) or unmark the sensor starving for BULK requests """
+        try:
+            if starving:
+                with open(self._starving_path(), 'a'):
+                    os.utime(self._starving_path(), None)
+            elif self._starving:
+                os.remove(self._starving_path())
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        self._starving = starving
+
+    def try_acquire(self):
+        """ take a free slot without waiting, returns True if we got one """
+        if self._held is not None:
+            return True
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        for i in self._slots():
+            f = open(self._slot_path(i), 'a')
+            try:
+                flock(f, LOCK_EX | LOCK_NB)
+            except IOError as e:
+                f.close()
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                continue
+            self._held = f
+            if self.lane == BULK:
+                # blocks only while someone checks bulk_running()
+                self._bulk = open(self._bulk_path(), 'a')
+                flock(self._bulk, LOCK_SH)
+            return True
+        return False
+
+    def acquire(self, deadline, cancel):
+        """ deadline - a utc datetime, cancel - a threading.Event """
+        waiting = time()
+        try:
+            while not self.try_acquire():
+                if self.lane == BULK and time() - waiting >= self.starve:
+                    self._starve(True)
+                remaining = (deadline - datetime.utcnow()).total_seconds()
+                if remaining <= 0 or cancel.wait(min(SLOT_POLL, remaining)):
+                    return False
+            return True
+        finally:
+            self._starve(False)
+
+    def release(self):
+        if self._bulk is not None:
+            flock(self._bulk, LOCK_UN)
+            self._bulk.close()
+            self._bulk = None
+        if self._held is not None:
+            flock(self._held, LOCK_UN)
+            self._held.close()
+            self._held = None
@@ -0,0 +1,205 @@
+##
+## Copyright (c) 2017, 2018 RockNSM.
+##
+## This file is part of RockNSM
+## (see http://rocknsm.io).
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##   http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing,
+## software distributed under the License is distributed on an
+## "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+## KIND, either express or implied.  See the License for the
+## specific language governing permissions and limitations
+## under the License.
+##
+##
+# StatsCache - stenographer stats shared by every docket process.
+#   One collector (elected through a redis lock) polls every instance in parallel and
+#   publishes timestamped results. The web, query workers and idle checks read the cache.
+#   Without redis the collector holds an flock() on <path>.lock and publishes to <path>:
+#   the other processes only try the lock once a period, so one of them takes over if it dies.
+from threading import Thread, Lock, Event, current_thread
+from fcntl import flock, LOCK_EX, LOCK_NB, LOCK_UN
+from socket import gethostname
+from time import time
+from json import dump, dumps, load, loads
+import errno
+import os
+
+from config import Config
+
+_REDIS_KEY = 'Docket.Stats'
+_REDIS_LOCK = 'Docket.Stats.collector'
+
+
+class StatsCache(object):
+    """ cache = StatsCache(poll, sensors, period=2.0, timeout=3.0, on_sample=None, path=None)
+            poll(sensor) returns a stats dict or an error string, it's called from collector threads
+            on_sample(sensor, sampled, stats) is fed by the elected collector's periodic polls only:
+                it runs in that one process, refreshes made by read() don't reach it
+            path - the shared cache file without redis (None: each process keeps its own cache)
+        cache.read(sensors, max_age)    { sensor: (sampled epoch, stats) }
+            anything missing or older than max_age seconds is polled before returning
+        cache.stop()                    stop this process's collector and give up the lead
+    """
+    def __init__(self, poll, sensors, period=2.0, timeout=3.0, on_sample=None, path=None):
+        self.poll = poll
+        self.on_sample = on_sample
+        self.sensors = list(sensors)
+        self.period = period
+        self.timeout = timeout
+        self.path = path
+        self._local = {}
+        self._lock = Lock()
+        self._stop = Event()
+        self._pid = None
+        self._ident = None
+        self._held = None
+
+    def start(self):
+        """ start this process's collector (once per process: threads don't survive a fork) """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._ident = '{}:{}'.format(gethostname(), self._pid)
+            if self._held:
+                # the parent's lock: closing this copy (without LOCK_UN) leaves the parent leading
+                self._held.close()
+                self._held = None
+            self._stop = Event()
+            thread = Thread(target=self._run, args=(self._stop,), name='stats-collector')
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        with self._lock:
+            self._stop.set()
+            self._pid = None
+            if self._held:
+                flock(self._held, LOCK_UN)
+                self._held.close()
+                self._held = None
+        r = Config.redis()
+        if r and self._ident and r.get(_REDIS_LOCK) == self._ident:
+            r.delete(_REDIS_LOCK)
+
+    def _run(self, stop):
+        while not stop.is_set():
+            try:
+                if self._lead(stop):
+                    results = self.collect()
+                    if self.on_sample:
+                        for sensor, (sampled, data) in results.items():
+                            self.on_sample(sensor, sampled, data)
+            except Exception as e:
+                Config.logger.error("Stats collector: {}".format(e))
+            stop.wait(self.period)
+
+    def _lead(self, stop):
+        """ True if this process is the collector. The lock expires (or is released) if the collector dies. """
+        r = Config.redis()
+        if not r:
+            return self._lead_file(stop)
+        ttl = int(self.period * 3) + 1
+        if r.set(_REDIS_LOCK, self._ident, nx=True, ex=ttl):
+            return True
+        if r.get(_REDIS_LOCK) == self._ident:
+            r.expire(_REDIS_LOCK, ttl)
+            return True
+        return False
+
+    def _lead_file(self, stop):
+        if not self.path or self._held:
+            return True
+        f = self._open(self.path + '.lock', 'a')
+        try:
+            flock(f, LOCK_EX | LOCK_NB)
+        except IOError as e:
+            f.close()
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return False
+        with self._lock:
+            if stop.is_set():
+                f.close()
+                return False
+            self._held = f
+        return True
+
+    def collect(self, sensors=None):
+        """ poll sensors (default: all) in parallel and publish their stats """
+        results = {}
+        def poll(sensor):
+            results[sensor] = (time(), self.poll(sensor))
+        threads = [Thread(target=poll, args=(s,)) for s in (sensors or self.sensors)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join(self.timeout + 1)
+        self.publish(results)
+        return results
+
+    def publish(self, results):
+        if not results:
+            return
+        r = Config.redis()
+        if r:
+            r.hmset(_REDIS_KEY, {s: dumps(v) for s, v in results.items()})
+        elif self.path:
+            # a refresh and the collector may publish together (from one process too): each keeps the
+            # newest sample, and writes its own temporary file
+            cached = self._load()
+            cached.update((s, v) for s, v in results.items() if v[0] >= cached.get(s, (0,))[0])
+            tmp = '{}.{}.{}.tmp'.format(self.path, os.getpid(), current_thread().ident)
+            with self._open(tmp, 'w') as f:
+                dump(cached, f)
+            os.rename(tmp, self.path)
+        else:
+            self._local.update(results)
+
+    def _open(self, path, mode):
+        try:
+            return open(path, mode)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            return open(path, mode)
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return {s: tuple(v) for s, v in load(f).items()}
+        except (IOError, ValueError):
+            return {}
+
+    def read(self, sensors=None, max_age=None):
+        self.start()
+        sensors = list(sensors or self.sensors)
+        r = Config.redis()
+        if r:
+            cached = {s: tuple(loads(v)) for s, v in zip(sensors, r.hmget(_REDIS_KEY, sensors)) if v}
+        elif self.path:
+            cached = {s: v for s, v in self._load().items() if s in sensors}
+        else:
+            cached = {s: self._local[s] for s in sensors if s in self._local}
+
+        if max_age is not None:
+            now = time()
+            stale = [s for s in sensors if s not in cached or now - cached[s][0] > max_age]
+            if stale:
+                cached.update(self.collect(stale))
+        return cached
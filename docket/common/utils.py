@@ -236,6 +236,10 @@ def space_low():
         return "Low on FileSystem Nodes: {} free".format(space.nodes)
     return False
 
+def space_available():
+    """ bytes that can be written to SPOOL_DIR before space_low() complains """
+    return spool_space().bytes - parse_capacity(Config.get('FREE_BYTES', '100MB'))
+
 def validate_ip(ip):
     """ return a tuple (string, AF_INET) for valid IP addresses
         raise an exception for bad addresses
@@ -21,12 +21,14 @@
 # Query - A Class for tracking queries through the process and interfacing with them
 # QueryRequest - implements Flask Restful to fill requests with formatted data
 from collections import namedtuple
+from numbers import Integral
 from datetime import datetime, timedelta
+from time import sleep
 import re
 import os
 
 from werkzeug.exceptions import BadRequest
-from flask import jsonify, request, render_template, Response, make_response
+from flask import jsonify, request, render_template, Response, make_response, send_file
 from flask_restful import Resource, inputs, reqparse
 from json import dumps
 import yaml
@@ -34,7 +36,18 @@ import redis
 
 from common.utils import parse_duration, parse_capacity, file_modified, ISOFORMAT \
         , recurse_update, md5, validate_ip, validate_net, readdir, spool_space \
-        , epoch, from_epoch, write_yaml, update_yaml, space_low, is_str, is_sequence
+        , epoch, from_epoch, space_low, space_available, is_str, is_sequence
+from common.catalog import SpoolCatalog
+from common.reservations import SpaceLedger, REJECTED
+from common.eventlog import EventLog
+from common import queryindex
+from common.pcapfilter import PacketFilter
+from common.frames import FramedReader
+from common.metrics import MetricsRegistry
+from common.slots import FAST, BULK
+from common.profiling import Profiler
+from common.pcap import PcapReader, PcapError, StreamMerger, global_header, \
+        MAX_SNAPLEN, FOLLOW_SLEEP, GLOBAL_HEADER
 from config import Config
 
 RequestInfo = namedtuple('RequestInfo', ['ip', 'port', 'agent'])
@@ -42,15 +55,62 @@ Event = namedtuple('Event', ['datetime', 'name', 'msg', 'state'])
 Result = namedtuple('Result', ['datetime', 'name', 'msg', 'state', 'value'])
 
 _REDIS_PREFIX = 'Docket.Query.'
+_EPOCH = datetime(1970, 1, 1)
+
+# Query metadata schema: the event log's state and records (see common/eventlog.py) are JSON.
+# Bump SCHEMA_VERSION when this changes, and keep reading the previous version.
+#   state   {"v": 1, "query": string, "state": string or null}
+#   Event   [time, name, msg, state]            time - microseconds since the epoch (UTC)
+#   Result  [time, name, msg, state, value]     value - an integer (bytes received, -HTTP status)
+SCHEMA_VERSION = 1
 _DATE_FORMAT = Config.get('DATE_FORMAT', "%Y-%m-%dT%H:%M:%S")
 _INSTANCES = Config.get('STENOGRAPHER_INSTANCES')
 _SENSORS = []
+# what's in SPOOL_DIR: updated as queries progress and expire
+CATALOG = SpoolCatalog(os.path.join(Config.get('SPOOL_DIR'), '.catalog'))
+# RESERVE_DEFAULT - 50MB, space reserved for a query WEIGHTS can't estimate, until queries have finished:
+#                   then it's their average size
+# RESERVE_TIMEOUT - 2h, a reservation that isn't updated for this long is dropped (its worker died)
+SPACE = SpaceLedger(os.path.join(Config.get('SPOOL_DIR'), '.reserved'),
+                    default=parse_capacity(Config.setdefault('RESERVE_DEFAULT', '50MB')),
+                    timeout=parse_duration(Config.setdefault('RESERVE_TIMEOUT', '2h')).total_seconds())
+
+# METRICS_FLUSH - 5.0, seconds each process keeps its metrics before adding them to the shared totals
+METRICS = MetricsRegistry(os.path.join(Config.get('SPOOL_DIR'), '.metrics'),
+                          flush=Config.setdefault('METRICS_FLUSH', 5.0, minval=0))
+
+# LANE_FAST_BYTES - none, priority lanes: queries predicted to return more than this (WEIGHTS' estimate, scaled by
+#                   how results compared to estimates so far) go to the 'bulk' queue and its workers,
+#                   the rest to the 'query' queue. Unset: every query goes to 'query'
+_LANE_FAST_BYTES = parse_capacity(Config.get('LANE_FAST_BYTES')) if Config.get('LANE_FAST_BYTES') else None
+LANE_QUEUES = {FAST: 'query', BULK: 'bulk'}
+
+# PROFILE_RATE     - 0.0, fraction of API requests and task runs (query_task, merge, refine, cleanup) profiled
+# PROFILE_TOKEN    - none, requests with the header 'X-Docket-Profile: <token>' are profiled, and the tasks they queue
+# PROFILE_DIR      - 'docket-profiles' beside SPOOL_DIR, where profiles are written (GET /api/profiles/)
+# PROFILE_MODE     - 'sample', folded stacks for flamegraphs, or 'cprofile', pstats of the calling thread
+# PROFILE_INTERVAL - 0.01, seconds between a sampling profile's stack samples
+# PROFILE_KEEP     - 100, profiles kept, the oldest are deleted
+PROFILER = Profiler(Config.setdefault('PROFILE_DIR', os.path.join(
+                        os.path.dirname(os.path.normpath(Config.get('SPOOL_DIR'))), 'docket-profiles')),
+                    rate=Config.setdefault('PROFILE_RATE', 0.0, minval=0),
+                    mode=Config.setdefault('PROFILE_MODE', 'sample'),
+                    interval=Config.setdefault('PROFILE_INTERVAL', 0.01, minval=0.001),
+                    keep=Config.setdefault('PROFILE_KEEP', 100, minval=1))
 
 for steno in _INSTANCES:
     steno['stats'] = {}
     _SENSORS.append(steno['sensor'])
 
 Config.setdefault('TIME_WINDOW', 60, minval=1)
+# STREAM_SKEW - 5.0, seconds a streamed sensor may lag before the others are sent without it
+STREAM_SKEW = Config.setdefault('STREAM_SKEW', 5.0, minval=0)
+# STREAM_WAIT - 60, seconds a stream waits for its (queued) query to start
+STREAM_WAIT = Config.setdefault('STREAM_WAIT', 60, minval=1)
+# results stored compressed (see tasks.COMPRESS_RESULTS) are MERGED_NAME.pcap + this
+COMPRESSED_SUFFIX = '.gz'
+# PAGE_SIZE - 100, jobs or statuses per response when the request has no limit, and the most a limit may ask for
+PAGE_SIZE = Config.setdefault('PAGE_SIZE', 100, minval=1)
 
 
 def enforce_time_window(time):
@@ -84,6 +144,22 @@ def json_serial(obj):
     raise TypeError("Type %s not serializable" % type(obj))
 
 
+class _LegacyLoader(yaml.SafeLoader):
+    """ reads query.yaml as written by yaml.dump(Query): python tags become plain data, nothing is imported or called """
+
+def _legacy_object(loader, suffix, node):
+    if isinstance(node, yaml.MappingNode):
+        value = loader.construct_mapping(node, deep=True)
+        # object/new in its long form: {args: [...], state: {...}}
+        return value.get('args', value) if suffix.endswith(('.Event', '.Result')) else value
+    return loader.construct_sequence(node, deep=True)
+
+_LegacyLoader.add_multi_constructor('tag:yaml.org,2002:python/object:', _legacy_object)
+_LegacyLoader.add_multi_constructor('tag:yaml.org,2002:python/object/new:', _legacy_object)
+_LegacyLoader.add_constructor('tag:yaml.org,2002:python/unicode', yaml.SafeLoader.construct_yaml_str)
+_LegacyLoader.add_constructor('tag:yaml.org,2002:python/str', yaml.SafeLoader.construct_yaml_str)
+
+
 class Query:
     """ Query               handles metadata and actions to process docket queries:
         q = Query(f)        creates a query from a dict of fields
@@ -132,6 +208,8 @@ class Query:
         self.state = None           # string: one of (RECEIVING, RECEIVED, MERGE, SUCCESS, ERROR, FAIL)
         self._id = None             # a hash of the normalized query string, uniquely identifies this query to prevent duplicates
         self.events = []            # a sorted list of events including errors... TODO FIX ME
+        self._saved = 0             # events[:_saved] are already in the event log
+        self._saved_state = None    # the state fields last written to the event log
 
         if qt:
             self._detupify(qt)
@@ -147,56 +225,141 @@ class Query:
 
     def load(self, path=None, q_id=None, from_file=False):
         """ query data, if no path is provided use the default (requires id)
-            path - ignore redis and read the file from the given path
-            from_file - ignore redis and read the file from disk
+            path - ignore redis and read the event log file at the given path
+            from_file - ignore redis and read the event log from disk
         """
         if path is not None:
             if os.path.exists(path):
-                return update_yaml(path, self) != False
+                state, records, _ = EventLog(None, path).read(from_file=True)
+                return self._apply(state, records)
             self.error('load', "No Such path {}".format(path))
             return False
-        elif Config.redis() and not from_file:
-            r = Config.redis()
-            key = _REDIS_PREFIX + (q_id or self.id)
-            old = r.get(key)
-            if old:
-                old = yaml.load(old)
-                self.update(old)
-                return True
         q_id = q_id or self.id
-        if q_id:
-            return update_yaml(Query.yaml_path_for_id(q_id), self) != False
-        raise Exception("Can't load a Query without an ID: {}".format(self))
+        if not q_id:
+            raise Exception("Can't load a Query without an ID: {}".format(self))
+
+        state, records, _ = Query.log_for_id(q_id).read(from_file=from_file)
+        if state or records:
+            self._id = q_id
+            return self._apply(state, records)
+        return self._migrate(q_id, from_file)
+
+    def _apply(self, state, records):
+        """ take the query's state and events from an event log """
+        if state.get('v', SCHEMA_VERSION) > SCHEMA_VERSION:
+            Config.logger.error("Query[{}] schema v{} is newer than v{}".format(self._id, state['v'], SCHEMA_VERSION))
+            return False
+        try:
+            loaded = sorted(Query.decode_event(rec) for rec in records)
+        except (ValueError, TypeError) as e:
+            Config.logger.error("Query[{}] bad event log: {}".format(self._id, e))
+            return False
+        self.query = state.get('query') or self.query
+        self.state = state.get('state') or self.state
+        unsaved = [e for e in self.events if e not in loaded]
+        self.events = loaded + unsaved
+        self._saved = len(loaded)
+        self._saved_state = (self.query, self.state)
+        return True
+
+    def _migrate(self, q_id, from_file=False):
+        """ read a query saved as yaml (before the event log) and rewrite it as an event log """
+        old = None
+        r = Config.redis()
+        if r and not from_file:
+            old = r.get(_REDIS_PREFIX + q_id)
+        if not old and os.path.exists(Query.yaml_path_for_id(q_id)):
+            with open(Query.yaml_path_for_id(q_id), 'rb') as f:
+                old = f.read()
+        if not old or not self.update(old):
+            return False
+        self._id = q_id
+        if os.path.isdir(self.job_path):
+            Config.logger.info("Query[{}] migrating to the event log".format(q_id))
+            self.save()
+            if r:
+                r.delete(_REDIS_PREFIX + q_id)
+        return True
 
     def save(self, path=None, q_id=None, to_file=False):
-        """ save this query to the default location, clobbering old values
+        """ append new events (and state changes) to the event log, cost doesn't grow with the event count
             path - write the query to the given file path and return True if successful. Overrides other keyargs
             to_file - ensure the file on disk is written, will also write to redis if configured
         """
         Config.logger.info("Query Save state:{}, Last Event:{}".format(self.state, self.events[-1]))
         if path is not None:
             if os.path.exists(path):
-                return write_yaml(path, self)
+                return EventLog(None, path).write([Query.encode_event(e) for e in self.events],
+                                                  self._state_record())
             self.error('load', "No Such path {}".format(path))
             return False
-        if Config.redis():
-            r = Config.redis()
-            key = _REDIS_PREFIX + self.id
-            r.set(key, yaml.dump(self))
-            if not to_file:
-                return True
         q_id = q_id or self.id
-        if q_id:
-            return write_yaml(Query.yaml_path_for_id(q_id), self)
-        Exception("Can't save Query {}".format(self))
+        if not q_id:
+            raise Exception("Can't save Query {}".format(self))
+
+        # other threads may append events while we write: only claim what we took
+        new = self.events[self._saved:]
+        state = None
+        if self._saved_state != (self.query, self.state):
+            state = self._state_record()
+        log = Query.log_for_id(q_id)
+        if not log.append([Query.encode_event(e) for e in new], state):
+            return False
+        if state and Config.redis() and (self._saved_state is None or self._saved_state[0] != self.query):
+            queryindex.add(q_id, self.query, epoch(self.queried))
+        if state and (self._saved_state is None or self._saved_state[1] != self.state):
+            CATALOG.update(q_id, state=self.state)
+        self._saved += len(new)
+        self._saved_state = (self.query, self.state)
+
+        if to_file and Config.redis():
+            return log.write([Query.encode_event(e) for e in self.events[:self._saved]],
+                             self._state_record())
+        return True
+
+    def _state_record(self):
+        return {'v': SCHEMA_VERSION, 'query': self.query, 'state': self.state}
+
+    @staticmethod
+    def encode_event(e):
+        """ Event or Result -> a JSON-able list for the event log """
+        delta = e.datetime - _EPOCH
+        usec = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+        return [usec] + list(e[1:])
+
+    @staticmethod
+    def decode_event(rec):
+        """ event log record -> Event or Result, raises ValueError if it doesn't match the schema """
+        if not isinstance(rec, list) or len(rec) not in (len(Event._fields), len(Result._fields)):
+            raise ValueError("not an event: {}".format(rec))
+        usec, name, msg, state = rec[:4]
+        if (not isinstance(usec, Integral) or not is_str(name)
+                or not (msg is None or is_str(msg)) or not (state is None or is_str(state))):
+            raise ValueError("not an event: {}".format(rec))
+        dt = _EPOCH + timedelta(microseconds=usec)
+        if len(rec) == len(Event._fields):
+            return Event(dt, name, msg, state)
+        if not (rec[4] is None or isinstance(rec[4], Integral)):
+            raise ValueError("not a result: {}".format(rec))
+        return Result(dt, name, msg, state, rec[4])
+
+    @staticmethod
+    def tail(q_id, cursor=0):
+        """ (state, events, cursor): q_id's events recorded after cursor (from a previous tail, or 0)
+            state holds the fields that changed, it's complete when reading from 0
+        """
+        state, records, cursor = Query.log_for_id(q_id).read(cursor)
+        return state, [Query.decode_event(rec) for rec in records], cursor
 
     def update(self, other):
         """ update self from other's data,
-            other can be a Query, dict, or yaml string.
+            other can be a Query, dict, or yaml string (as written by yaml.dump(Query) in older versions).
         """
         Config.logger.debug("updating: {} with {}".format(self, other))
         if type(other) is dict and other:
             Config.logger.debug("Dict update: {} with {}".format(self, other))
+            other = dict(other, events=[Query._legacy_event(e) for e in other.get('events') or []])
+            other = {k: v for k, v in other.items() if k in ('_id', 'query', 'state', 'events')}
             recurse_update(self.__dict__, other, ignore_none=True)
             self._fix_events()
             return True
@@ -205,10 +368,22 @@ class Query:
             recurse_update(self.__dict__, other.__dict__, ignore_none=True)
             self._fix_events()
             return True
-        elif type(other) is str:
-            return self.update(yaml.load(other))
+        elif is_str(other):
+            try:
+                return self.update(yaml.load(other, Loader=_LegacyLoader))
+            except yaml.YAMLError as e:
+                Config.logger.error("Query[{}] unreadable yaml: {}".format(self._id, e))
         return False
 
+    @staticmethod
+    def _legacy_event(e):
+        """ an event from legacy yaml: a namedtuple's arguments (or the namedtuple) """
+        if isinstance(e, (Event, Result)):
+            return e
+        if len(e) == len(Result._fields):
+            return Result(*e)
+        return Event(*e)
+
     def tupify(self):       # We can't queue an object. This is all the data we need to use queue in the celery worker
         """ Serializes the basic values used to define a query into a tuple """
         return Query.Tuple(self.query, self.queried.strftime(ISOFORMAT))
@@ -254,13 +429,19 @@ class Query:
         """ returns an ISO date (ordinal) - when the query was requested """
         return self.queried.strftime(_DATE_FORMAT)[:-3]
 
+    @classmethod
+    def log_for_id(cls, q_id):
+        """ the EventLog recording this query (redis when configured, and a file in the job directory) """
+        return EventLog(_REDIS_PREFIX + q_id,
+                        cls.job_path_for_id(q_id, Config.get('QUERY_FILE', 'query') + '.log'))
+
     @property
     def yaml_path(self):
         return Query.yaml_path_for_id(self.id)
 
     @classmethod
     def yaml_path_for_id(cls, q_id):
-        """  path used to record this query as yaml """
+        """  path used to record this query as yaml, before the event log """
         return cls.job_path_for_id(q_id, Config.get('QUERY_FILE', 'query') + '.yaml')
 
     def path(self, path):
@@ -400,10 +581,7 @@ class Query:
 
         # Check the request's 'weight'
         if Query.WEIGHTS['enabled'] and not q_fields.get('ignore-weight'):
-            req_weight = ( Query.WEIGHTS['total']
-                          * ((end-start).total_seconds() / (Query.WEIGHTS['hour'] * 3600) )
-                          / (sum((val * Query.WEIGHTS[k] for k, val in weights.items())) or 1)
-                         )
+            req_weight = Query._weigh((end-start).total_seconds(), weights)
             if req_weight > Query.WEIGHTS['limit']:
                 self.error('build_query',
                            "Request is too heavy: {}/{}:\t{}".format(req_weight,
@@ -430,51 +608,108 @@ class Query:
         #    self.sensors = q_fields['sensors']
         return self.id
 
+    @staticmethod
+    def _weigh(seconds, counts):
+        """ WEIGHTS: bytes expected from 'seconds' of capture, counts - {'ip','net','port': clauses} """
+        return ( Query.WEIGHTS['total']
+                * (seconds / (Query.WEIGHTS['hour'] * 3600) )
+                / (sum((val * Query.WEIGHTS[k] for k, val in counts.items())) or 1)
+               )
+
+    @staticmethod
+    def estimate(query):
+        """ bytes WEIGHTS expects a stenographer query string to return, None without a time window or WEIGHTS """
+        if not (Query.WEIGHTS['total'] and Query.WEIGHTS['hour']):
+            return None
+        window = re.search(r'\bafter (\S+) and before (\S+)', query or '')
+        if not window:
+            return None
+        try:
+            start, end = [datetime.strptime(t, ISOFORMAT) for t in window.groups()]
+        except ValueError:
+            return None
+        counts = {'ip': 0, 'net': 0, 'port': 0}
+        for clause in queryindex.parse_clauses(query):
+            kind = clause.split(':')[0]
+            if kind in ('host', 'net', 'port'):
+                counts['ip' if kind == 'host' else kind] += 1
+        return Query._weigh(max((end - start).total_seconds(), 0), counts)
+
     @classmethod
-    def find(cls, fields):
+    def find(cls, fields, limit=None, cursor=0):
+        """ queries matching fields (see parse_json), newest first: uses the redis query index
+            returns (list of query.json(), cursor for the next 'limit' results or None)
+        """
         r = Config.redis()
         if not r:
-            return []
-        results = []
-        ids = Query.get_unexpired()
+            return [], None
+        if not queryindex.built():
+            Config.logger.info("Building the query index")
+            queries = (Query(q_id=i) for i in Query.get_unexpired())
+            queryindex.rebuild((q.id, q.query, epoch(q.queried)) for q in queries if q.query)
+
+        after = before = None
+        for k in ('after-ago', 'after', 'before-ago', 'before'):
+            v = fields.get(k)
+            if not v:
+                continue
+            dur = parse_duration(v)
+            if dur:
+                v = datetime.utcnow() - dur
+            else:
+                v = inputs.datetime_from_iso8601(v).replace(tzinfo=None)
+            if k.startswith('after'):
+                after = epoch(v)
+            else:
+                before = epoch(v)
+
+        ids, cursor = queryindex.search(queryindex.field_clauses(fields), after, before, limit, cursor)
+        results, expired = [], []
+        found = Query.load_many([i for i in ids if os.path.isdir(Query.job_path_for_id(i))])
         for i in ids:
-            q = Query(q_id=i)
-            if not q.query:
-                # sometimes query meta data is incomplete, usually when I'm break^H^H^H^H^Htesting.
+            if i not in found:
+                expired.append(i)
+            elif found[i].query:
+                results.append(found[i].json())
+        queryindex.remove(expired)
+        return results, cursor
+
+    @staticmethod
+    def covering(query):
+        """ id of a completed query whose results hold every packet 'query' (a query string) asks for, or None.
+            It has a subset of the query's clauses (or nets holding its hosts and nets), its time window holds
+            the query's, and it was requested after the query's window ended (the sensors had those packets)
+        """
+        if not Config.redis() or not queryindex.built():
+            return None
+        try:
+            wanted = PacketFilter.parse(query)
+        except ValueError:
+            return None
+        if wanted.after is None or wanted.before is None:
+            return None
+        def contains(net):
+            try:
+                return PacketFilter.parse('net ' + net).covers(wanted)
+            except ValueError:
+                return False
+        ids = queryindex.subsets(queryindex.parse_clauses(query), wanted.before, contains)
+        completed = CATALOG.entries(ids)
+        # the smallest one is the quickest to filter
+        ids = sorted((i for i in ids if completed.get(i, {}).get('state') == Query.SUCCESS),
+                     key=lambda i: completed[i].get('size') or 0)
+        queries = Query.load_many(ids)
+        for q_id in ids:
+            try:
+                wider = PacketFilter.parse(queries[q_id].query)
+            except ValueError:
                 continue
-            for k,v in fields.items():
-                if k in ('after-ago', 'after', 'before-ago', 'before'):
-                    dur = parse_duration(v)
-                    if dur:
-                        v = (datetime.utcnow() - dur)
-                    else:
-                        v = inputs.datetime_from_iso8601(v)
-                        pass
-                    if (q.queried < v) and k in ('after-ago', 'after'):
-                        q = None
-                        break
-                    elif (q.queried > v) and k in ('before-ago', 'before'):
-                        q = None
-                        break
-                    pass
-                elif k in ('sensors', 'limit-packets', 'limit-bytes'):
-                    continue
-                elif k not in q.query:
-                    Config.logger.info("Skipping: {} - {}".format(q.query, k))
-                    q = None
-                    break
-                else:
-                    if is_sequence(v) and v != [vi for vi in v if q.query.find(vi) >= 0]:
-                        Config.logger.info("Skipping: {} - {}".format(q.query, v))
-                        q = None
-                        break
-                    elif is_str(v) and v not in q.query:
-                        Config.logger.info("Skipping: {} - {}".format(q.query, v))
-                        q = None
-                        break
-            if q:
-                results.append(q.json())
-        return results
+            if (queries[q_id].query != query and wider.covers(wanted)
+                    and (wider.after is None or wider.after <= wanted.after)
+                    and (wider.before is None or wanted.before <= wider.before)
+                    and Query.stored_pcap_for_id(q_id)):
+                return q_id
+        return None
 
     @staticmethod
     def thead():
@@ -496,12 +731,22 @@ class Query:
                  'time' : self.time_requested(),
                  'query': self.query}
 
+    def lane(self):
+        """ FAST or BULK by the predicted size of the results, None without LANE_FAST_BYTES """
+        if not _LANE_FAST_BYTES:
+            return None
+        return BULK if SPACE.predict(Query.estimate(self.query)) > _LANE_FAST_BYTES else FAST
+
     def enqueue(self):
-        """ queue this query in celery for fulfillment """
+        """ queue this query in celery for fulfillment, in its lane's queue """
         if self.invalid:
             raise Exception("Invalid Query " + self.errors)
         from tasks import query_task
-        query_task.apply_async(queue='query', kwargs={'query_tuple' :self.tupify()})
+        kwargs = dict(PROFILER.forwarded(), query_tuple=self.tupify())
+        lane = self.lane()
+        if lane:
+            kwargs['lane'] = lane
+        query_task.apply_async(queue=LANE_QUEUES.get(lane, 'query'), kwargs=kwargs)
         return self.json()
 
     @property
@@ -521,6 +766,17 @@ class Query:
         if q_id:
             return os.path.join(Config.get('SPOOL_DIR'), q_id, '%s.pcap' % Config.get('MERGED_NAME'))
 
+    @staticmethod
+    def stored_pcap_for_id(q_id):
+        """ the result as it's stored: pcap_path, or pcap_path.gz if it was compressed (COMPRESS_RESULTS).
+            None until there is one
+        """
+        path = Query.pcap_path_for_id(q_id)
+        for stored in (path, path + COMPRESSED_SUFFIX):
+            if os.path.exists(stored):
+                return stored
+        return None
+
     def complete(self, state=SUCCESS):
         """ why a separate method: because someone will definitely want to check for the 'completed' status so it better be reliably named """
         if state not in Query.FINAL_STATES:
@@ -555,15 +811,36 @@ class Query:
 
     @staticmethod
     def get_unexpired(ids=None):
-        """ return a list of query IDs that are still available on the drive
+        """ return a list of query IDs that are still available on the drive, least recently touched first
             the queries can be in various states of processing
         """
-        return [
-            f for f in readdir(Config.get('SPOOL_DIR'))
-            if (f not in ['.', '..']) and
-            (not ids or f in ids) and
-            (len(f) >= 32)
-        ]
+        if not CATALOG.built():
+            Query.rebuild_catalog()
+        return CATALOG.ids(ids or None)
+
+    @staticmethod
+    def page(limit, cursor=None, states=None, newest=True):
+        """ ([(id, catalog entry)], next cursor or None): a page of queries ordered by request time """
+        if not CATALOG.built():
+            Query.rebuild_catalog()
+        return CATALOG.page(limit, cursor, states, newest)
+
+    @staticmethod
+    def rebuild_catalog():
+        """ list and stat SPOOL_DIR to replace the spool catalog """
+        return CATALOG.rebuild(Config.get('SPOOL_DIR'), Query._describe)
+
+    @staticmethod
+    def _describe(q_id):
+        """ spool catalog fields for a job directory """
+        path = Query.job_path_for_id(q_id)
+        touched = os.path.getmtime(path)
+        size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+        q = Query(q_id=q_id)
+        return {'created': epoch(q.queried) if q.events else touched,
+                'touched': touched,
+                'size': size,
+                'state': q.state}
 
     def status(self, full=False):
         """ describe this query's state in detail """
@@ -591,9 +868,21 @@ class Query:
     @staticmethod
     def status_for_ids(ids):
         """ return a dictionary of id : {status} """
-        if type(ids) is str:
-            ids = list(ids)
-        return { i: Query(q_id=i).status(full=True) for i in ids }
+        if is_str(ids):
+            ids = [ids]
+        return { i: q.status(full=True) for i, q in Query.load_many(ids).items() }
+
+    @staticmethod
+    def load_many(ids):
+        """ {id: Query} for ids, loaded with one redis round trip. Queries missing there are loaded from disk """
+        queries = {}
+        for i, (state, records, _) in zip(ids, EventLog.read_many([Query.log_for_id(i) for i in ids])):
+            q = Query()
+            q._id = i
+            if not (state or records) or not q._apply(state, records):
+                q = Query(q_id=i)
+            queries[i] = q
+        return queries
 
     @staticmethod
     def expire_now(ids=None):
@@ -605,15 +894,18 @@ class Query:
         if not ids:
             return False
         errors = []
-        if type(ids) is str:
+        if is_str(ids):
             ids = (ids,)
         for i in ids:
             try:
                 path = Query.job_path_for_id(i)
+                Query.log_for_id(i).delete()
+                queryindex.remove([i])
                 if os.path.exists( path ):
                     rmtree( path )
                 else:
                     Config.logger.info("expire_now: no {} to expire".format(i))
+                CATALOG.remove([i])
             except OSError as e:
                 errors.append(i)
                 Config.logger.error("Query: Unable to delete {}: {}".format(i, str(e)))
@@ -662,6 +954,8 @@ def parse_json():
 
     rp.add_argument('ignore-weight',
                     help='Override the configured weight limit for this request')
+    rp.add_argument('limit', type=int, help='find: return at most this many queries')
+    rp.add_argument('cursor', type=int, help='find: continue from the cursor a previous find returned')
 
     q_fields = { k:v for k,v in rp.parse_args(strict=True).items() if v or v is 0}
     Config.logger.info(str(type(q_fields))[6:] + ": " + str(q_fields))
@@ -750,6 +1044,139 @@ def parse_uri(path):
         raise BadRequest("Incomplete {} clause".format(state))
     return q_fields
 
+def _open_sensor_pcap(q_id, sensor):
+    """ open a sensor's capture for streaming: follow it while it downloads, read it once it's complete """
+    part = Query.job_path_for_id(q_id, sensor + '.pcap.part')
+    for path, follow in ((part, lambda: os.path.exists(part)),
+                         (Query.job_path_for_id(q_id, sensor + '.pcap'), None)):
+        try:
+            if os.path.getsize(path) >= GLOBAL_HEADER.size:
+                return PcapReader(path, follow=follow)
+        except (OSError, IOError, PcapError):
+            # not there (yet), or renamed/removed while we looked
+            continue
+    return None
+
+def _merged_chunks(merged, chunk_size):
+    """ a merged pcap as is, decompressed if it's stored compressed """
+    if merged.endswith(COMPRESSED_SUFFIX):
+        for chunk in FramedReader(merged, chunk_size).read():
+            yield chunk
+        return
+    with open(merged, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            yield chunk
+
+def stream_pcap(q_id, chunk_size=64*1024):
+    """ yields a pcap for q_id: a global header right away, then packets as sensors deliver them.
+        A completed query's merged pcap is sent as is (decompressed, if it's stored compressed).
+    """
+    start = datetime.utcnow()
+    while not os.path.exists(Query.job_path_for_id(q_id)):
+        if (datetime.utcnow() - start).total_seconds() > STREAM_WAIT:
+            Config.logger.error("stream: {} never started".format(q_id))
+            return
+        sleep(FOLLOW_SLEEP)
+
+    merged = Query.stored_pcap_for_id(q_id)
+    if merged:
+        for chunk in _merged_chunks(merged, chunk_size):
+            yield chunk
+        return
+
+    merger = StreamMerger(skew=STREAM_SKEW)
+    pending = set(_SENSORS)
+    finished, answered, cursor = False, set(), 0
+    try:
+        for sensor in list(pending):
+            reader = _open_sensor_pcap(q_id, sensor)
+            if reader:
+                merger.add(reader)
+                pending.discard(sensor)
+        # a merge that finished since we looked has removed the sensors' captures: send its result instead
+        merged = Query.stored_pcap_for_id(q_id)
+        if merged:
+            for chunk in _merged_chunks(merged, chunk_size):
+                yield chunk
+            return
+
+        yield global_header(MAX_SNAPLEN)
+        while pending or not merger.done:
+            if pending:
+                # only read the events recorded since we last looked
+                state, events, cursor = Query.tail(q_id, cursor)
+                finished = finished or state.get('state') in Query.FINAL_STATES + (Query.RECEIVED,)
+                answered.update(e.name for e in events
+                                if type(e) is Result or e.state in (Query.ERROR, Query.FAIL))
+            for sensor in list(pending):
+                reader = _open_sensor_pcap(q_id, sensor)
+                if reader:
+                    merger.add(reader)
+                    pending.discard(sensor)
+                elif finished or sensor in answered:
+                    pending.discard(sensor)
+
+            data, size = [], 0
+            for record in merger.available():
+                data.append(record)
+                size += len(record)
+                if size >= chunk_size:
+                    yield b''.join(data)
+                    data, size = [], 0
+            if data:
+                yield b''.join(data)
+            else:
+                sleep(FOLLOW_SLEEP)
+    finally:
+        merger.close()
+
+def _spool_usage():
+    """ {labels: value} of catalog totals: queries and bytes by state """
+    usage = {}
+    for entry in CATALOG.entries().values():
+        for kind, value in (('queries', 1), ('bytes', entry.get('size') or 0)):
+            labels = (('kind', kind), ('state', entry.get('state') or 'unknown'))
+            usage[labels] = usage.get(labels, 0) + value
+    return usage
+
+def _queue_depths():
+    """ tasks waiting in each celery queue: the broker keeps them in redis lists named after the queues """
+    r = Config.redis()
+    if not r:
+        return {}
+    return {(('queue', name),): r.llen(name) for name in ('query', 'bulk', 'io')}
+
+METRICS.histogram('docket_http_request_seconds', "Seconds the API takes to answer, by endpoint")
+METRICS.counter('docket_admissions_total', "Queries admitted, queued or rejected for spool space (see RESERVE_DEFAULT)")
+METRICS.gauge('docket_spool_free_bytes', "Free bytes in SPOOL_DIR's filesystem", lambda: {(): spool_space().bytes})
+METRICS.gauge('docket_spool_free_nodes', "Free inodes in SPOOL_DIR's filesystem", lambda: {(): spool_space().nodes})
+METRICS.gauge('docket_spool_reserved_bytes', "Spool space reserved for queries' results", lambda: {(): SPACE.outstanding()})
+METRICS.gauge('docket_spool_usage', "Queries in the spool, and the bytes they use, by state", _spool_usage)
+METRICS.gauge('docket_queue_depth', "Tasks waiting in each celery queue (redis broker)", _queue_depths)
+
+def _admit(q):
+    """ reserve spool space for q's predicted results.
+        returns None if q can be enqueued: admitted, or queued until other queries release space
+                (message, 413) if it can't: forces a cleanup
+    """
+    low = space_low()
+    if not low:
+        if not q.id or os.path.exists(q.job_path):
+            return None             # invalid (enqueue says why), or a duplicate: its results are already stored
+        size = SPACE.predict(Query.estimate(q.query))
+        available = space_available()
+        decision = SPACE.admit(q.id, size, available)
+        METRICS.inc('docket_admissions_total', decision=decision)
+        Config.logger.info("Query[{}] {} {} bytes: {} available, {} reserved".format(
+                q.id, decision, size, available, SPACE.outstanding()))
+        if decision != REJECTED:
+            return None
+        low = "Not enough space for the expected results: {} bytes needed, {} available".format(size, available)
+    from tasks import cleanup
+    cleanup.apply_async(queue='io', kwargs={'force':True})
+    Config.logger.error(low)
+    return low, 413
+
 class QueryRequest(Resource):
     """ This class handles Stenographer Query requests ala Flask-Restful. """
 
@@ -759,13 +1186,6 @@ class QueryRequest(Resource):
                  - return the ID, URL needed for a future get ID/MERGED_NAME.pcap request
         """
         Config.logger.info("query request: {}".format(_get_request_nfo()))
-        low = space_low()
-        if low:
-            from tasks import cleanup
-            cleanup.apply_async(queue='io', kwargs={'force':True})
-            Config.logger.error(low)
-            return low, 413
-
         try:
             fields = parse_json()
             q = Query(fields=fields)
@@ -773,20 +1193,13 @@ class QueryRequest(Resource):
             return str(e), 400
         except ValueError as e:
             return str(e), 400
-        return q.enqueue()
+        return _admit(q) or q.enqueue()
 
     def get(self, path):
         """ get  - build a query based on uri and enqueue it for processing
                  - return the ID, URL needed for a future get ID/MERGED_NAME.pcap request
         """
         Config.logger.info("URI request: {}".format(_get_request_nfo()))
-        low = space_low()
-        if low:
-            from tasks import cleanup
-            cleanup.apply_async(queue='io', kwargs={'force': True})
-            Config.logger.error(low)
-            return low, 413
-
         try:
             fields = parse_uri(path)
             q = Query(fields=fields)
@@ -795,6 +1208,9 @@ class QueryRequest(Resource):
         except ValueError as e:
             return str(e), 400
 
+        rejected = _admit(q)
+        if rejected:
+            return rejected
         result = q.enqueue()
 
         r = Response(
@@ -811,17 +1227,10 @@ class RawRequest(Resource):
     def get(self, query):
         Config.logger.info("RAW request: {}".format(_get_request_nfo()))
 
-        low = space_low()
-        if low:
-            from tasks import cleanup
-            cleanup.apply_async(queue='io', kwargs={'force':True})
-            Config.logger.error(low)
-            return low
-
         from urllib import unquote_plus
         q = Query(unquote_plus(query))
         Config.logger.info("Raw query: {}".format(q.query))
-        return q.enqueue()
+        return _admit(q) or q.enqueue()
 
     def post(self):
         """ Handles raw query POST,
@@ -830,13 +1239,6 @@ class RawRequest(Resource):
         """
         Config.logger.info("RAW request: {}".format(_get_request_nfo()))
 
-        low = space_low()
-        if low:
-            from tasks import cleanup
-            cleanup.apply_async(queue='io', kwargs={'force':True})
-            Config.logger.error(low)
-            return low
-
         q = Query()
         q.query = ''
         for k,v in request.form.lists():
@@ -847,16 +1249,147 @@ class RawRequest(Resource):
                 q.query += k
 
         Config.logger.info("Raw query: {}".format(q.query))
-        return q.enqueue()
+        return _admit(q) or q.enqueue()
+
+class StreamRequest(Resource):
+    """ Streams a query's packets while sensors are still answering: curl .../stream/ID | tcpdump -r - """
+    def get(self, q_id):
+        Config.logger.info("Stream request: {}".format(_get_request_nfo()))
+        if not re.match(r'^[a-f0-9-]{32,}$', q_id):
+            return "Invalid id: {}".format(q_id), 404
+        r = Response(stream_pcap(q_id), mimetype='application/vnd.tcpdump.pcap')
+        r.headers['Content-Disposition'] = 'attachment; filename={}.pcap'.format(q_id)
+        return r
+
+class RefineRequest(Resource):
+    """ Narrows a completed query's results without asking the sensors: GET /refine/ID/port/53/udp
+        The derived query is ID's query and the new clauses (parse_uri's syntax),
+        its results are filtered from ID's pcap in the io worker.
+        Time clauses narrow the window only when given.
+    """
+    _TIMES = ('after', 'before', 'after-ago', 'before-ago')
+
+    def get(self, q_id, path):
+        Config.logger.info("Refine request: {}".format(_get_request_nfo()))
+        if not re.match(r'^[a-f0-9-]{32,}$', q_id):
+            return "Invalid id: {}".format(q_id), 404
+        source = Query(q_id=q_id)
+        if not source.query:
+            return "No such query: {}".format(q_id), 404
+        if source.state != Query.SUCCESS or not Query.stored_pcap_for_id(q_id):
+            return "Query {} has no results to refine ({})".format(q_id, source.state), 409
+        try:
+            fields = parse_uri(path)
+            # nothing is asked of the sensors, the weight limit doesn't apply
+            fields['ignore-weight'] = True
+            clauses = Query(fields=fields).query.split(' and ')
+        except (BadRequest, ValueError) as e:
+            return str(e), 400
+        if not any(fields.get(k) for k in self._TIMES):
+            clauses = [c for c in clauses if not c.startswith(('after ', 'before '))]
+        existing = source.query.split(' and ')
+        clauses = [c for c in clauses if c not in existing]
+        if not clauses:
+            return source.json()
+
+        q = Query(query=' and '.join(existing + clauses))
+        try:
+            PacketFilter.parse(q.query)
+        except ValueError as e:
+            return "Can't refine {}: {}".format(q_id, e), 400
+        rejected = _admit(q)
+        if rejected:
+            return rejected
+        from tasks import refine_from
+        refine_from(q, q_id)
+        return q.json()
+
+class ResultRequest(Resource):
+    """ Serves results that aren't stored as requested: the web server sends the files that exist (static-map),
+        requests for compressed results (COMPRESS_RESULTS) fall through to us.
+        GET PCAP_WEB_ROOT/ID/MERGED_NAME.pcap       decompressed while it's sent, a Range only reads the frames it needs
+        GET PCAP_WEB_ROOT/ID/MERGED_NAME.pcap.gz    the stored file
+    """
+    def get(self, q_id, name):
+        if not re.match(r'^[a-f0-9-]{32,}$', q_id):
+            return "Invalid id: {}".format(q_id), 404
+        stored = Query.stored_pcap_for_id(q_id)
+        if not stored or name not in (os.path.basename(Query.pcap_path_for_id(q_id)), os.path.basename(stored)):
+            return "No results: {}/{}".format(q_id, name), 404
+        if name == os.path.basename(stored):
+            mimetype = 'application/gzip' if stored.endswith(COMPRESSED_SUFFIX) else 'application/vnd.tcpdump.pcap'
+            return send_file(stored, mimetype=mimetype, conditional=True)
+
+        reader = FramedReader(stored)
+        start, stop, status = 0, reader.size, 200
+        if reader.size is not None and request.range:
+            requested = request.range.range_for_length(reader.size)
+            if requested is None:
+                r = Response(status=416)
+                r.headers['Content-Range'] = 'bytes */{}'.format(reader.size)
+                return r
+            (start, stop), status = requested, 206
+        r = Response(reader.read(start, stop), status=status, mimetype='application/vnd.tcpdump.pcap',
+                     direct_passthrough=True)
+        if reader.size is not None:
+            r.headers['Accept-Ranges'] = 'bytes'
+            r.headers['Content-Length'] = str(stop - start)
+        if status == 206:
+            r.headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, stop - 1, reader.size)
+        return r
 
 class ApiRequest(Resource):
     delims = re.compile('[, \t;+]+')
 
+    @staticmethod
+    def _found(fields, limit=None, cursor=None):
+        """ Query.find results, paged by limit and cursor: the next cursor is in the X-Docket-Cursor header """
+        results, cursor = Query.find(fields, limit=limit, cursor=cursor or 0)
+        return results, 200, ({'X-Docket-Cursor': str(cursor)} if cursor is not None else {})
+
+    def _paged(self, describe):
+        """ a page of queries, newest first: describe(ids, fields) returns {id: description}
+            ?limit=N            at most PAGE_SIZE
+            ?cursor=C           from the previous page's X-Docket-Cursor header, absent after the last page
+            ?state=S,S          only queries in these states
+            ?order=asc          oldest first
+            ?fields=F,F         only these fields of each description
+            returns (page, {id: description}, next cursor), BadRequest for a cursor we didn't hand out
+        """
+        limit = min(request.args.get('limit', PAGE_SIZE, type=int) or PAGE_SIZE, PAGE_SIZE)
+        # states have spaces ('Request Complete'): only commas separate them
+        states = self._split('state', ',')
+        try:
+            page, cursor = Query.page(limit, request.args.get('cursor') or None, set(states) if states else None,
+                                      newest=request.args.get('order', 'desc') != 'asc')
+        except ValueError:
+            raise BadRequest("Bad cursor: {}".format(request.args.get('cursor')))
+        return page, describe([i for i, _ in page], self._split('fields')), cursor
+
+    def _split(self, arg, delimiter=None):
+        """ a list from a delimited request argument, None if it's absent """
+        value = request.args.get(arg)
+        if not value:
+            return None
+        return value.split(delimiter) if delimiter else self.__class__.delims.split(value)
+
+    @staticmethod
+    def _project(description, fields):
+        if not fields:
+            return description
+        return {k: v for k, v in description.items() if k in fields}
+
+    def _response(self, body, cursor):
+        r = Response(response=dumps(body, default=json_serial), mimetype="application/json")
+        if cursor:
+            r.headers['X-Docket-Cursor'] = cursor
+        return r
+
     def get(self, api=None, selected=None):
         """ inspect parameters and call the right Query method """
         Config.logger.info("API request: {}".format(_get_request_nfo()))
 
-        if type(selected) is str:
+        if is_str(selected):
             selected = self.__class__.delims.split(selected)
 
         if api == "ids" or api == "urls":
@@ -865,22 +1398,43 @@ class ApiRequest(Resource):
                 return ids
             urls = {}
             for i in ids:
-                if os.path.exists(Query.pcap_path_for_id(i)):
+                if Query.stored_pcap_for_id(i):
                     urls[i] = Query.pcap_url_for_id(i)
             return urls
 
         elif api == "stats":
-            from tasks import get_stats
+            from tasks import get_stats, SESSIONS, IDLE_HISTOGRAMS
             stats = get_stats(selected_sensors=selected)
             freespace = spool_space()
-            stats['docket'] = {'Free space': freespace}
+            stats['docket'] = {'Free space': freespace,
+                               'Connections': SESSIONS.counters(_INSTANCES),
+                               'Idle': IDLE_HISTOGRAMS.read(_SENSORS)}
             return stats
 
         elif api == "status":
+            def describe(ids, fields):
+                if fields and set(fields) <= {'state'}:
+                    # the catalog knows: don't load event logs
+                    return {i: {'state': e.get('state')} for i, e in CATALOG.entries(ids).items()}
+                return {i: self._project(status, fields) for i, status in Query.status_for_ids(ids).items()}
+            if selected:
+                return self._response(describe(Query.get_unexpired(selected), self._split('fields')), None)
+            try:
+                _, described, cursor = self._paged(describe)
+            except BadRequest as e:
+                return str(e), 400
+            return self._response(described, cursor)
+
+        elif api == "events":
+            # tail a query's events: pass the returned cursor back to get only newer ones
+            if not selected:
+                return "Usage: /events/ID/?cursor=N", 400
+            state, events, cursor = Query.tail(selected[0], request.args.get('cursor', 0, type=int))
             r = Response(
-                response=dumps(
-                    Query.status_for_ids(Query.get_unexpired(selected)),
-                    default=json_serial),
+                response=dumps({'state': state,
+                                'events': [e._asdict() for e in events],
+                                'cursor': cursor},
+                               default=json_serial),
                 mimetype="application/json"
                 )
             return r
@@ -890,8 +1444,32 @@ class ApiRequest(Resource):
             cleanup.apply_async(queue='io', kwargs={'force':True})
             return "Cleanup queued"
 
+        elif api == "catalog":
+            from tasks import rebuild_catalog
+            rebuild_catalog.apply_async(queue='io')
+            return "Catalog rebuild queued"
+
+        elif api == "metrics":
+            return Response(METRICS.render(), mimetype='text/plain; version=0.0.4')
+
+        elif api == "profiles":
+            if not selected:
+                return self._response(PROFILER.list(), None)
+            path = PROFILER.file(selected[0])
+            if not path:
+                return "No profile {}".format(selected[0]), 404
+            return send_file(path, mimetype='text/plain' if path.endswith('.folded') else 'application/octet-stream',
+                             as_attachment=True, cache_timeout=0)
+
         elif api == "jobs":
-            return Query.find({})
+            def describe(ids, fields):
+                queries = Query.load_many(ids)
+                return {i: self._project(q.json(), fields) for i, q in queries.items() if q.query}
+            try:
+                page, described, cursor = self._paged(describe)
+            except BadRequest as e:
+                return str(e), 400
+            return self._response([described[i] for i, _ in page if i in described], cursor)
 
         return "Unrecognized request: try /stats, /ids, /urls, /jobs or POST a json encoded stenographer query"
 
@@ -899,5 +1477,5 @@ class ApiRequest(Resource):
         if api == 'find':
             fields = parse_json()
             Config.logger.info("Fields: {}".format(fields))
-            return Query.find(fields)
+            return self._found(fields, fields.pop('limit', None), fields.pop('cursor', None))
         return "Unrecognized request: try /stats, /ids, /urls or POST a json encoded stenographer query"
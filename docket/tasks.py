@@ -20,16 +20,32 @@
 ##
 """ Celery Tasks (occasionally called from uwsgi: get_stats) """
 import os
+import io
+import zlib
+import errno
 
 from datetime import datetime, timedelta
-from time import sleep
+from time import time
+from threading import Thread, Event
 import requests
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
 
 from docket import celery
 from config import Config
-from common.utils import parse_duration, parse_capacity, from_epoch, ISOFORMAT, file_modified, \
-        spool_space, readdir, is_str
-from resources.query import Query
+from common.utils import parse_duration, parse_capacity, ISOFORMAT, \
+        spool_space, space_available, readdir, is_str, epoch
+from common.pcap import merge_pcaps, count_records, PcapError
+from common.pcapfilter import PacketFilter, filter_pcap
+from common.frames import compress_file, FramedReader, INDEX_SUFFIX
+from common.chunks import ChunkCache
+from common.slots import SensorSlot, FAST
+from common.sessions import SessionPool
+from common.statscache import StatsCache
+from common.idle import IdleTracker, IdleHistograms, IDLE, BUSY, UNREACHABLE
+from resources.query import Query, CATALOG, SPACE, METRICS, PROFILER, LANE_QUEUES, COMPRESSED_SUFFIX
 
 
 #logger = Config.logger
@@ -37,7 +53,8 @@ _LAST_CLEANED = datetime.utcnow()
 
 _INSTANCES = Config.get('STENOGRAPHER_INSTANCES')
 for _ in _INSTANCES:
-    _['idle'], _['stats'] = (from_epoch(0), {})
+    _['stats'] = {}
+_BY_SENSOR = {_['sensor']: _ for _ in _INSTANCES}
 
 # IDLE_TIME - 5, assume stenoboxes remain IDLE for 5 seconds and check again after that.
 IDLE_TIME = Config.setdefault('IDLE_TIME', 5, minval=1)
@@ -49,86 +66,157 @@ STAT_TIMEOUT = Config.setdefault('STAT_TIMEOUT', 3.0, minval=0.1)
 QUERY_TIMEOUT = Config.setdefault('QUERY_TIMEOUT', 720.0, minval=5)
 # MERGED_NAME - name of the final result pcap
 MERGED_NAME = Config.setdefault('MERGED_NAME', "merged")
+# DOWNLOAD_CHUNK - 1MB, stenographer responses are written to disk in chunks of this size
+DOWNLOAD_CHUNK = int(parse_capacity(Config.setdefault('DOWNLOAD_CHUNK', '1MB')))
+# MERGE_BUFFER - 4MB, merged output is written in pieces of this size
+MERGE_BUFFER = int(parse_capacity(Config.setdefault('MERGE_BUFFER', '4MB')))
+# SENSOR_CONCURRENCY - 1, stenographer queries a single instance will run at once (across all query workers)
+#                      instances may override this with a 'concurrency' value
+SENSOR_CONCURRENCY = Config.setdefault('SENSOR_CONCURRENCY', 1, minval=1)
+# LANE_FAST_SLOTS - 1, slots of each instance that bulk queries leave to fast ones (see LANE_FAST_BYTES)
+# LANE_STARVE - 60, seconds a bulk query waits for an instance before fast queries make way for it
+LANE_FAST_SLOTS = Config.setdefault('LANE_FAST_SLOTS', 1, minval=0)
+LANE_STARVE = Config.setdefault('LANE_STARVE', 60, minval=0)
+if Config.get('LANE_FAST_BYTES'):
+    _SHARED = [i['sensor'] for i in _INSTANCES if i.get('concurrency', SENSOR_CONCURRENCY) - LANE_FAST_SLOTS < 1]
+    if _SHARED:
+        Config.logger.warning("Priority lanes: {} can't keep a slot for fast queries (concurrency - LANE_FAST_SLOTS < 1),"
+                              " fast and bulk queries share them".format(', '.join(_SHARED)))
+_SLOT_DIR = os.path.join(Config.get('SPOOL_DIR'), '.slots')
+# STENO_POOL_SIZE - 4, keep-alive connections kept open to each instance (per process)
+# STENO_RETRIES - 2, reconnect attempts when a connection to an instance fails
+SESSIONS = SessionPool(METRICS, pool_size=Config.setdefault('STENO_POOL_SIZE', 4, minval=1),
+                       retries=Config.setdefault('STENO_RETRIES', 2, minval=0))
 
 EXPIRE_TIME = parse_duration(Config.get('EXPIRE_TIME', 0))
 EXPIRE_SPACE= parse_capacity(Config.get('EXPIRE_SPACE', 0))
+# EXPIRE_BATCH - 50, most queries one cleanup run deletes before yielding the io worker to merges
+EXPIRE_BATCH = Config.setdefault('EXPIRE_BATCH', 50, minval=1)
+# CHUNK_SECONDS - 0 (off), request time in aligned chunks of this many seconds (at least 60), and cache each sensor's
+#                 chunks so queries overlapping earlier ones only request the time that isn't cached (see docs/design.md)
+CHUNK_SECONDS = Config.get('CHUNK_SECONDS') and Config.setdefault('CHUNK_SECONDS', 3600, minval=60)
+CHUNKS = ChunkCache(os.path.join(Config.get('SPOOL_DIR'), '.chunks'), CHUNK_SECONDS) if CHUNK_SECONDS else None
+# REUSE_RESULTS - true, answer a query covered by a completed query by filtering its results (requires redis)
+REUSE_RESULTS = Config.setdefault('REUSE_RESULTS', True)
+# COMPRESS_RESULTS - false, store results as gzip frames (MERGED_NAME.pcap.gz), served decompressed or as is
+# COMPRESS_FRAME - 1MB, result bytes per gzip frame: a Range request decompresses at most one frame it doesn't need
+# COMPRESS_LEVEL - 6, zlib compression level: 1 (fastest) to 9 (smallest)
+COMPRESS_RESULTS = Config.setdefault('COMPRESS_RESULTS', False)
+COMPRESS_FRAME = int(parse_capacity(Config.setdefault('COMPRESS_FRAME', '1MB')))
+COMPRESS_LEVEL = Config.setdefault('COMPRESS_LEVEL', 6, minval=1)
+
+METRICS.histogram('docket_stage_seconds', "Seconds queries spend in each stage: queue (waiting for a query worker), "
+                  "space (waiting for spool space), merge, refine, and total (request to final state)")
+METRICS.histogram('docket_sensor_stage_seconds', "Seconds each sensor request spends in each stage: "
+                  "slot (waiting for other queries on the sensor), idle (waiting for it to be idle), transfer")
+METRICS.counter('docket_sensor_bytes_total', "Bytes received from each sensor")
+METRICS.counter('docket_sensor_packets_total', "Packets merged from each sensor's results")
+METRICS.counter('docket_queries_total', "Queries finished, by final state")
+METRICS.counter('docket_sensor_requests_total', "Requests made to each sensor (stats and queries)")
+METRICS.counter('docket_sensor_connections_total', "TLS connections opened to each sensor: requests that couldn't reuse one")
+METRICS.counter('docket_cache_total', "Lookups by cache (chunk: CHUNK_SECONDS, results: REUSE_RESULTS), hit or miss")
+
+# Stats errors: the instance can't be reached, don't wait for it to become idle
+_UNREACHABLE = ("Connection Error", "SSL Error")
+
+def _poll_stats(sensor):
+    """ request /debug/stats from one instance, returns a dict of stats or an error string """
+    instance = _BY_SENSOR[sensor]
+    Config.logger.debug("query instance: {}".format(sensor))
+
+    url = "https://{}:{}/debug/stats".format(
+            instance['host'], instance['port'])
 
-# stats are not enqueueble because we always want them immediately.
-def get_stats(selected_sensors=None):
-    """ return a dictionary of { sensorname: {stats} }
-        NOTE: runs immediately not - used when we _need_ a result
+    try:
+        rq = SESSIONS.get(instance).get(url, timeout=STAT_TIMEOUT)
+        if rq.status_code != requests.codes.ok:
+            Config.logger.error("stats failed({}): {} {}".format(rq.status_code,
+                                                                 sensor,
+                                                                 rq.text))
+            return "Stats failed({})".format(rq.status_code)
+    except requests.exceptions.ConnectTimeout as ex:
+        Config.logger.error("Stats: {}:{} Connection timeout after {} seconds".format(
+            instance['host'], instance['port'], STAT_TIMEOUT))
+        return "Connection Timeout"
+    except requests.exceptions.ReadTimeout as ex:
+        Config.logger.error("Stats: {}:{} Didn't provide stats in {} seconds".format(
+            instance['host'], instance['port'], STAT_TIMEOUT))
+        SESSIONS.reset(instance)
+        return "Read Timeout"
+    except requests.exceptions.SSLError as ex:
+        Config.logger.error("Stats: {}:{} SSL Error - check conf {}".format(
+            instance['host'], instance['port'], str(ex)))
+        return "SSL Error"
+    except requests.exceptions.ConnectionError as ex:
+        Config.logger.error("Stats: {}:{} Connection Error? {}".format(
+            instance['host'], instance['port'], str(ex)))
+        SESSIONS.reset(instance)
+        return "Connection Error"
+
+    # Request Succeeded
+    Config.logger.debug("response code: {}".format(rq.status_code))
+    data = {}
+    for line in rq.text.split('\n'):
+        if line.strip():
+            k, v = line.split()
+            data[k] = int(v)
+
+    if 'oldest_timestamp' in data:
+        ot = data['oldest_timestamp']
+        dt = datetime.utcfromtimestamp(0) + timedelta(microseconds=ot/1000 )
+        data['oldest_timestamp'] = dt.strftime(ISOFORMAT)
+    return data
+
+def _idle_state(stats):
+    """ IDLE, BUSY or UNREACHABLE according to an instance's stats """
+    if stats in _UNREACHABLE:
+        return UNREACHABLE
+    if isinstance(stats, dict) and stats.get('indexfile_current_reads') == 0:
+        return IDLE
+    return BUSY
+
+def _record_idle(sensor, sampled, stats):
+    IDLE_HISTOGRAMS.observe(sensor, sampled, _idle_state(stats))
+
+# STATS_PERIOD - 2.0, seconds between polls of every instance by the (single) stats collector
+# STATS_MAX_AGE - 10.0, cached stats older than this are refreshed before they're returned
+STATS_PERIOD = Config.setdefault('STATS_PERIOD', 2.0, minval=0.5)
+STATS_MAX_AGE = Config.setdefault('STATS_MAX_AGE', 10.0, minval=0)
+IDLE_HISTOGRAMS = IdleHistograms()
+# the idle histograms are fed by the collector's polls: without redis they're kept in the collecting process
+STATS = StatsCache(_poll_stats, _BY_SENSOR.keys(), period=STATS_PERIOD, timeout=STAT_TIMEOUT,
+                   on_sample=_record_idle, path=os.path.join(Config.get('SPOOL_DIR'), '.stats'))
+
+def get_stats(selected_sensors=None, max_age=STATS_MAX_AGE):
+    """ return a dictionary of { sensorname: {stats} } from the shared stats cache
+        max_age - seconds: older (or missing) stats are requested from the instance before returning
     """
     Config.logger.debug("Get Stats: {}".format(selected_sensors))
     if is_str(selected_sensors):
         selected_sensors = (selected_sensors, )
-    datas = {}
+    sensors = [s for s in _BY_SENSOR if selected_sensors is None or s in selected_sensors]
 
-    global _INSTANCES
-    for instance in _INSTANCES:
-        if ((selected_sensors is not None) and
-            (instance['sensor'] not in selected_sensors)):
-            continue
-
-        Config.logger.debug("query instance: {}".format(instance['sensor']))
-
-        url = "https://{}:{}/debug/stats".format(
-                instance['host'], instance['port'])
-
-        data = None
-        try:
-            rq = requests.get(
-                url,
-                cert=(instance['cert'], instance['key']),
-                verify=instance['ca'],
-                timeout=STAT_TIMEOUT
-            )
-            if rq.status_code != requests.codes.ok:
-                Config.logger.error("stats failed({}): {} {}".format(rq.status_code,
-                                                                     instance['sensor'],
-                                                                     rq.text))
-                continue
-        except requests.exceptions.ConnectTimeout as ex:
-            Config.logger.error("Stats: {}:{} Connection timeout after {} seconds".format(
-                instance['host'], instance['port'], STAT_TIMEOUT))
-            data = "Connection Timeout"
-        except requests.exceptions.ReadTimeout as ex:
-            Config.logger.error("Stats: {}:{} Didn't provide stats in {} seconds".format(
-                instance['host'], instance['port'], STAT_TIMEOUT))
-            data = "Read Timeout"
-        except requests.exceptions.ConnectionError as ex:
-            Config.logger.error("Stats: {}:{} Connection Error? {}".format(
-                instance['host'], instance['port'], str(ex)))
-            raise ex
-        except requests.exceptions.SSLError as ex:
-            Config.logger.error("Stats: {}:{} SSL Error - check conf {}".format(
-                instance['host'], instance['port'], str(ex)))
-            raise ex
-        else:
-            # Request Succeeded
-            Config.logger.debug("response code: {}".format(rq.status_code))
-            lines = rq.text.split('\n')
-            data = instance.get('stats')
-            for line in lines:
-                if line.strip():
-                    k, v = line.split()
-                    data[k] = int(v)
-
-            if 'oldest_timestamp' in data:
-                ot = data['oldest_timestamp']
-                dt = datetime.utcfromtimestamp(0) + timedelta(microseconds=ot/1000 )
-                data['oldest_timestamp'] = dt.strftime(ISOFORMAT)
-
-            if data.get('indexfile_current_reads') == 0:
-                instance['idle'] = datetime.utcnow()
+    datas = {}
+    for sensor, (_, data) in STATS.read(sensors, max_age=max_age).items():
+        _BY_SENSOR[sensor]['stats'] = data
+        datas[sensor] = data
+    return datas
 
-        datas[instance['sensor']] = data
+def _read_idle(sensor):
+    """ (sampled, state) for the idle tracker, accepts stats up to one collector period past IDLE_SLEEP """
+    sampled, data = STATS.read([sensor], max_age=IDLE_SLEEP + STATS_PERIOD).get(sensor, (0, None))
+    return sampled, _idle_state(data)
 
-    return datas
+# Every query waiting on an instance shares one watcher
+IDLE_TRACKER = IdleTracker(_read_idle, idle_time=IDLE_TIME, poll=IDLE_SLEEP)
 
 @celery.task(queue='query', default_retry_delay=900, max_retries=1)    # 15 minute retry delay
-def query_task(query_tuple, headers=None):
+@PROFILER.task()
+def query_task(query_tuple, headers=None, lane=None, requery=False):
     """ manage the threads that query stenographer.
         Eliminate duplicate queries and ensure order
+        lane - FAST or BULK with priority lanes (see Query.lane), BULK queries run in the 'bulk' workers
+        requery - the job exists already: filtering a covering query's results failed (see refine)
     """
     query = Query(qt=query_tuple)
     if query.invalid:
@@ -137,34 +225,76 @@ def query_task(query_tuple, headers=None):
 
     query.progress('query_task', 'Starting requests')
     Config.logger.debug("query: {}".format(query.id))
+    METRICS.observe('docket_stage_seconds', (datetime.utcnow() - query.queried).total_seconds(), stage='queue',
+                    queue=LANE_QUEUES.get(lane, 'query'))
 
     # detect duplicates, and update their timestamps to forestall deletion
     from os import mkdir
     try:
         mkdir(query.job_path, 0750)       # mkdir throws OSError if directory exists
     except OSError:
-        # NOTE: python 3 throws the subclass: FileExistsError
-        Config.logger.info("query: duplicate request {}".format(query.id))
-        # Python2 doesn't allow keyword arguments here
-        os.utime(query.job_path, None)
+        if not requery:
+            # NOTE: python 3 throws the subclass: FileExistsError
+            Config.logger.info("query: duplicate request {}".format(query.id))
+            # Python2 doesn't allow keyword arguments here
+            os.utime(query.job_path, None)
+            CATALOG.update(query.id, touched=time())
+            return
+    CATALOG.update(query.id, created=epoch(query.queried), touched=time(), size=0)
+
+    # A completed query that covers this one already has our packets: filter them instead of asking the sensors
+    covering = Query.covering(query.query) if REUSE_RESULTS and not requery else None
+    if REUSE_RESULTS and not requery:
+        METRICS.inc('docket_cache_total', cache='results', result='hit' if covering else 'miss')
+    if covering:
+        _queue_refine(query, covering)
         return
 
-    threads = []
-    # Query each instance concurrently
+    # Query each instance concurrently. Requesters report through 'reports' as they progress,
+    # so we only save when something happened and return as soon as the last one is done.
+    deadline = datetime.utcnow() + timedelta(seconds=QUERY_TIMEOUT)
+    cancel = Event()
+
+    # Space for the results is reserved when a request is admitted, queued requests wait for it here
+    estimate = Query.estimate(query.query)
+    reserved = SPACE.reserved(query.id)
+    if reserved is None:
+        reserved = SPACE.predict(estimate)
+        query.progress('query_task', "awaiting {} bytes of spool space".format(reserved), Query.RECEIVING)
+        query.save()
+        with METRICS.timer('docket_stage_seconds', stage='space'):
+            acquired = SPACE.acquire(query.id, reserved, space_available, deadline, cancel)
+        if not acquired:
+            query.error('query_task', "not enough spool space for {}".format(QUERY_TIMEOUT), Query.FAIL)
+            query.save()
+            CATALOG.update(query.id, touched=time())
+            _finished(query)
+            return
+
+    reports = Queue()
+    pending = set()
     for instance in _INSTANCES:
-        from threading import Thread
-        thread = Thread(target=_requester, args=(query, instance, headers))
+        thread = Thread(target=_requester, args=(query, instance, headers, deadline, cancel, reports, lane))
+        thread.daemon = True
         thread.start()
-        threads.append(thread)
+        pending.add(instance['sensor'])
 
-    # Wait until all threads complete.
-    alive = True
-    while alive:
+    query.save()
+    while pending:
+        # requesters give up at the deadline on their own, give them a moment to say so
+        try:
+            reported = [reports.get(timeout=max(_remaining(deadline) + STAT_TIMEOUT, 0))]
+            while not reports.empty():
+                reported.append(reports.get_nowait())
+        except Empty:
+            cancel.set()
+            for sensor in pending:
+                query.error(sensor, "cancelled: no response in {}".format(QUERY_TIMEOUT), Query.FAIL)
+            break
+        pending.difference_update(sensor for sensor, done in reported if done)
         query.save()
-        alive = False
-        for thread in threads:
-            thread.join(1.0)
-            alive = alive or thread.is_alive()
+        # what's been received is on disk now, it's no longer reserved
+        SPACE.update(query.id, max(reserved - sum(e.value for e in query.successes), 0))
 
     errors = query.errors
     if errors:
@@ -175,87 +305,196 @@ def query_task(query_tuple, headers=None):
         query.progress('query_task', 'stenographer queries completed. No packets returned', Query.SUCCESS)
 
     query.save()
+    received = sum(e.value for e in query.successes)
+    CATALOG.update(query.id, touched=time(), size=received)
+    if not errors:
+        SPACE.observe(estimate, received)
+    # merging more than one result writes a copy of them
+    SPACE.update(query.id, received if len(query.successes) > 1 else 0)
     if query.successes:
-        merge.apply_async(queue='io', kwargs={'query_tuple':query.tupify()})
+        merge.apply_async(queue='io', kwargs=dict(PROFILER.forwarded(), query_tuple=query.tupify()))
+    else:
+        _finished(query)
+    METRICS.flush()
+
+def _finished(query):
+    """ count a query that reached its final state """
+    METRICS.inc('docket_queries_total', state=query.state)
+    METRICS.observe('docket_stage_seconds', (datetime.utcnow() - query.queried).total_seconds(), stage='total')
 
-def _requester(query, instance, headers = None):
+def _requester(query, instance, headers, deadline, cancel, reports, lane=None):
     """ Runs in the 'query' worker: performs a request against the instance
-        and writes the response data to disk
+        and writes the response data to disk.
+        Gives up at deadline, or as soon as cancel is set.
+        reports receives (sensor, done) whenever this request changes state
+        lane - the query's priority lane: which of the instance's slots it may take
     """
     # NOTE on thread safety: python built-ins like list and dict are thread-safe due to GIL,
     #   But the order of those operations can change.
     #   Here we add events to query (list appends).
     #   The order of these appends are not important, and the values do not depend on shared data
-    query.progress(instance['sensor'], "Awaiting idle", Query.RECEIVING)
-
-    if not _ensure_idle(instance):
-        query.error(instance['sensor'], "not idle or can't connect in {}".format(QUERY_TIMEOUT), Query.FAIL)
+    slot = SensorSlot(_SLOT_DIR, instance['sensor'], instance.get('concurrency', SENSOR_CONCURRENCY),
+                      lane=lane, reserved=LANE_FAST_SLOTS, starve=LANE_STARVE)
+    try:
+        # Other queries may be using this instance, wait our turn so we don't thrash its disks
+        query.progress(instance['sensor'], "Awaiting sensor", Query.RECEIVING)
+        with METRICS.timer('docket_sensor_stage_seconds', stage='slot', sensor=instance['sensor']):
+            acquired = slot.acquire(deadline, cancel)
+        if not acquired:
+            query.error(instance['sensor'], "sensor busy with other queries for {}".format(QUERY_TIMEOUT), Query.FAIL)
+            return
+        # a bulk query's reads keep the instance busy: fast queries are small enough not to wait them out,
+        # otherwise they wait for idle like any other, the sensor may be busy writing
+        _request(query, instance, headers, deadline, cancel, reports,
+                 wait_idle=lane != FAST or not slot.bulk_running())
+    finally:
+        slot.release()
+        reports.put((instance['sensor'], True))
+
+def _request(query, instance, headers, deadline, cancel, reports, wait_idle=True):
+    if wait_idle:
+        query.progress(instance['sensor'], "Awaiting idle", Query.RECEIVING)
+        with METRICS.timer('docket_sensor_stage_seconds', stage='idle', sensor=instance['sensor']):
+            idle = _ensure_idle(instance, deadline, cancel)
+        if not idle:
+            query.error(instance['sensor'], "not idle or can't connect in {}".format(QUERY_TIMEOUT), Query.FAIL)
+            return
+
+    path = query.path(instance['sensor']+".pcap")
+    chunks = CHUNKS.plan(query.query, instance['sensor']) if CHUNKS else None
+    with METRICS.timer('docket_sensor_stage_seconds', stage='transfer', sensor=instance['sensor']):
+        if chunks is None:
+            received = _fetch(query, instance, query.query, path, headers, deadline, cancel, reports)
+        else:
+            received = _fetch_chunks(query, instance, chunks, path, headers, deadline, cancel, reports)
+    if received is None:
         return
-
+    state = Query.RECEIVED if received > Query.EMPTY_THRESHOLD else Query.EMPTY
+    query.result(instance['sensor'],
+                 msg = '{} bytes received'.format(received),
+                 state = state,
+                 value = received)
+
+def _fetch(query, instance, steno_query, path, headers, deadline, cancel, reports):
+    """ request steno_query from the instance and write the response to path
+        returns the bytes received, or None if the request failed (recorded in query)
+    """
     url = "https://%s:%i/query" % (instance['host'], instance['port'])
     try:
-        query.progress(instance['sensor'], "requesting {}".format(query.query), Query.RECEIVING)
-        rq = requests.post(url, data=query.query, headers=headers,
-                           cert=(instance['cert'], instance['key']),
-                           verify=instance['ca'],
-                           timeout=QUERY_TIMEOUT
-                          )
+        query.progress(instance['sensor'], "requesting {}".format(steno_query), Query.RECEIVING)
+        reports.put((instance['sensor'], False))
+        rq = SESSIONS.get(instance).post(url, data=steno_query, headers=headers,
+                                         timeout=max(_remaining(deadline), 1),
+                                         stream=True
+                                        )
+
+        received = None
+        if rq.status_code == requests.codes.ok:
+            received = _download(rq, path, deadline, cancel)
+            METRICS.inc('docket_sensor_bytes_total', received or 0, sensor=instance['sensor'])
+            if received is None:
+                query.error(instance['sensor'], "Data Timeout({}) - transfer incomplete".format(QUERY_TIMEOUT))
+        elif rq.status_code == requests.codes.bad:
+            query.result(instance['sensor'],
+                         msg = "{} {}".format(rq.status_code, rq.reason),
+                         state = Query.ERROR,
+                         value = -rq.status_code )
+        rq.close()
+        return received
 
     except requests.exceptions.ConnectTimeout as ex:
         query.error(instance['sensor'], "Connection Timeout({}) - {}".format(QUERY_TIMEOUT, ex) )
     except requests.exceptions.ReadTimeout as ex:
+        SESSIONS.reset(instance)
         query.error(instance['sensor'], "Data Timeout({}) - {}".format(QUERY_TIMEOUT, ex))
-    except requests.exceptions.ConnectionError as ex:
-        query.error(instance['sensor'], "Connection Failed - check host:port {}".format(ex))
-        raise ex
+    except requests.exceptions.ChunkedEncodingError as ex:
+        SESSIONS.reset(instance)
+        query.error(instance['sensor'], "Transfer interrupted - {}".format(ex))
     except requests.exceptions.SSLError as ex:
         query.error(instance['sensor'], "SSL Failed - check certificate config: {}".format(ex))
         raise ex
+    except requests.exceptions.ConnectionError as ex:
+        SESSIONS.reset(instance)
+        query.error(instance['sensor'], "Connection Failed - check host:port {}".format(ex))
+        raise ex
+    return None
+
+def _fetch_chunks(query, instance, chunks, path, headers, deadline, cancel, reports):
+    """ chunked execution: request the chunks the cache doesn't have, then stitch them all into path
+        returns the bytes in path, or None if a request failed
+    """
+    sensor = instance['sensor']
+    missing = [c for c in chunks if not c.cached]
+    query.progress(sensor, "{} of {} chunks cached".format(len(chunks) - len(missing), len(chunks)), Query.RECEIVING)
+    METRICS.inc('docket_cache_total', len(chunks) - len(missing), cache='chunk', result='hit')
+    METRICS.inc('docket_cache_total', len(missing), cache='chunk', result='miss')
+    uncached, clips, window = [], {}, PacketFilter.window(query.query)
+    try:
+        for chunk in missing:
+            chunk_path = query.path('{}.{}.chunk'.format(sensor, chunk.start))
+            if _fetch(query, instance, chunk.query, chunk_path, headers, deadline, cancel, reports) is None:
+                return None
+            if chunk.cacheable:
+                CHUNKS.store(chunk, chunk_path)
+            elif os.path.exists(chunk_path):
+                uncached.append(chunk_path)
+                clips[chunk_path] = CHUNKS.clip(chunk, window.before)
+        clips.update((c.path, CHUNKS.clip(c, window.before)) for c in chunks if c.cacheable)
+
+        # a chunk's 'before' takes in its whole last second: each chunk keeps to its own seconds (see ChunkCache.clip),
+        # and the query's window leaves out what aligned chunks add around it
+        merged = merge_pcaps(CHUNKS.files(c for c in chunks if c.cacheable) + uncached, path + '.part',
+                             buffer_size=MERGE_BUFFER, keep=window.match, clips=clips)
+        if not merged.records:
+            os.remove(path + '.part')
+            return 0
+        os.rename(path + '.part', path)
+        return os.path.getsize(path)
+    finally:
+        for chunk_path in uncached:
+            os.remove(chunk_path)
+
+def _remaining(deadline):
+    """ seconds left until deadline """
+    return (deadline - datetime.utcnow()).total_seconds()
+
+def _download(rq, path, deadline, cancel):
+    """ Stream a response body into path.part in DOWNLOAD_CHUNK sized pieces.
+        The part file is renamed to path (atomic) once complete, unless it is 'empty'
+        returns the number of bytes received, or None if the deadline passed or we were cancelled
+    """
+    part = path + '.part'
+    received = 0
+    try:
+        with open(part, 'wb') as f:
+            for chunk in rq.iter_content(chunk_size=DOWNLOAD_CHUNK):
+                if cancel.is_set() or _remaining(deadline) < 0:
+                    received = None
+                    break
+                f.write(chunk)
+                received += len(chunk)
+    except:
+        os.remove(part)
+        raise
+
+    if received is not None and received > Query.EMPTY_THRESHOLD:
+        os.rename(part, path)
     else:
-        if rq.status_code == requests.codes.ok:
-            state = Query.EMPTY
-            if len(rq.content) > Query.EMPTY_THRESHOLD:
-                state = Query.RECEIVED
-                with open(query.path(instance['sensor']+".pcap"), 'wb') as f:
-                    f.write(rq.content)
-            query.result(instance['sensor'],
-                         msg = '{} bytes received'.format(len(rq.content)),
-                         state = state,
-                         value = len(rq.content))
-        elif rq.status_code == requests.codes.bad:
-            query.result(instance['sensor'],
-                         msg = "{} {}".format(rq.status_code, rq.reason),
-                         state = Query.ERROR,
-                         value = -rq.status_code )
-    return
-
-def _ensure_idle(instance):
-    """ Block until instance is idle or QUERY_TIMEOUT is reached """
-    idle = instance.get('idle')
-    now = start = datetime.utcnow()
-    while(((now - idle).total_seconds() > IDLE_TIME) and
-          ((now - start).total_seconds() < QUERY_TIMEOUT)
-         ):
-        Config.logger.debug("sleeping : {}".format(instance['sensor']))
-        sleep(IDLE_SLEEP)
-        try:
-            get_stats(selected_sensors=instance['sensor'])
-        except requests.exceptions.ConnectionError:
-            return False
-        except requests.exceptions.ConnectTimeout:
-            return False
-        except requests.exceptions.ReadTimeout:
-            return False
-
-        idle = instance.get('idle')
-        now = datetime.utcnow()
-    return (now - start).total_seconds() <= QUERY_TIMEOUT
+        os.remove(part)
+    return received
+
+def _ensure_idle(instance, deadline, cancel):
+    """ Block until instance is idle, the deadline passes or we are cancelled """
+    Config.logger.debug("awaiting idle : {}".format(instance['sensor']))
+    return IDLE_TRACKER.wait(instance['sensor'], _remaining(deadline), cancel)
 
 @celery.task(queue='io', default_retry_delay=600, max_retries=1)    # 10 minute retry delay
+@PROFILER.task()
 def merge(query_tuple):
     """ Runs in the 'io' worker
-        merges multiple pcap results using wireshark's mergecap tool
+        merges multiple pcap results into one, ordered by time (see common.pcap)
     """
+    started = time()
     query = Query(qt=query_tuple)
     if not query.load():
         Config.logger.debug("DEBUG: failed to load [{}]".format(query.id))
@@ -266,70 +505,213 @@ def merge(query_tuple):
         Config.logger.debug("Merging: {}".format(','.join(files)))
         merged_file = query.path('merged.tmp')
 
-        cmd = ["/usr/sbin/mergecap", "-F", "pcap", "-w", merged_file]
-        cmd.extend(files)
-
-        from subprocess import call
-        status_code= call(cmd)
-
-        # Cleanup temporary files
-        if status_code == 0:
-            query.progress('merge', "merge complete, finalizing")
-            # make the merged file available (rename is atomic)
-            os.rename(merged_file,
-                      query.path('{}.pcap'.format(MERGED_NAME)))
+        try:
+            merged = merge_pcaps(files, merged_file, buffer_size=MERGE_BUFFER)
+        except (PcapError, IOError, OSError) as e:
+            query.error('merge', "merge failed: {}".format(e))
+        else:
+            if merged.truncated:
+                query.progress('merge', "truncated input: {}".format(', '.join(merged.truncated)))
+            query.progress('merge', "merged {} packets, finalizing".format(merged.records))
+            _count_packets(merged.counts)
+            _store(query, merged_file)
             Config.logger.debug("Removing temp files: {}".format(str(files)))
             for item in files:
                 os.remove(item)
             query.complete()
-        else:
-            query.error('merge', "{} returned {}".format(cmd, status_code))
     elif files:
-        os.rename(files[0],
-                  query.path('{}.pcap'.format(MERGED_NAME)))
+        try:
+            _count_packets({files[0]: count_records(files[0])})
+        except (PcapError, IOError, OSError) as e:
+            Config.logger.error("merge: can't count packets in {}: {}".format(files[0], e))
+        _store(query, files[0])
         query.complete()
     else:
         query.error('merge', "Nothing to merge ?!?")
     query.save(to_file=True)
+    CATALOG.update(query.id, touched=time(), size=_job_size(query))
+    SPACE.update(query.id, 0)
+    METRICS.observe('docket_stage_seconds', time() - started, stage='merge')
+    _finished(query)
+    METRICS.flush()
     cleanup.apply_async(queue='io')
 
+def _count_packets(counts):
+    """ counts - {sensor's pcap path: packets} """
+    for path, packets in counts.items():
+        METRICS.inc('docket_sensor_packets_total', packets, sensor=os.path.basename(path)[:-len('.pcap')])
+
+def _store(query, path):
+    """ make the capture at path query's result: renamed, or compressed (COMPRESS_RESULTS) """
+    merged = query.pcap_path
+    if COMPRESS_RESULTS:
+        compressed, tmp = merged + COMPRESSED_SUFFIX, query.path('merged.gz.tmp')
+        try:
+            size, stored = compress_file(path, tmp, COMPRESS_FRAME, COMPRESS_LEVEL, buffer_size=MERGE_BUFFER)
+            # the index first: a result that's there can be read by range
+            os.rename(tmp + INDEX_SUFFIX, compressed + INDEX_SUFFIX)
+            os.rename(tmp, compressed)
+            os.remove(path)
+            query.progress('merge', "compressed {} to {} bytes".format(size, stored))
+            return
+        except (IOError, OSError, zlib.error) as e:
+            query.progress('merge', "compression failed, storing uncompressed: {}".format(e))
+            # leave nothing of the attempt behind: the catalog doesn't count it, and nothing else removes it
+            for leftover in (tmp, tmp + INDEX_SUFFIX, compressed, compressed + INDEX_SUFFIX):
+                try:
+                    os.remove(leftover)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        Config.logger.error("merge: can't remove {}: {}".format(leftover, e))
+    # make the result available (rename is atomic)
+    os.rename(path, merged)
+
+def refine_from(query, source):
+    """ start a query whose results are filtered from those of 'source', a completed query (see RefineRequest)
+        returns False if the query is a duplicate
+    """
+    try:
+        os.mkdir(query.job_path, 0750)
+    except OSError:
+        Config.logger.info("refine: duplicate request {}".format(query.id))
+        os.utime(query.job_path, None)
+        CATALOG.update(query.id, touched=time())
+        return False
+    CATALOG.update(query.id, created=epoch(query.queried), touched=time(), size=0)
+    _queue_refine(query, source)
+    return True
+
+def _queue_refine(query, source):
+    query.progress('query_task', "covered by {}".format(source), Query.RECEIVED)
+    query.save()
+    # filtering reads the source: keep it from expiring first
+    os.utime(Query.job_path_for_id(source), None)
+    CATALOG.update(source, touched=time())
+    refine.apply_async(queue='io', kwargs=dict(PROFILER.forwarded(), query_tuple=query.tupify(), source=source))
+
 @celery.task(queue='io')
+@PROFILER.task()
+def refine(query_tuple, source):
+    """ Runs in the 'io' worker
+        produces a query's results by filtering those of a completed query that covers it (see Query.covering)
+    """
+    started = time()
+    query = Query(qt=query_tuple)
+    if not query.load():
+        Config.logger.debug("DEBUG: failed to load [{}]".format(query.id))
+    query.progress('refine', 'filtering {}'.format(source), Query.MERGE)
+
+    filtered, stored = query.path('merged.tmp'), Query.stored_pcap_for_id(source)
+    unpacked = query.path('source.tmp')
+    failed = False
+    try:
+        if stored and stored.endswith(COMPRESSED_SUFFIX):
+            # the filter maps its input: decompress the source next to us first
+            with io.open(unpacked, 'wb', buffering=MERGE_BUFFER) as out:
+                for data in FramedReader(stored).read():
+                    out.write(data)
+            stored = unpacked
+        read, written = filter_pcap(stored or Query.pcap_path_for_id(source), filtered,
+                                    PacketFilter.parse(query.query), buffer_size=MERGE_BUFFER)
+    except (PcapError, IOError, OSError, ValueError, zlib.error) as e:
+        # the covering result may be damaged, or have expired meanwhile: the sensors can still answer
+        query.progress('refine', "filtering {} failed, querying the sensors: {}".format(source, e))
+        failed = True
+    else:
+        query.progress('refine', "{} of {} packets from {}".format(written, read, source))
+        _store(query, filtered)
+        query.complete()
+    finally:
+        for path in (unpacked, filtered):
+            if os.path.exists(path):
+                os.remove(path)
+    if failed:
+        query.save()
+        kwargs = dict(PROFILER.forwarded(), query_tuple=query.tupify(), requery=True)
+        lane = query.lane()
+        if lane:
+            kwargs['lane'] = lane
+        query_task.apply_async(queue=LANE_QUEUES.get(lane, 'query'), kwargs=kwargs)
+        return
+    query.save(to_file=True)
+    CATALOG.update(query.id, touched=time(), size=_job_size(query))
+    SPACE.update(query.id, 0)
+    METRICS.observe('docket_stage_seconds', time() - started, stage='refine')
+    _finished(query)
+    METRICS.flush()
+    cleanup.apply_async(queue='io')
+
+def _job_size(query):
+    """ bytes used by a job after its merge: the merged capture (and its index) and the query log """
+    size = 0
+    merged = Query.stored_pcap_for_id(query.id) or query.pcap_path
+    for path in (merged, merged + INDEX_SUFFIX, Query.log_for_id(query.id).path):
+        try:
+            size += os.path.getsize(path)
+        except OSError:
+            pass
+    return size
+
+@celery.task(queue='io')
+def rebuild_catalog():
+    """ Replace the spool catalog with what's on disk """
+    Query.rebuild_catalog()
+
+@celery.task(queue='io')
+@PROFILER.task()
 def cleanup(force=None):
-    """ Delete queries until EXPIRE config is satisfied:
+    """ Delete queries until EXPIRE config is satisfied, least recently touched first:
         1 - Delete anything older than EXPIRE_TIME seconds
         2 - Delete the oldest queries until we have at least EXPIRE_SPACE bytes free
+        Cached chunks (CHUNK_SECONDS) go first: those unused for EXPIRE_TIME, then the least recently used
+        ones until EXPIRE_SPACE is free (they're cheaper to lose than results).
+        At most EXPIRE_BATCH queries are deleted per run, the rest is queued behind the 'io' work
+        (merges) that was waiting on us.
     """
     period = parse_duration(Config.get('CLEANUP_PERIOD', 0))
     now = datetime.utcnow()
     global _LAST_CLEANED
-    if not force and period and _LAST_CLEANED + period < now:
+    if not force and period and _LAST_CLEANED + period > now:
         Config.logger.debug("Cleaned recently, aborting: {}".format(_LAST_CLEANED.strftime(Config.get('DATE_FORMAT'))))
         return
 
     _LAST_CLEANED = datetime.utcnow()
-
-    from heapq import heapify, heappop
-
     Config.logger.info("Running Cleanup: {}".format(now.strftime(ISOFORMAT)))
-    ids = Query.get_unexpired()
-    ordered = [(file_modified(Query.job_path_for_id(i)), i) for i in ids]
-    heapify(ordered)
-    Config.logger.info("Cleaning: {}".format({ v:o.strftime(ISOFORMAT) for o,v in ordered}))
-
-    if EXPIRE_TIME:
-        expiring = []
-        while ordered and ordered[0][0] + EXPIRE_TIME < now:
-            _, q_id = heappop(ordered)
-            expiring.append(q_id)
-        Config.logger.info("Deleting old queries: {}".format(expiring))
-        expiring = Query.expire_now(expiring)
-        if expiring:
-            Config.logger.error("Couldn't delete: {}".format(expiring))
-
-    if EXPIRE_SPACE > 0:
-        free_bytes = spool_space().bytes
-        while ordered and free_bytes < EXPIRE_SPACE:
-            _, q_id = heappop(ordered)
+
+    if not CATALOG.built():
+        Query.rebuild_catalog()
+    oldest = CATALOG.oldest(EXPIRE_BATCH)
+    expire_before = time() - EXPIRE_TIME.total_seconds() if EXPIRE_TIME else None
+    free_bytes = spool_space().bytes if EXPIRE_SPACE > 0 else None
+
+    wanted = max(EXPIRE_SPACE - free_bytes, 0) if free_bytes is not None else 0
+    if CHUNKS and (expire_before is not None or wanted):
+        removed, freed = CHUNKS.expire(expire_before, wanted)
+        Config.logger.info("Deleted {} cached chunks ({} bytes)".format(removed, freed))
+        if free_bytes is not None:
+            free_bytes += freed
+
+    expiring = []
+    for q_id, entry in oldest:
+        if expire_before is not None and entry['touched'] < expire_before:
+            Config.logger.info("Deleting old query: {}".format(q_id))
+        elif free_bytes is not None and free_bytes < EXPIRE_SPACE:
             Config.logger.info("Deleting for space: {}".format(q_id))
-            Query.expire_now(q_id)
-            free_bytes = spool_space().bytes
+        else:
+            # everything else was touched more recently
+            break
+        expiring.append(q_id)
+        if free_bytes is not None:
+            # the catalog knows what each query uses: no need to ask the filesystem again
+            free_bytes += entry.get('size') or 0
+
+    failed = Query.expire_now(expiring)
+    if failed:
+        Config.logger.error("Couldn't delete: {}".format(failed))
+    CATALOG.compact()
+    folded = METRICS.fold()
+    if folded:
+        Config.logger.info("Folded the metrics of {} exited processes".format(folded))
+    if len(expiring) == len(oldest) == EXPIRE_BATCH and len(failed) < len(expiring):
+        # more to do, after the merges queued meanwhile
+        cleanup.apply_async(queue='io', kwargs={'force': True})
@@ -25,8 +25,37 @@ from config import Config
 from common.utils import *
 import unittest
 import os
+from contextlib import contextmanager
 from stat import S_ISDIR, ST_MODE
 
+def _tasks():
+    """ the tasks module, configured with test/test.yaml and without redis """
+    os.environ.setdefault('DOCKET_CONF', os.path.join(os.curdir, 'test', 'test.yaml'))
+    Config.config['DOCKET_NO_REDIS'] = True
+    import tasks
+    return tasks
+
+@contextmanager
+def _spool(*modules):
+    """ SPOOL_DIR and the spool catalog of resources.query (and modules) in a temporary directory """
+    import resources.query
+    from common.catalog import SpoolCatalog
+    from tempfile import mkdtemp
+    from shutil import rmtree
+    modules = (resources.query,) + modules
+    tmp = mkdtemp()
+    saved = Config.config.get('SPOOL_DIR'), [m.CATALOG for m in modules]
+    Config.config['SPOOL_DIR'] = tmp
+    for m in modules:
+        m.CATALOG = SpoolCatalog(os.path.join(tmp, '.catalog'))
+    try:
+        yield tmp
+    finally:
+        Config.config['SPOOL_DIR'] = saved[0]
+        for m, catalog in zip(modules, saved[1]):
+            m.CATALOG = catalog
+        rmtree(tmp)
+
 class testConfig(unittest.TestCase):
     def test_load(self):
         # TODO - Absolute path          "./test/test.yaml"
@@ -98,17 +127,776 @@ class testUtils(unittest.TestCase):
             elif type(v) is tuple:
                 self.assertEqual(v, tuple(k.split()), msg="{}, {}".format(v,k))
 
+    def test_sensor_slot(self):
+        from common.slots import SensorSlot
+        from datetime import datetime
+        from threading import Event
+        from tempfile import mkdtemp
+        from shutil import rmtree
+        tmp = mkdtemp()
+        try:
+            first, second, third = [SensorSlot(tmp, 'sensor-1', limit=2) for _ in range(3)]
+            self.assertTrue(first.try_acquire())
+            self.assertTrue(second.try_acquire())
+            self.assertFalse(third.acquire(datetime.utcnow(), Event()))
+            self.assertTrue(SensorSlot(tmp, 'sensor-2').try_acquire())
+            first.release()
+            self.assertTrue(third.try_acquire())
+            second.release()
+            third.release()
+
+            # lanes: bulk leaves a slot to fast queries, fast ones make way for a starving bulk query
+            from common.slots import FAST, BULK
+            bulk = [SensorSlot(tmp, 'sensor-3', limit=2, lane=BULK, starve=0) for _ in range(2)]
+            fast = [SensorSlot(tmp, 'sensor-3', limit=2, lane=FAST) for _ in range(2)]
+            self.assertFalse(fast[0].bulk_running())
+            self.assertTrue(bulk[0].try_acquire())
+            self.assertFalse(bulk[1].try_acquire())
+            self.assertTrue(fast[0].try_acquire())
+            self.assertTrue(fast[0].bulk_running())
+            bulk[0].release()
+            self.assertFalse(fast[0].bulk_running())
+            self.assertTrue(fast[1].try_acquire())
+            fast[0].release()
+            fast[1].release()
+            self.assertTrue(bulk[0].try_acquire())
+            bulk[1]._starve(True)                           # waited 'starve' seconds in acquire()
+            self.assertTrue(fast[0].try_acquire())          # the reserved slot
+            bulk[0].release()
+            self.assertFalse(fast[1].try_acquire())         # bulk's slot is kept for bulk
+            self.assertTrue(bulk[1].try_acquire())
+            bulk[1]._starve(False)
+            fast[0].release()
+            self.assertTrue(fast[1].try_acquire())
+            # one slot can't be reserved: the lanes share it, even while bulk is starving
+            bulk = SensorSlot(tmp, 'sensor-4', limit=1, lane=BULK)
+            bulk._starve(True)
+            self.assertTrue(SensorSlot(tmp, 'sensor-4', limit=1, lane=FAST).try_acquire())
+        finally:
+            rmtree(tmp)
+
+    def test_idle_tracker(self):
+        from common.idle import IdleTracker, IdleHistograms, IDLE, BUSY, UNREACHABLE
+        from threading import Event
+        from time import time
+        reads = []
+        states = {'busy': [BUSY, BUSY, IDLE], 'gone': [UNREACHABLE]}
+        def read(sensor):
+            reads.append(sensor)
+            return time(), states[sensor].pop(0) if len(states[sensor]) > 1 else states[sensor][0]
+        tracker = IdleTracker(read, idle_time=5, poll=0.01)
+        self.assertTrue(tracker.wait('busy', 2, Event()))
+        self.assertEqual(reads.count('busy'), 3)
+        self.assertTrue(tracker.wait('busy', 2, Event()))     # still idle, no new read
+        self.assertEqual(reads.count('busy'), 3)
+        self.assertFalse(tracker.wait('gone', 2, Event()))
+        # the watcher stopped before the waiter heard it: the next wait starts another one
+        self.assertNotIn('gone', tracker._watchers)
+        states['gone'] = [IDLE]
+        self.assertTrue(tracker.wait('gone', 2, Event()))
+
+        histograms = IdleHistograms()
+        for sampled, state in ((0, BUSY), (3, IDLE), (4, IDLE), (40, BUSY)):
+            histograms.observe('s', sampled, state)
+        counts = histograms.read(['s'])['s']
+        self.assertEqual(counts[BUSY]['buckets']['5'], 1)
+        self.assertEqual(counts[IDLE]['buckets']['60'], 1)
+        self.assertEqual(counts[IDLE]['sum'], 37)
+
+    def test_stats_cache(self):
+        from common.statscache import StatsCache
+        from tempfile import mkdtemp
+        from shutil import rmtree
+        from time import time, sleep
+        tmp = mkdtemp()
+        polls, samples = [], []
+        def process(name):
+            """ a StatsCache as another docket process would have it """
+            def poll(sensor):
+                polls.append((name, sensor))
+                return {'from': name}
+            return StatsCache(poll, ['s1', 's2'], period=0.05, timeout=1,
+                              on_sample=lambda sensor, sampled, stats: samples.append((name, sensor)),
+                              path=os.path.join(tmp, 'stats', '.stats'))
+        def until(test):
+            deadline = time() + 5
+            while not test() and time() < deadline:
+                sleep(0.01)
+        first, second = process('first'), process('second')
+        try:
+            self.assertEqual(first.read(['s1']), {})       # starts the collector
+            until(lambda: 's2' in first.read())
+            self.assertEqual(first.read()['s2'][1], {'from': 'first'})
+
+            # the second process reads the first one's samples and collects nothing itself
+            self.assertEqual(second.read(['s1'])['s1'][1], {'from': 'first'})
+            sleep(0.2)
+            self.assertNotIn('second', [name for name, _ in polls + samples])
+
+            # a refresh is shared, but only the collector's polls reach on_sample
+            self.assertEqual(second.read(['s1'], max_age=0)['s1'][1], {'from': 'second'})
+            self.assertIn(('second', 's1'), polls)
+            self.assertNotIn('second', [name for name, _ in samples])
+
+            # the other process takes over when the collector stops
+            first.stop()
+            until(lambda: ('second', 's2') in samples)
+            self.assertIn(('second', 's2'), samples)
+            self.assertEqual(first.read(['s2'])['s2'][1], {'from': 'second'})
+        finally:
+            first.stop()
+            second.stop()
+            rmtree(tmp)
+
+    def test_spool_catalog(self):
+        from common.catalog import SpoolCatalog
+        from tempfile import mkdtemp
+        from shutil import rmtree
+        tmp = mkdtemp()
+        try:
+            a, b = 'a' * 32, 'b' * 32
+            catalog, other = [SpoolCatalog(os.path.join(tmp, '.catalog')) for _ in range(2)]
+            catalog.update(a, created=1, touched=5, size=0)
+            catalog.update(b, created=2, touched=3, size=0)
+            catalog.update(a, state='Completed', size=100)
+            self.assertEqual(other.ids(), [b, a])
+            self.assertEqual([i for i, _ in other.oldest(1)], [b])
+            self.assertEqual(other.entries([a]), {a: {'created': 1, 'touched': 5, 'size': 100, 'state': 'Completed'}})
+            page, cursor = other.page(1)
+            self.assertEqual([i for i, _ in page], [b])
+            self.assertEqual([i for i, _ in other.page(1, cursor)[0]], [a])
+            self.assertEqual(other.page(1, cursor)[1], None)
+            self.assertEqual([i for i, _ in other.page(5, states={'Completed'}, newest=False)[0]], [a])
+            catalog.remove([b])
+            self.assertEqual(other.ids(), [a])
+
+            os.mkdir(os.path.join(tmp, b))
+            catalog.rebuild(tmp, lambda q_id: {'touched': 7, 'size': 0})
+            self.assertEqual(other.ids(), [b])
+
+            # without redis the log is rewritten once it's mostly history, readers start over from the new one
+            from common import catalog as module
+            saved = module._COMPACT_SLACK
+            module._COMPACT_SLACK = 10
+            try:
+                self.assertFalse(catalog.compact())
+                for touched in range(20):
+                    catalog.update(a, created=1, touched=touched, size=0)
+                catalog.update(b, state='Completed')
+                self.assertEqual(sorted(other.ids()), [a, b])
+                self.assertTrue(catalog.compact())
+                with open(catalog.path) as f:
+                    self.assertEqual(len(f.readlines()), 3)     # the state line and an entry each
+                self.assertFalse(catalog.compact())
+                self.assertEqual(other.entries(), {a: {'created': 1, 'touched': 19, 'size': 0},
+                                                   b: {'touched': 7, 'size': 0, 'state': 'Completed'}})
+            finally:
+                module._COMPACT_SLACK = saved
+        finally:
+            rmtree(tmp)
+
+        # a spool from before the catalog: the first update (query_task) doesn't hide the jobs already there
+        import resources.query
+        from resources.query import Query
+        legacy, new = 'c' * 32, 'd' * 32
+        with _spool() as spool:
+            os.mkdir(os.path.join(spool, legacy))
+            os.mkdir(os.path.join(spool, new))
+            resources.query.CATALOG.update(new, created=1, touched=1, size=0)
+            self.assertEqual(sorted(Query.get_unexpired()), [legacy, new])
+
+    def test_space_ledger(self):
+        from common.reservations import SpaceLedger, ADMITTED, QUEUED, REJECTED
+        from tempfile import mkdtemp
+        from shutil import rmtree
+        tmp = mkdtemp()
+        try:
+            a, b = 'a' * 32, 'b' * 32
+            ledger = SpaceLedger(tmp, default=100, timeout=60)
+            self.assertEqual(ledger.predict(None), 100)
+            self.assertEqual(ledger.admit(a, 100, 150), ADMITTED)
+            self.assertEqual(ledger.admit(b, 100, 150), QUEUED)
+            self.assertEqual(ledger.admit(b, 200, 150), REJECTED)
+            ledger.update(a, 40)
+            self.assertEqual(ledger.admit(b, 100, 150), ADMITTED)
+            self.assertEqual(ledger.outstanding(), 140)
+            ledger.update(a, 0)
+            self.assertIsNone(ledger.reserved(a))
+
+            ledger.observe(1000, 500)
+            self.assertEqual(ledger.predict(1000), 900)
+            self.assertEqual(SpaceLedger(tmp, default=100, timeout=0).outstanding(), 0)
+        finally:
+            rmtree(tmp)
+
+    def test_chunk_cache(self):
+        from common.chunks import ChunkCache
+        from tempfile import mkdtemp
+        from shutil import rmtree
+        from time import time
+        tmp = mkdtemp()
+        try:
+            cache = ChunkCache(tmp, 3600)
+            query = 'host 1.2.3.4 and after 2018-01-01T00:58:00Z and before 2018-01-01T02:03:00Z'
+            chunks = cache.plan(query, 's1')
+            self.assertEqual([c.query for c in chunks], [
+                'host 1.2.3.4 and after 2018-01-01T00:00:00Z and before 2018-01-01T01:00:00Z',
+                'host 1.2.3.4 and after 2018-01-01T01:00:00Z and before 2018-01-01T02:00:00Z',
+                'host 1.2.3.4 and after 2018-01-01T02:00:00Z and before 2018-01-01T03:00:00Z'])
+            self.assertTrue(all(c.cacheable and not c.cached for c in chunks))
+            self.assertIsNone(cache.plan('host 1.2.3.4 or host 1.2.3.5', 's1'))
+
+            fetched = os.path.join(tmp, 'fetched')
+            open(fetched, 'w').close()
+            cache.store(chunks[0], fetched)
+            cache.store(chunks[1], fetched)     # gone: recorded as empty
+            later = cache.plan(query.replace('00:58', '01:30'), 's1')
+            self.assertEqual([c.cached for c in later], [True, False])
+            self.assertEqual([c.cached for c in cache.plan(query, 's2')], [False] * 3)
+            self.assertEqual(cache.files(chunks), [chunks[0].path])
+
+            # files() marks empty chunks used too, expire() takes the least recently used first for space
+            for path in (chunks[0].path, cache._empty(chunks[1].path)):
+                os.utime(path, (time() - 7200,) * 2)
+            cache.files(chunks[1:])
+            self.assertEqual(cache.expire(time() - 3600), (1, 0))
+            self.assertTrue(os.path.exists(cache._empty(chunks[1].path)))
+            cache.store(chunks[2], fetched)
+            self.assertEqual(cache.expire(None, space=0), (0, 0))
+            self.assertEqual(cache.expire(None, space=1), (2, 0))
+            self.assertEqual(os.listdir(tmp), [])
+        finally:
+            rmtree(tmp)
+
 class testIO(unittest.TestCase):
+    @staticmethod
+    def write_pcap(path, times, order='<', nanosecond=False, snaplen=65535, linktype=1):
+        """ write a capture with one 60 byte packet for each (second, microsecond) in times """
+        import struct
+        magic = 0xa1b23c4d if nanosecond else 0xa1b2c3d4
+        with open(path, 'wb') as f:
+            f.write(struct.pack(order + 'IHHiIII', magic, 2, 4, 0, 0, snaplen, linktype))
+            for sec, usec in times:
+                frac = usec * 1000 if nanosecond else usec
+                f.write(struct.pack(order + 'IIII', sec, frac, 60, 60))
+                f.write(struct.pack('>I', sec) * 15)
+
     def test_merge(self):
-        # TODO - write a few caps, call merge, check merged.pcap
-        #from resources.query import Query
-        #q = Query()
-        #from tasks import merge
-        #merge()
-        pass
+        from common.pcap import merge_pcaps, PcapReader, PcapError
+        from tempfile import mkdtemp
+        from shutil import rmtree
+        tmp = mkdtemp()
+        try:
+            a, b, c = [os.path.join(tmp, n) for n in ('a.pcap', 'b.pcap', 'c.pcap')]
+            self.write_pcap(a, [(1, 0), (3, 5), (5, 0)])
+            self.write_pcap(b, [(2, 0), (3, 4)], order='>', snaplen=1500)
+            self.write_pcap(c, [(4, 0)], nanosecond=True)
+            out = os.path.join(tmp, 'merged.pcap')
+            merged = merge_pcaps([a, b, c], out)
+            self.assertEqual(merged, (6, [], {a: 3, b: 2, c: 1}))
+
+            with PcapReader(out) as reader:
+                self.assertEqual((reader.order, reader.nanosecond), ('<', False))
+                self.assertEqual(reader.snaplen, 65535)
+                times = [ts for ts, _ in reader]
+            self.assertEqual(times, [1000000, 2000000, 3000004, 3000005, 4000000, 5000000])
+
+            # each input keeps to its own [start, end) seconds: chunks sharing a boundary second don't repeat it
+            self.assertEqual(merge_pcaps([a, b], out, clips={a: (0, 3), b: (3, 4)}).records, 2)
+            with PcapReader(out) as reader:
+                self.assertEqual([ts for ts, _ in reader], [1000000, 3000004])
+
+            # a partial record at the end of a capture is reported, not merged
+            with open(a, 'ab') as f:
+                f.write(b'\x00' * 10)
+            self.assertEqual(merge_pcaps([a, b], out), (5, [a], {a: 3, b: 2}))
+
+            self.write_pcap(c, [(4, 0)], linktype=105)
+            with self.assertRaises(PcapError):
+                merge_pcaps([b, c], out)
+        finally:
+            rmtree(tmp)
+
+    def test_stream_merge(self):
+        from common.pcap import PcapReader, StreamMerger
+        from tempfile import mkdtemp
+        from shutil import rmtree
+        tmp = mkdtemp()
+        try:
+            a, b = os.path.join(tmp, 'a.pcap'), os.path.join(tmp, 'b.pcap')
+            self.write_pcap(a, [(1, 0), (3, 0)])
+            self.write_pcap(b, [(2, 0)])
+            growing = [True]
+            merger = StreamMerger(skew=60)
+            merger.add(PcapReader(a))
+            merger.add(PcapReader(b, follow=lambda: growing[0]))
+            # b might still deliver something older than a's second packet
+            self.assertEqual(len(list(merger.available())), 2)
+            self.assertFalse(merger.done)
+            growing[0] = False
+            self.assertEqual(len(list(merger.available())), 1)
+            self.assertTrue(merger.done)
+            merger.close()
+        finally:
+            rmtree(tmp)
+
+    def test_stream_pcap(self):
+        """ a merge finishing while the stream opens the sensors' captures: the merged result is sent instead """
+        import resources.query
+        from resources.query import Query, stream_pcap
+        saved = resources.query._SENSORS, resources.query._open_sensor_pcap
+        with _spool() as spool:
+            query = Query(query='host 1.2.3.4')
+            os.makedirs(Query.job_path_for_id(query.id))
+            def open_sensor_pcap(q_id, sensor):
+                # merged and removed just before we got to it
+                self.write_pcap(Query.pcap_path_for_id(q_id), [(1, 0), (2, 0)])
+                return None
+            try:
+                resources.query._SENSORS = ['s1']
+                resources.query._open_sensor_pcap = open_sensor_pcap
+                streamed = b''.join(stream_pcap(query.id))
+            finally:
+                resources.query._SENSORS, resources.query._open_sensor_pcap = saved
+            with open(Query.pcap_path_for_id(query.id), 'rb') as f:
+                self.assertEqual(streamed, f.read())
+
+    def test_packet_filter(self):
+        from common.pcap import global_header, RECORD_HEADER, PcapReader
+        from common.pcapfilter import PacketFilter, filter_pcap
+        from socket import inet_aton
+        from tempfile import mkdtemp
+        from shutil import rmtree
+        import struct
+        def packet(sec, src, dst, sport, dport, proto=6):
+            ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 40, 0, 0, 64, proto, 0, inet_aton(src), inet_aton(dst))
+            data = b'\0' * 12 + b'\x08\x00' + ip + struct.pack('!HH', sport, dport) + b'\0' * 16
+            return RECORD_HEADER.pack(sec, 0, len(data), len(data)) + data
+
+        wide = PacketFilter.parse('net 10.0.0.0/8 and after 2018-01-01T00:00:00Z and before 2018-01-02T00:00:00Z')
+        narrow = PacketFilter.parse('host 10.1.2.3 and udp and port 53 and after 2018-01-01T01:00:00Z')
+        self.assertTrue(wide.covers(narrow))
+        self.assertFalse(narrow.covers(wide))
+        self.assertTrue(PacketFilter.parse('net 10.1.0.0/255.255.0.0').covers(PacketFilter.parse('net 10.1.2.0/24')))
+        with self.assertRaises(ValueError):
+            PacketFilter.parse('host 10.1.2.3 or host 10.1.2.4')
+
+        tmp = mkdtemp()
+        try:
+            path, out = os.path.join(tmp, 'in.pcap'), os.path.join(tmp, 'out.pcap')
+            with open(path, 'wb') as f:
+                f.write(global_header())
+                f.write(packet(1514768400, '10.1.2.3', '8.8.8.8', 1000, 53, proto=17))
+                f.write(packet(1514768401, '10.1.2.3', '8.8.8.8', 1000, 53))
+                f.write(packet(1514768402, '10.1.2.4', '8.8.8.8', 1000, 53, proto=17))
+                f.write(packet(1514768403, '8.8.8.8', '10.1.2.3', 53, 1000, proto=17))
+                f.write(packet(1514764799, '10.1.2.3', '8.8.8.8', 1000, 53, proto=17))
+                f.write(packet(1514768404, '10.1.2.3', '8.8.8.8', 1000, 53, proto=17)[:30])
+            self.assertEqual(filter_pcap(path, out, narrow), (5, 2))
+            with PcapReader(out) as reader:
+                self.assertEqual([ts // 1000000 for ts, _ in reader], [1514768400, 1514768403])
+            with PcapReader(path) as reader:
+                spans = list(reader.spans())
+                self.assertEqual(len(spans), 5)
+                self.assertTrue(reader.truncated)
+                self.assertEqual([narrow.match(reader.map, offset) for offset, _ in spans],
+                                 [True, False, False, True, False])
+        finally:
+            rmtree(tmp)
+
+    def test_frames(self):
+        from common.frames import compress_file, FramedReader, INDEX_SUFFIX
+        from tempfile import mkdtemp
+        from shutil import rmtree
+        import struct
+        import gzip
+        tmp = mkdtemp()
+        try:
+            path, out = os.path.join(tmp, 'in.pcap'), os.path.join(tmp, 'in.pcap.gz')
+            data = b''.join(struct.pack('<I', i) for i in range(5000))
+            with open(path, 'wb') as f:
+                f.write(data)
+            self.assertEqual(compress_file(path, out, 1000)[0], len(data))
+            self.assertEqual(gzip.open(out).read(), data)
+            reader = FramedReader(out, chunk_size=100)
+            self.assertEqual(reader.size, len(data))
+            for start, stop in ((0, None), (999, 1001), (4500, 20000), (len(data), None)):
+                self.assertEqual(b''.join(reader.read(start, stop)), data[start:stop])
+            os.remove(out + INDEX_SUFFIX)
+            self.assertEqual(b''.join(FramedReader(out).read(2500, 2600)), data[2500:2600])
+        finally:
+            rmtree(tmp)
+
+    def test_metrics(self):
+        from common.metrics import MetricsRegistry
+        from tempfile import mkdtemp
+        from shutil import rmtree
+        tmp = mkdtemp()
+        try:
+            metrics = MetricsRegistry(os.path.join(tmp, 'metrics'), flush=3600)
+            metrics.counter('t_bytes_total', 'bytes')
+            metrics.histogram('t_seconds', 'seconds', buckets=(1, 10))
+            metrics.gauge('t_free', 'free', lambda: {(('kind', 'disk'),): 3})
+            metrics.inc('t_bytes_total', 2**40, sensor='a')
+            metrics.inc('t_bytes_total', 1, sensor='a')
+            for seconds in (0.5, 5, 50):
+                metrics.observe('t_seconds', seconds, stage='merge')
+            text = metrics.render().splitlines()
+            self.assertIn('t_bytes_total{sensor="a"} 1099511627777', text)
+            self.assertIn('t_seconds_bucket{stage="merge",le="10"} 2', text)
+            self.assertIn('t_seconds_bucket{stage="merge",le="+Inf"} 3', text)
+            self.assertIn('t_seconds_sum{stage="merge"} 55.5', text)
+            self.assertIn('t_free{kind="disk"} 3', text)
+            # another process's totals are added in
+            other = MetricsRegistry(metrics.path)
+            other._pid, other._file = os.getpid(), os.path.join(other.path, 'other.1.0')
+            other.inc('t_bytes_total', 1, sensor='a')
+            other.flush()
+            self.assertIn('t_bytes_total{sensor="a"} 1099511627778', metrics.render().splitlines())
+            # the files of this host's exited processes are folded into one, the totals don't change
+            from socket import gethostname
+            from subprocess import Popen
+            for run in range(2):
+                exited = Popen(['true'])
+                exited.wait()
+                gone = MetricsRegistry(metrics.path)
+                gone._pid, gone._file = os.getpid(), os.path.join(gone.path, '{}.{}.0'.format(gethostname(), exited.pid))
+                gone.inc('t_bytes_total', 10, sensor='a')
+                gone.flush()
+                self.assertEqual(metrics.fold(), 1)
+                self.assertEqual(metrics.fold(), 0)
+            self.assertEqual(sorted(os.listdir(metrics.path)),
+                             sorted(['.lock', gethostname() + '.folded', 'other.1.0', os.path.basename(metrics._file)]))
+            self.assertIn('t_bytes_total{sensor="a"} 1099511627798', metrics.render().splitlines())
+        finally:
+            rmtree(tmp)
+
+    def test_query_task(self):
+        """ every sensor is asked at once: one failing doesn't stop the others, the slowest ends the task """
+        from threading import Event
+        from common.reservations import SpaceLedger
+        from common.metrics import MetricsRegistry
+        from resources.query import Query
+        tasks = _tasks()
+        saved = {k: getattr(tasks, k) for k in ('_INSTANCES', '_SLOT_DIR', '_request', 'REUSE_RESULTS',
+                                                 'SPACE', 'space_available', 'METRICS')}
+        merges, finished = [], []
+        first_done = Event()
+        def request(query, instance, headers, deadline, cancel, reports, wait_idle=True):
+            sensor = instance['sensor']
+            reports.put((sensor, False))
+            if sensor == 's1':
+                first_done.wait(5)             # finishes last, though it started first
+            if sensor == 's2':
+                query.error(sensor, "Connection Failed", Query.FAIL)
+            else:
+                query.result(sensor, msg='100 bytes received', state=Query.RECEIVED, value=100)
+                finished.append(sensor)
+            if sensor == 's3':
+                first_done.set()
+        tasks.merge.apply_async = lambda **kwargs: merges.append(kwargs['kwargs']['query_tuple'])
+        try:
+            with _spool(tasks) as spool:
+                tasks._INSTANCES = [{'sensor': s, 'host': s, 'port': 443} for s in ('s1', 's2', 's3')]
+                tasks._SLOT_DIR = os.path.join(spool, '.slots')
+                tasks._request = request
+                tasks.REUSE_RESULTS = False
+                tasks.SPACE = SpaceLedger(os.path.join(spool, '.reserved'), default=100, timeout=60)
+                tasks.space_available = lambda: 10**9
+                tasks.METRICS = MetricsRegistry(os.path.join(spool, '.metrics'))
+                tasks.METRICS._metrics = saved['METRICS']._metrics
+                query = Query(query='host 1.2.3.4 and after 2018-01-01T00:00:00Z and before 2018-01-01T01:00:00Z')
+                query.progress(Query.CREATED, state=Query.CREATED)
+
+                tasks.query_task(query.tupify())
+                self.assertEqual(finished, ['s3', 's1'])
+                done = Query(q_id=query.id)
+                self.assertEqual(done.state, Query.FAIL)
+                self.assertEqual(sorted(e.name for e in done.successes), ['s1', 's3'])
+                self.assertEqual([e.name for e in done.errors if e.name != 'query_task'], ['s2'])
+                # results are recorded as they arrive, and merged once all of them are in
+                results = [e.name for e in done.events if e.name in ('s1', 's3') and e.state == Query.RECEIVED]
+                self.assertEqual(results, ['s3', 's1'])
+                self.assertEqual(len(merges), 1)
+                self.assertEqual(tasks.SPACE.reserved(query.id), 200)
+
+                # a repeated request is a duplicate: nothing is asked again
+                tasks.query_task(query.tupify())
+                self.assertEqual((finished, len(merges)), (['s3', 's1'], 1))
+        finally:
+            for k, v in saved.items():
+                setattr(tasks, k, v)
+            del tasks.merge.apply_async
+
+    def test_fetch_chunks(self):
+        """ stitched chunks hold the query's whole last second, like the stenographer query, aligned or not """
+        from calendar import timegm
+        from datetime import datetime
+        from common.chunks import ChunkCache
+        from common.metrics import MetricsRegistry
+        from common.pcap import PcapReader
+        from common.pcapfilter import PacketFilter
+        from resources.query import Query
+        tasks = _tasks()
+        saved = tasks.CHUNKS, tasks._fetch, tasks.METRICS
+        base = timegm(datetime(2018, 1, 1).timetuple())
+        packets = [(base + s, u) for s, u in ((1799, 0), (1800, 0), (3599, 500000), (3600, 0), (3600, 500000),
+                                                (5400, 500000), (5401, 0))]
+        def fetch(query, instance, chunk_query, path, headers, deadline, cancel, reports):
+            # the sensor's answer takes in the whole second of its 'before'
+            window = PacketFilter.parse(chunk_query)
+            self.write_pcap(path, [p for p in packets if window.after <= p[0] <= window.before])
+            return os.path.getsize(path)
+        try:
+            with _spool(tasks) as spool:
+                tasks._fetch = fetch
+                tasks.METRICS = MetricsRegistry(os.path.join(spool, '.metrics'))
+                tasks.METRICS._metrics = saved[2]._metrics
+                for before, wanted in (('01:30:00', [(1800, 0), (3599, 500000), (3600, 0), (3600, 500000), (5400, 500000)]),
+                                       ('01:00:00', [(1800, 0), (3599, 500000), (3600, 0), (3600, 500000)])):
+                    tasks.CHUNKS = ChunkCache(os.path.join(spool, '.chunks' + before), 3600)
+                    query = Query(query='host 1.2.3.4 and after 2018-01-01T00:30:00Z and before 2018-01-01T{}Z'.format(before))
+                    os.makedirs(Query.job_path_for_id(query.id))
+                    chunks = tasks.CHUNKS.plan(query.query, 's1')
+                    out = query.path('s1.pcap')
+                    self.assertTrue(tasks._fetch_chunks(query, {'sensor': 's1'}, chunks, out, {}, None, None, None))
+                    with PcapReader(out) as reader:
+                        self.assertEqual([ts for ts, _ in reader], [(base + s) * 1000000 + u for s, u in wanted])
+        finally:
+            tasks.CHUNKS, tasks._fetch, tasks.METRICS = saved
+
+    def test_store(self):
+        """ a failed compression leaves the result uncompressed, and nothing of the attempt """
+        from resources.query import Query
+        tasks = _tasks()
+        saved = tasks.COMPRESS_RESULTS, tasks.compress_file
+        def compress_file(path, out_path, *args, **kwargs):
+            for partial in (out_path, out_path + tasks.INDEX_SUFFIX):
+                open(partial, 'wb').close()
+            raise IOError(28, 'No space left on device')
+        try:
+            with _spool(tasks):
+                tasks.COMPRESS_RESULTS, tasks.compress_file = True, compress_file
+                query = Query(query='host 1.2.3.4')
+                os.makedirs(Query.job_path_for_id(query.id))
+                with open(query.path('merged.part'), 'wb') as f:
+                    f.write(b'pcap')
+                tasks._store(query, query.path('merged.part'))
+                self.assertEqual(os.listdir(query.job_path), [os.path.basename(query.pcap_path)])
+                self.assertEqual(Query.stored_pcap_for_id(query.id), query.pcap_path)
+        finally:
+            tasks.COMPRESS_RESULTS, tasks.compress_file = saved
+
+    def test_refine_fallback(self):
+        """ a covering result that can't be filtered sends the query to the sensors, it doesn't fail it """
+        from resources.query import Query
+        tasks = _tasks()
+        queued = []
+        tasks.query_task.apply_async = lambda **kwargs: queued.append(kwargs['kwargs'])
+        try:
+            with _spool(tasks):
+                query = Query(query='host 1.2.3.4')
+                os.makedirs(Query.job_path_for_id(query.id))
+                query.progress(Query.CREATED, state=Query.CREATED)
+                query.save()
+                tasks.refine(query.tupify(), 'expired')         # its result is gone
+                self.assertEqual([(k['query_tuple'], k['requery']) for k in queued], [(query.tupify(), True)])
+                done = Query(q_id=query.id)
+                self.assertTrue(done.load())
+                self.assertNotEqual(done.state, Query.FAIL)
+                self.assertEqual([f for f in os.listdir(query.job_path) if f.endswith('.tmp')], [])
+        finally:
+            del tasks.query_task.apply_async
+
+    def test_requester_idle(self):
+        """ fast queries wait for idle like the others, unless a bulk query is reading from the sensor """
+        from datetime import datetime, timedelta
+        from threading import Event
+        from common.slots import SensorSlot, FAST, BULK
+        from resources.query import Query
+        tasks = _tasks()
+        saved = {k: getattr(tasks, k) for k in ('_SLOT_DIR', '_ensure_idle', '_fetch')}
+        waits = []
+        def ensure_idle(instance, deadline, cancel):
+            waits.append(instance['sensor'])
+            return True
+        try:
+            with _spool(tasks) as spool:
+                tasks._SLOT_DIR = os.path.join(spool, '.slots')
+                tasks._ensure_idle = ensure_idle
+                tasks._fetch = lambda *args: None
+                instance = {'sensor': 's1', 'host': 's1', 'port': 443, 'concurrency': 2}
+                query = Query(query='host 1.2.3.4')
+                def request(lane):
+                    deadline = datetime.utcnow() + timedelta(seconds=5)
+                    tasks._requester(query, instance, None, deadline, Event(), tasks.Queue(), lane)
+
+                request(FAST)
+                self.assertEqual(waits, ['s1'])
+                bulk = SensorSlot(tasks._SLOT_DIR, 's1', limit=2, lane=BULK)
+                self.assertTrue(bulk.try_acquire())
+                request(FAST)
+                self.assertEqual(waits, ['s1'])
+                bulk.release()
+                request(FAST)
+                request(BULK)
+                self.assertEqual(waits, ['s1'] * 3)
+        finally:
+            for k, v in saved.items():
+                setattr(tasks, k, v)
+
+    def test_sessions(self):
+        from common.metrics import MetricsRegistry
+        from common.sessions import SessionPool
+        from tempfile import mkdtemp
+        from shutil import rmtree
+        import socket
+        tmp = mkdtemp()
+        try:
+            metrics = MetricsRegistry(os.path.join(tmp, 'metrics'), flush=3600)
+            sessions = SessionPool(metrics)
+            closed = socket.socket()
+            closed.bind(('127.0.0.1', 0))
+            port = closed.getsockname()[1]
+            closed.close()
+            instance = {'sensor': 's1', 'host': '127.0.0.1', 'port': port, 'cert': 'c', 'key': 'k', 'ca': 'ca'}
+
+            session = sessions.get(instance)
+            self.assertIs(sessions.get(instance), session)
+            adapter = session.get_adapter('https://127.0.0.1')
+            pool = adapter.get_connection('https://127.0.0.1:{}/'.format(port))
+            with self.assertRaises(Exception):
+                pool._new_conn().connect()      # a handshake was needed (and refused)
+            session.hooks['response'][0](None)
+            session.hooks['response'][0](None)
+
+            # counted in the shared metrics: other processes' requests add up
+            other = MetricsRegistry(metrics.path)
+            other._pid, other._file = os.getpid(), os.path.join(other.path, 'other.1.0')
+            other.inc('docket_sensor_requests_total', 3, sensor='s1')
+            other.flush()
+            self.assertEqual(sessions.counters([instance]),
+                             {'s1': {'requests': 5, 'handshakes': 1, 'handshakes_avoided': 4}})
+
+            # reset swaps in a new session, the old one stays usable by the requests holding it
+            sessions.reset(instance)
+            self.assertIsNot(sessions.get(instance), session)
+            self.assertEqual(len(adapter.poolmanager.pools), 1)
+            sessions.reset(dict(instance, sensor='s2'))
+            self.assertNotIn('s2', sessions._sessions)
+        finally:
+            rmtree(tmp)
+
+    def test_profiler(self):
+        from common.profiling import Profiler
+        from tempfile import mkdtemp
+        from shutil import rmtree
+        from time import sleep
+        tmp = mkdtemp()
+        try:
+            profiler = Profiler(tmp, rate=0, interval=0.001, keep=2)
+
+            @profiler.task()
+            def task(seconds):
+                sleep(seconds)
+                return profiler.forwarded()
+
+            self.assertEqual(task(0), {})
+            self.assertEqual(profiler.list(), [])       # rate 0: only forced runs
+            for i in range(3):
+                self.assertEqual(task(0.05, profile=True), {'profile': True})
+            profiles = profiler.list()
+            self.assertEqual(len(profiles), 2)          # keep
+            self.assertTrue(profiles[0]['name'].endswith('.task.{}.folded'.format(os.getpid())))
+            with open(profiler.file(profiles[0]['name'])) as f:
+                stacks = dict(line.rsplit(' ', 1) for line in f)
+            # the task sleeps for 50 intervals, the first samples may be of the sampler starting
+            self.assertGreater(sum(int(count) for stack, count in stacks.items() if ';tests.py:task:' in stack), 0)
+            self.assertIsNone(profiler.file('../' + profiles[0]['name']))
+            self.assertEqual(profiler.forwarded(), {})
+        finally:
+            rmtree(tmp)
 
     def test_cleanup(self):
-        pass
+        from collections import namedtuple
+        from datetime import datetime, timedelta
+        from time import time
+        tasks = _tasks()
+        Space = namedtuple('Space', ['bytes', 'nodes'])
+        free, requeued = [0], []
+        saved = {k: getattr(tasks, k) for k in ('EXPIRE_TIME', 'EXPIRE_SPACE', 'EXPIRE_BATCH', 'spool_space', 'CHUNKS')}
+        period = Config.get('CLEANUP_PERIOD', 0)
+        tasks.spool_space = lambda: Space(free[0], 1000)
+        tasks.cleanup.apply_async = lambda **kwargs: requeued.append(kwargs)
+
+        def jobs(spool, *ages):
+            """ job directories from before the catalog, touched 'ages' hours ago, 20 bytes each """
+            ids = []
+            for i, age in enumerate(ages):
+                q_id = '{:032x}'.format(i)
+                os.mkdir(os.path.join(spool, q_id))
+                with open(os.path.join(spool, q_id, 'merged.pcap'), 'wb') as f:
+                    f.write(b'\0' * 20)
+                os.utime(os.path.join(spool, q_id), (time() - age * 3600,) * 2)
+                ids.append(q_id)
+            return ids
+
+        def expire(expire_time=0, expire_space=0, batch=50):
+            tasks.EXPIRE_TIME, tasks.EXPIRE_SPACE, tasks.EXPIRE_BATCH = timedelta(hours=expire_time), expire_space, batch
+            tasks.cleanup(force=True)
+
+        from resources.query import Query
+        try:
+            # EXPIRE_TIME
+            with _spool(tasks) as spool:
+                a, b, c = jobs(spool, 3, 2, 0)
+                expire(expire_time=1)
+                self.assertEqual(Query.get_unexpired(), [c])
+            # EXPIRE_SPACE: the oldest go until there's enough free, counting the sizes they had
+            with _spool(tasks) as spool:
+                a, b, c = jobs(spool, 3, 2, 1)
+                free[0] = 70
+                expire(expire_space=100)
+                self.assertEqual(Query.get_unexpired(), [c])
+            # EXPIRE_SPACE: cached chunks go before any query
+            with _spool(tasks) as spool:
+                from common.chunks import ChunkCache
+                a, = jobs(spool, 3)
+                tasks.CHUNKS = ChunkCache(os.path.join(spool, '.chunks'), 3600)
+                os.makedirs(os.path.join(spool, '.chunks', 'key'))
+                chunk = os.path.join(spool, '.chunks', 'key', 's1.0.pcap')
+                with open(chunk, 'wb') as f:
+                    f.write(b'\0' * 30)
+                free[0] = 80
+                expire(expire_space=100)
+                self.assertEqual(Query.get_unexpired(), [a])
+                self.assertFalse(os.path.exists(chunk))
+                tasks.CHUNKS = None
+            # EXPIRE_BATCH: a full batch queues the next run
+            with _spool(tasks) as spool:
+                a, b, c, d = jobs(spool, 4, 3, 2, 0)
+                expire(expire_time=1, batch=2)
+                self.assertEqual(Query.get_unexpired(), [c, d])
+                self.assertEqual(requeued, [{'queue': 'io', 'kwargs': {'force': True}}])
+                expire(expire_time=1, batch=2)
+                self.assertEqual(Query.get_unexpired(), [d])
+                self.assertEqual(len(requeued), 1)
+            # CLEANUP_PERIOD: unforced runs within the period are skipped
+            with _spool(tasks) as spool:
+                a, b = jobs(spool, 2, 0)
+                tasks.EXPIRE_TIME = timedelta(hours=1)
+                Config.config['CLEANUP_PERIOD'] = '1h'
+                tasks._LAST_CLEANED = datetime.utcnow()
+                tasks.cleanup()
+                self.assertEqual(Query.get_unexpired(), [a, b])
+                tasks._LAST_CLEANED = datetime.utcnow() - timedelta(hours=2)
+                tasks.cleanup()
+                self.assertEqual(Query.get_unexpired(), [b])
+        finally:
+            for k, v in saved.items():
+                setattr(tasks, k, v)
+            del tasks.cleanup.apply_async
+            Config.config['CLEANUP_PERIOD'] = period
 
 class testQuery(unittest.TestCase):
     app = Flask('test')
@@ -186,5 +974,127 @@ class testQuery(unittest.TestCase):
         # TODO - test JSON -> q_fields
         # TODO - test q_fields -> query strings
 
+    def test_query_index_clauses(self):
+        from common.queryindex import parse_clauses, field_clauses
+        query = 'host 1.2.3.4 and net 10.0.0.0/8 and port 53 and ip proto 17 and udp and after 2018-01-01T00:00:00Z'
+        clauses = ['host:1.2.3.4', 'net:10.0.0.0/8', 'port:53', 'proto:17']
+        self.assertEqual(parse_clauses(query), clauses)
+        self.assertEqual(parse_clauses('tcp and port 80'), parse_clauses('ip proto 6 and port 80'))
+        self.assertEqual(parse_clauses('host 1.2.3.4 or host 5.6.7.8'), [])
+        fields = {'host': ['1.2.3.4'], 'net': ['10.0.0.0/8'], 'port': ['53'], 'proto': '17', 'proto-name': 'UDP'}
+        self.assertEqual(field_clauses(fields), clauses)
+        self.assertEqual(field_clauses({'proto-name': 'tcp'}), ['proto:6'])
+
+    def test_covering(self):
+        """ a completed query's results cover a narrower one: more clauses, a host or net inside its net """
+        try:
+            import fakeredis
+        except ImportError:
+            self.skipTest("covering needs redis: install fakeredis")
+        from time import time
+        from common import queryindex
+        import resources.query
+        from resources.query import Query
+        window = 'after 2018-01-01T00:00:00Z and before 2018-01-01T02:00:00Z'
+        narrow = 'after 2018-01-01T00:30:00Z and before 2018-01-01T01:00:00Z'
+        Config._redis = fakeredis.FakeRedis()
+        try:
+            with _spool():
+                queryindex.rebuild([])
+                def completed(query, size):
+                    done = Query(query=query)
+                    done.complete()
+                    done.save()
+                    resources.query.CATALOG.update(done.id, touched=time(), size=size)
+                    os.makedirs(done.job_path)
+                    open(done.pcap_path, 'wb').close()
+                    return done
+                done = completed('net 10.0.0.0/8 and ' + window, 100)
+                for covered in ('net 10.0.0.0/8 and port 53', 'host 10.1.2.3', 'net 10.1.0.0/16 and udp'):
+                    self.assertEqual(Query.covering(covered + ' and ' + narrow), done.id, msg=covered)
+                for uncovered in ('host 11.1.2.3', 'net 10.0.0.0/7'):
+                    self.assertIsNone(Query.covering(uncovered + ' and ' + narrow), msg=uncovered)
+                self.assertIsNone(Query.covering('host 10.1.2.3 and ' + window.replace('02:00', '03:00')))
+                # protocols match by number, however they were written
+                tcp = completed('ip proto 6 and ' + window, 100)
+                self.assertEqual(Query.covering('tcp and port 80 and ' + narrow), tcp.id)
+                # a query with time clauses only covers everything in its window, a query without clauses too
+                everything = completed(window, 1000)
+                self.assertEqual(Query.covering('host 11.1.2.3 and ' + narrow), everything.id)
+                self.assertEqual(Query.covering(narrow), everything.id)
+                self.assertEqual(Query.covering('host 10.1.2.3 and ' + narrow), done.id)     # the smallest
+                queryindex.remove([done.id])
+                self.assertEqual(Config.redis().smembers('Docket.Index.nets'), set())
+        finally:
+            Config._redis = None
+
+    def test_load_many(self):
+        """ one batch: missing and corrupt queries don't keep the others from loading """
+        from json import dumps
+        from resources.query import Query
+        with _spool():
+            good, corrupt = Query(query='host 1.2.3.4'), Query(query='host 1.2.3.5')
+            for q in (good, corrupt):
+                os.makedirs(Query.job_path_for_id(q.id))
+                q.progress(Query.CREATED, state=Query.CREATED)
+                q.save()
+            with open(Query.log_for_id(corrupt.id).path, 'ab') as f:
+                f.write(dumps(['e', ['yesterday', 'sensor-1', None, None]]) + '\n')
+            missing = 'f' * 32
+
+            loaded = Query.load_many([good.id, missing, corrupt.id])
+            self.assertEqual(sorted(loaded), sorted([good.id, missing, corrupt.id]))
+            self.assertEqual((loaded[good.id].query, loaded[good.id].events), (good.query, good.events))
+            self.assertEqual((loaded[missing].query, loaded[missing].events), (None, []))
+            self.assertEqual((loaded[corrupt.id].query, loaded[corrupt.id].events), (None, []))
+            self.assertEqual(Query.load_many([]), {})
+
+    def test_event_log(self):
+        from resources.query import Query
+        from common.eventlog import EventLog
+        from tempfile import mkdtemp
+        from shutil import rmtree
+        tmp = mkdtemp()
+        try:
+            q = Query(query='host 1.2.3.4')
+            q.progress(Query.CREATED, state=Query.CREATED)
+            q.progress('query_task', 'Starting requests', Query.RECEIVING)
+            q.result('sensor-1', '100 bytes received', Query.RECEIVED, 100)
+            log = EventLog('test', os.path.join(tmp, 'query.log'))
+            log.append([Query.encode_event(e) for e in q.events[:2]], {'query': q.query}, to_file=True)
+            state, records, cursor = log.read(from_file=True)
+            self.assertEqual(state, {'query': q.query})
+            self.assertEqual([Query.decode_event(r) for r in records], q.events[:2])
+
+            log.append([Query.encode_event(q.events[2])], {'state': Query.RECEIVED}, to_file=True)
+            state, records, cursor = log.read(cursor, from_file=True)
+            self.assertEqual(state, {'state': Query.RECEIVED})
+            self.assertEqual([Query.decode_event(r) for r in records], q.events[2:])
+
+            with open(log.path, 'ab') as f:
+                f.write(b'["e", {"partial')          # a writer mid-append
+            self.assertEqual(log.read(cursor, from_file=True), ({}, [], cursor))
+
+            # a damaged line anywhere else is skipped: the lines around it still load
+            with open(log.path, 'ab') as f:
+                f.write(b'\n["e", 1, 2]\n')
+            log.append([Query.encode_event(q.events[2])], {'state': Query.RECEIVED}, to_file=True)
+            state, records, _ = log.read(from_file=True)
+            self.assertEqual(state, {'query': q.query, 'state': Query.RECEIVED})
+            self.assertEqual([Query.decode_event(r) for r in records], q.events + q.events[2:])
+            loaded = Query()
+            self.assertTrue(loaded.load(path=log.path))
+            self.assertEqual((loaded.query, loaded.state), (q.query, Query.RECEIVED))
+
+            with self.assertRaises(ValueError):
+                Query.decode_event(['yesterday', 'sensor-1', None, None])
+            import yaml
+            legacy = Query()
+            self.assertTrue(legacy.update(yaml.dump(q)))
+            self.assertEqual((legacy.query, legacy.events), (q.query, q.events))
+            self.assertFalse(legacy.update("!!python/object/apply:os.getcwd []"))
+        finally:
+            rmtree(tmp)
+
 
 unittest.main()
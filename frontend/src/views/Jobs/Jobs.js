@@ -38,14 +38,19 @@ class Jobs extends Component {
   updateTable() {
     var Config = require('Config');
 
-    var statusApi = fetch( Config.serverUrl + '/jobs/' )
+    /* the newest page of jobs, and the urls of those jobs only */
+    var statusApi = fetch( Config.serverUrl + '/jobs/?limit=100&fields=id,time,query,state' )
       .then(results => {
         return results.json();
       })
 
-    var urlsApi = fetch( Config.serverUrl + '/urls/' )
-      .then(results => {
-        return results.json();
+    var urlsApi = statusApi.then(jobs => {
+        if (jobs.length === 0)
+          return {};
+        return fetch( Config.serverUrl + '/urls/' + jobs.map(job => job.id).join(',') + '/' )
+          .then(results => {
+            return results.json();
+          })
       })
 
     Promise.all([statusApi, urlsApi]).then( values => {